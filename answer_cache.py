@@ -0,0 +1,127 @@
+import logging
+import math
+import operator
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # без numpy сравнение идет в чистом Python — медленнее, но кеш небольшой
+    np = None
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_MAX_ENTRIES = 500
+ANSWER_CACHE_TTL_SECONDS = 3600
+
+
+def _unit_vector(embedding: List[float]) -> Optional[List[float]]:
+    norm = math.sqrt(sum(x * x for x in embedding))
+    if not norm:
+        return None
+    return [x / norm for x in embedding]
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    similarity: float
+
+
+@dataclass
+class _Entry:
+    vector: List[float]
+    scope: Hashable
+    question: str
+    answer: str
+    expires_at: float
+
+
+class SemanticAnswerCache:
+    # Ответы на почти одинаковые вопросы: ищем ближайший сохраненный вопрос по косинусной близости
+    # эмбеддингов. scope — версия активной БЗ и ID ассистента: после обновления БЗ или смены
+    # ассистента старые ответы не выдаются.
+    def __init__(self, threshold: float = ANSWER_CACHE_SIMILARITY, maxsize: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl: float = ANSWER_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._next_id = 0
+        self._matrix: Any = None  # кеш numpy-матрицы векторов, сбрасывается при изменении записей
+        self._matrix_ids: List[int] = []
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _changed(self):
+        self._matrix = None
+
+    def _drop_expired(self, now: float):
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry.expires_at <= now]
+        for entry_id in expired:
+            del self._entries[entry_id]
+        if expired:
+            self._changed()
+
+    def _best_match(self, vector: List[float], scope: Hashable) -> Tuple[Optional[int], float]:
+        if np is not None:
+            if self._matrix is None:
+                self._matrix_ids = list(self._entries)
+                self._matrix = np.array([self._entries[i].vector for i in self._matrix_ids], dtype=np.float32)
+            scores = self._matrix @ np.asarray(vector, dtype=np.float32)
+            candidates = ((self._matrix_ids[i], float(scores[i])) for i in range(len(self._matrix_ids)))
+        else:
+            candidates = ((entry_id, sum(map(operator.mul, entry.vector, vector)))
+                          for entry_id, entry in self._entries.items())
+        best_id, best_score = None, -1.0
+        for entry_id, score in candidates:
+            if score > best_score and self._entries[entry_id].scope == scope:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def lookup(self, embedding: List[float], scope: Hashable) -> Optional[CachedAnswer]:
+        vector = _unit_vector(embedding)
+        self._drop_expired(time.monotonic())
+        if vector is None or not self._entries:
+            self.misses += 1
+            return None
+        entry_id, similarity = self._best_match(vector, scope)
+        if entry_id is None or similarity < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(entry_id)
+        self.hits += 1
+        entry = self._entries[entry_id]
+        return CachedAnswer(entry.question, entry.answer, similarity)
+
+    def store(self, embedding: List[float], scope: Hashable, question: str, answer: str):
+        vector = _unit_vector(embedding)
+        if vector is None:
+            return
+        self._entries[self._next_id] = _Entry(vector, scope, question, answer, time.monotonic() + self._ttl)
+        self._next_id += 1
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+        self._changed()
+
+    def invalidate(self, reason: str = ""):
+        if self._entries:
+            logger.info(f"Кеш ответов очищен ({len(self._entries)} записей){': ' + reason if reason else ''}.")
+        self._entries.clear()
+        self._changed()
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
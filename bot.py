@@ -1,44 +1,55 @@
 import sys
 import os
 import time as time_module # Используется
+# Отсчет этапов запуска — до импорта тяжелых зависимостей
+_BOT_STARTED_AT = time_module.perf_counter()
 import asyncio
 import logging
 import datetime # Используется datetime.datetime, datetime.time, datetime.date, datetime.timedelta
 # from datetime import timezone # Удалено, будем использовать pytz.utc
 import glob # Используется
-import io # Используется
-from io import BytesIO # Используется
 # import signal # Удалено, не используется явно
-# from collections import deque # Удалено, не используется
-from collections import defaultdict # Используется
-from typing import Optional, List, Dict, Any, Union # Добавлены для лучшей типизации
+from collections import deque # Используется
+from typing import Optional, List, Dict, Any, Tuple # Добавлены для лучшей типизации
 
 import pytz # Используется
 import shutil # Используется
-import requests # Используется
 import json # Используется
-import random # Используется
-import re # Используется
-import threading # Используется
 
 # --- Dependency Imports ---
-import vk_api
-from vk_api.bot_longpoll import VkBotLongPoll, VkBotEvent, VkBotEventType
+import aiohttp
+from vk_api.bot_longpoll import VkBotEvent, VkBotEventType, VkBotMessageEvent
 from vk_api.utils import get_random_id
 
 import openai
-import chromadb
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-import docx
-import PyPDF2
+# chromadb, LangChain, клиент Google Drive и парсеры PDF/DOCX импортируются при первом использовании:
+# они нужны для обновления БЗ, а не для ответов, и заметно замедляют перезапуск бота
 
-# LangChain components for specific tasks
-from langchain_openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
-# from langchain_core.documents import Document # Удалено, если не используется напрямую
+from vk_async import (
+    AsyncVkApi, AsyncVkBotLongPoll, VkApiError, VkAuthError, VkLongPollError, VkTransportError,
+    create_vk_http_session,
+)
+from vk_callback import create_callback_app, run_callback_server
+from vk_sender import VkOutboundScheduler, VkSendQueueFull
+from state_store import StateStore
+from bounded_cache import TTLCache, lock_is_idle
+from embedding_cache import ChunkEmbeddingStore, QueryEmbeddingCache, chunk_key
+from embedding_pipeline import EmbeddingPipeline, EmbeddingRunStats
+from answer_cache import SemanticAnswerCache
+from vector_index import NumpyVectorIndex, NumpyVectorIndexWriter, load_or_build_index
+from lexical_index import LexicalIndex, LexicalIndexBuilder, load_or_build_lexical_index, reciprocal_rank_fusion
+from drive_sync import DRIVE_PAGE_TOKEN_KEY, DriveChangesWatcher
+from drive_ingest import DriveDocumentReader
+from document_parsing import DOCUMENT_PARSERS, DocumentParsingService
+from kb_snapshot import KbSnapshot, KbSnapshotRegistry, write_active_pointer
+from kb_manifest import (
+    DRIVE_FILE_FIELDS, KbUpdatePlan, chunk_id, drive_file_fingerprint, load_manifest, plan_kb_update, save_manifest,
+)
+from startup_timing import StartupTimings
+
+startup_timings = StartupTimings(_BOT_STARTED_AT)
+startup_timings.mark("imports")
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -47,6 +58,27 @@ load_dotenv()
 # VK API Settings
 VK_GROUP_TOKEN = os.getenv("VK_GROUP_TOKEN")
 VK_API_VERSION = os.getenv("VK_API_VERSION", "5.199")
+VK_LONGPOLL_WAIT_SECONDS = 25
+VK_API_TIMEOUT_SECONDS = float(os.getenv("VK_API_TIMEOUT_SECONDS", "15"))
+VK_HTTP_POOL_SIZE = int(os.getenv("VK_HTTP_POOL_SIZE", "100"))
+# Исходящая очередь: лимит ключа сообщества ~20 запросов/сек
+VK_RATE_LIMIT_PER_SECOND = float(os.getenv("VK_RATE_LIMIT_PER_SECOND", "19"))
+VK_SEND_QUEUE_SIZE = int(os.getenv("VK_SEND_QUEUE_SIZE", "1000"))
+VK_SEND_MAX_RETRIES = int(os.getenv("VK_SEND_MAX_RETRIES", "5"))
+# Сколько ждать накопления запросов перед упаковкой в execute (0 — не ждать)
+VK_BATCH_LINGER_MS = float(os.getenv("VK_BATCH_LINGER_MS", "5"))
+
+# Источник событий: "longpoll" (по умолчанию) или "callback" (VK Callback API)
+VK_INGRESS_MODE = os.getenv("VK_INGRESS_MODE", "longpoll").strip().lower()
+VK_CALLBACK_HOST = os.getenv("VK_CALLBACK_HOST", "0.0.0.0")
+VK_CALLBACK_PORT = int(os.getenv("VK_CALLBACK_PORT", "8080"))
+VK_CALLBACK_PATH = os.getenv("VK_CALLBACK_PATH", "/vk/callback")
+VK_CALLBACK_CONFIRMATION_CODE = os.getenv("VK_CALLBACK_CONFIRMATION_CODE")
+VK_CALLBACK_SECRET = os.getenv("VK_CALLBACK_SECRET")
+if VK_INGRESS_MODE not in ("longpoll", "callback"):
+    raise ValueError("❌ Ошибка: VK_INGRESS_MODE должен быть 'longpoll' или 'callback'!")
+if VK_INGRESS_MODE == "callback" and not VK_CALLBACK_CONFIRMATION_CODE:
+    raise ValueError("❌ Ошибка: для VK_INGRESS_MODE=callback нужен VK_CALLBACK_CONFIRMATION_CODE в .env!")
 
 # Исправление №9: Преобразование VK_GROUP_ID в int сразу
 VK_GROUP_ID_STR = os.getenv("VK_GROUP_ID")
@@ -67,6 +99,16 @@ EMBEDDING_DIMENSIONS = 1536
 # Google Drive Settings
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE", 'service-account-key.json')
 FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+# Отслеживание правок в папке через Drive changes.list вместо ночного обновления в 04:00
+DRIVE_SYNC_ENABLED = os.getenv("DRIVE_SYNC_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+DRIVE_SYNC_INTERVAL_SECONDS = int(os.getenv("DRIVE_SYNC_INTERVAL_SECONDS", "180"))
+# Параллельное чтение БЗ: потоки для скачивания и процессы для разбора документов (0 — по числу ядер).
+# Разбор одного файла ограничен по времени и памяти процесса-воркера (DOCUMENT_PARSE_MEMORY_LIMIT_MB —
+# сверх адресного пространства, унаследованного от бота).
+DRIVE_DOWNLOAD_WORKERS = int(os.getenv("DRIVE_DOWNLOAD_WORKERS", "8"))
+DOCUMENT_PARSE_WORKERS = int(os.getenv("DOCUMENT_PARSE_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+DOCUMENT_PARSE_TIMEOUT_SECONDS = int(os.getenv("DOCUMENT_PARSE_TIMEOUT_SECONDS", "120"))
+DOCUMENT_PARSE_MEMORY_LIMIT_MB = int(os.getenv("DOCUMENT_PARSE_MEMORY_LIMIT_MB", "1024"))
 
 # User/Manager IDs
 try:
@@ -85,6 +127,39 @@ VECTOR_DB_BASE_PATH = "./local_vector_db"
 ACTIVE_DB_INFO_FILE = "active_db_info.txt"
 VECTOR_DB_COLLECTION_NAME = "documents_collection"
 RELEVANT_CONTEXT_COUNT = 3
+# Поиск по БЗ: "numpy" — матрица эмбеддингов в памяти процесса, "chroma" — запрос к коллекции ChromaDB
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "numpy").strip().lower()
+if VECTOR_BACKEND not in ("numpy", "chroma"):
+    raise ValueError("❌ Ошибка: VECTOR_BACKEND должен быть 'numpy' или 'chroma'!")
+# Гибридный поиск: к векторному добавляется BM25 по точным словам (названия, цены, артикулы),
+# списки объединяются через reciprocal rank fusion. Каждый поиск берет k * множитель кандидатов.
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+HYBRID_CANDIDATES_MULTIPLIER = 4
+# Кеш эмбеддингов запросов: частые вопросы ("адрес", "сколько стоит") не ходят в OpenAI повторно.
+# Пустой QUERY_EMBEDDING_CACHE_DIR — только кеш в памяти.
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_DIR = os.getenv("QUERY_EMBEDDING_CACHE_DIR", "./embedding_cache")
+QUERY_EMBEDDING_DISK_CAPACITY = int(os.getenv("QUERY_EMBEDDING_DISK_CAPACITY", "50000"))
+# Эмбеддинги чанков по sha256 текста: при пересборке БЗ в OpenAI уходят только новые тексты.
+# Пустое значение отключает кеш.
+CHUNK_EMBEDDING_CACHE_DIR = os.getenv("CHUNK_EMBEDDING_CACHE_DIR", "./embedding_cache")
+# Эмбеддинги чанков запрашиваются пачками не больше EMBEDDING_BATCH_MAX_TOKENS токенов,
+# одновременно не больше EMBEDDING_CONCURRENCY запросов
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "250000"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+# Обновление БЗ идет пачками по KB_INGEST_BATCH_CHUNKS чанков: пачка эмбеддится и сразу пишется в новую
+# базу. Одновременно в работе не больше KB_INGEST_MAX_PENDING_BATCHES пачек — пиковая память зависит
+# от размера пачки, а не от размера базы знаний.
+KB_INGEST_BATCH_CHUNKS = 256
+KB_INGEST_MAX_PENDING_BATCHES = 4
+# При старте БЗ обновляется, только если активной базы нет, манифест не подходит или последнее
+# обновление было больше KB_MAX_AGE_HOURS часов назад (0 — обновлять при каждом запуске)
+KB_MAX_AGE_HOURS = float(os.getenv("KB_MAX_AGE_HOURS", "24"))
+# Кеш готовых ответов на почти одинаковые вопросы (по умолчанию выключен)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
 
 # Bot Behavior Settings
 # MESSAGE_LIFETIME_DAYS = 100 # Удалено, если не используется для хранения истории в памяти
@@ -92,6 +167,11 @@ MESSAGE_COOLDOWN_SECONDS = 3
 MESSAGE_BUFFER_SECONDS = 4
 LOG_RETENTION_SECONDS = 86400
 OPENAI_RUN_TIMEOUT_SECONDS = 90
+# Ответ ассистента получаем потоком событий; опрос остается запасным вариантом
+OPENAI_USE_STREAMING = os.getenv("OPENAI_USE_STREAMING", "true").strip().lower() in ("1", "true", "yes")
+OPENAI_POLL_INITIAL_DELAY_SECONDS = 0.25
+OPENAI_POLL_BACKOFF_FACTOR = 1.5
+OPENAI_POLL_MAX_DELAY_SECONDS = 2.0
 
 # Time Settings
 TIMEZONE_STR = os.getenv("TIMEZONE_STR", "Asia/Yekaterinburg")
@@ -146,16 +226,34 @@ if missing_vars_list:
     raise ValueError(f"❌ Ошибка: Не найдены переменные в .env: {', '.join(missing_vars_list)}")
 
 # --- Global State (In-Memory) ---
-user_threads: Dict[str, str] = {}
-user_processing_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
-user_last_message_time: Dict[int, datetime.datetime] = {}
-chat_silence_state: Dict[int, bool] = {}
-MY_PENDING_RANDOM_IDS: set = set()
+# Все словари с ключом по пользователю ограничены по размеру и времени жизни,
+# иначе за месяцы работы они копят записи обо всех, кто когда-либо писал боту
+STATE_CACHE_MAX_ENTRIES = int(os.getenv("STATE_CACHE_MAX_ENTRIES", "10000"))
+STATE_CACHE_TTL_SECONDS = int(os.getenv("STATE_CACHE_TTL_SECONDS", str(6 * 3600)))
+USER_LOCK_TTL_SECONDS = int(os.getenv("USER_LOCK_TTL_SECONDS", "3600"))
+
+# Занятые блокировки и блокировки с ожидающими не вытесняются
+user_processing_locks: TTLCache[int, asyncio.Lock] = TTLCache(
+    STATE_CACHE_MAX_ENTRIES, USER_LOCK_TTL_SECONDS,
+    default_factory=asyncio.Lock, can_evict=lock_is_idle, name="user_locks",
+)
+# Сколько хранить в state_store random_id своих сообщений, чтобы узнать их в message_reply
+OWN_MESSAGE_TTL_SECONDS = 24 * 3600
 
-pending_messages: Dict[int, List[str]] = {}
+# Задачи-таймеры буферизации живут только в памяти; их сроки сохраняются в хранилище состояния
 user_message_timers: Dict[int, asyncio.Task] = {}
 
-SILENCE_STATE_FILE = "silence_state.json"
+SILENCE_STATE_FILE = "silence_state.json" # Устаревший формат, импортируется при старте
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "bot_state.sqlite3")
+
+# --- Persistent State (SQLite) ---
+# Треды, режим молчания, кулдауны и буферы сообщений переживают перезапуски
+state_store = StateStore(
+    STATE_DB_FILE,
+    cache_size=STATE_CACHE_MAX_ENTRIES,
+    cache_ttl=STATE_CACHE_TTL_SECONDS,
+    cooldown_ttl=max(60, MESSAGE_COOLDOWN_SECONDS),
+)
 
 # --- Initialize API Clients ---
 try:
@@ -165,17 +263,30 @@ except Exception as e:
     logger.critical(f"Не удалось инициализировать клиент OpenAI: {e}", exc_info=True)
     sys.exit(1)
 
-try:
-    vk_session_api = vk_api.VkApi(token=VK_GROUP_TOKEN, api_version=VK_API_VERSION)
-    logger.info("VK API сессия инициализирована (СИНХРОННО).")
-except vk_api.AuthError as e:
-     logger.critical(f"Ошибка авторизации VK: {e}. Проверьте токен группы.", exc_info=True)
-     sys.exit(1)
-except Exception as e:
-    logger.critical(f"Ошибка инициализации VK API: {e}", exc_info=True)
-    sys.exit(1)
-
-vector_collection: Optional[chromadb.api.models.Collection.Collection] = None
+# Асинхронный клиент VK API с общим пулом соединений (создается в main(), нужен запущенный event loop)
+vk_http_session: Optional[aiohttp.ClientSession] = None
+vk_client: Optional[AsyncVkApi] = None
+vk_sender: Optional[VkOutboundScheduler] = None
+
+# Активная версия БЗ (коллекция Chroma, индексы NumPy и BM25, файлы из манифеста). Запросы берут снимок
+# через kb_snapshots.reading(), после обновления старая версия удаляется, когда ее отпустит последний запрос.
+kb_snapshots = KbSnapshotRegistry()
+drive_watcher: Optional[DriveChangesWatcher] = None
+
+# Эмбеддинги запросов зависят только от модели и размерности, поэтому кеш переживает обновления БЗ
+query_embedding_cache = QueryEmbeddingCache(
+    EMBEDDING_MODEL, EMBEDDING_DIMENSIONS,
+    maxsize=QUERY_EMBEDDING_CACHE_SIZE,
+    disk_dir=QUERY_EMBEDDING_CACHE_DIR or None,
+    disk_capacity=QUERY_EMBEDDING_DISK_CAPACITY,
+)
+embedding_pipeline = EmbeddingPipeline(
+    openai_client, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS,
+    max_tokens_per_request=EMBEDDING_BATCH_MAX_TOKENS, concurrency=EMBEDDING_CONCURRENCY,
+)
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_SIMILARITY, maxsize=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL_SECONDS,
+)
 
 def _get_active_db_subpath() -> Optional[str]:
     try:
@@ -200,31 +311,88 @@ def _get_active_db_subpath() -> Optional[str]:
         logger.error(f"Ошибка при чтении файла информации об активной БД: {e}", exc_info=True)
         return None
 
-async def _initialize_active_vector_collection():
-    global vector_collection
-    active_subdir = _get_active_db_subpath()
-    if active_subdir:
-        active_db_full_path = os.path.join(VECTOR_DB_BASE_PATH, active_subdir)
+async def _open_kb_snapshot(active_subdir: str) -> Optional[KbSnapshot]:
+    active_db_full_path = os.path.join(VECTOR_DB_BASE_PATH, active_subdir)
+    try:
+        chromadb = await asyncio.to_thread(_load_chromadb)
+        chroma_client_init = chromadb.PersistentClient(path=active_db_full_path)
+        collection = chroma_client_init.get_or_create_collection(
+            name=VECTOR_DB_COLLECTION_NAME,
+        )
+        logger.info(f"Успешно подключено к ChromaDB: '{active_db_full_path}'. Коллекция: '{VECTOR_DB_COLLECTION_NAME}'.")
+        logger.info(f"Документов в активной коллекции при старте: {collection.count()}")
+    except Exception as e:
+        logger.error(f"Ошибка инициализации ChromaDB для пути '{active_db_full_path}': {e}. Поиск по базе знаний будет недоступен.", exc_info=True)
+        return None
+    new_vector_index: Optional[NumpyVectorIndex] = None
+    if VECTOR_BACKEND == "numpy":
         try:
-            os.makedirs(VECTOR_DB_BASE_PATH, exist_ok=True)
-            os.makedirs(active_db_full_path, exist_ok=True) 
-            
-            chroma_client_init = chromadb.PersistentClient(path=active_db_full_path)
-            vector_collection = chroma_client_init.get_or_create_collection(
-                name=VECTOR_DB_COLLECTION_NAME,
-            )
-            logger.info(f"Успешно подключено к ChromaDB: '{active_db_full_path}'. Коллекция: '{VECTOR_DB_COLLECTION_NAME}'.")
-            if vector_collection:
-                logger.info(f"Документов в активной коллекции при старте: {vector_collection.count()}")
+            new_vector_index = await asyncio.to_thread(load_or_build_index, active_db_full_path, collection)
+            logger.info(f"Векторный индекс NumPy загружен: {len(new_vector_index)} векторов.")
         except Exception as e:
-            logger.error(f"Ошибка инициализации ChromaDB для пути '{active_db_full_path}': {e}. Поиск по базе знаний будет недоступен.", exc_info=True)
-            vector_collection = None
-    else:
+            logger.error(f"Не удалось загрузить векторный индекс NumPy, поиск пойдет через ChromaDB: {e}", exc_info=True)
+    new_lexical_index: Optional[LexicalIndex] = None
+    if HYBRID_SEARCH_ENABLED:
+        try:
+            new_lexical_index = await asyncio.to_thread(load_or_build_lexical_index, active_db_full_path, collection)
+            logger.info(f"Лексический индекс загружен: {len(new_lexical_index)} документов.")
+        except Exception as e:
+            logger.error(f"Не удалось загрузить лексический индекс, поиск будет только векторным: {e}", exc_info=True)
+    manifest = load_manifest(active_db_full_path)
+    return KbSnapshot(
+        active_subdir, active_db_full_path, chroma_client_init, collection,
+        vector_index=new_vector_index, lexical_index=new_lexical_index,
+        file_ids=set(manifest["files"]) if manifest else None,
+    )
+
+def _activate_kb_snapshot(snapshot: Optional[KbSnapshot], delete_previous: bool = True):
+    previous_state = kb_snapshots.state_key
+    kb_snapshots.swap(snapshot, delete_previous=delete_previous)
+    if kb_snapshots.state_key != previous_state:
+        answer_cache.invalidate(f"активная БЗ сменилась ({previous_state} -> {kb_snapshots.state_key})")
+
+async def _initialize_active_vector_collection():
+    active_subdir = _get_active_db_subpath()
+    if not active_subdir:
         logger.warning("Не удалось определить активную директорию БД. База знаний будет недоступна.")
-        vector_collection = None
+    snapshot = await _open_kb_snapshot(active_subdir) if active_subdir else None
+    # Каталог по указателю не удаляем: если он не открылся, его еще можно разобрать вручную
+    _activate_kb_snapshot(snapshot, delete_previous=False)
+
+def _startup_kb_decision() -> Tuple[bool, str]:
+    # (нужно ли обновление при старте, причина); при устаревшей базе обновление инкрементальное
+    snapshot = kb_snapshots.current
+    if snapshot is None:
+        return True, "активной базы нет"
+    manifest = load_manifest(snapshot.path)
+    if manifest is None:
+        return True, "нет манифеста активной базы"
+    if (manifest.get("embedding_model") != EMBEDDING_MODEL
+            or manifest.get("embedding_dimensions") != EMBEDDING_DIMENSIONS):
+        return True, "сменилась модель эмбеддингов"
+    if not manifest["files"]:
+        return True, "в манифесте нет файлов"
+    try:
+        updated_at = datetime.datetime.fromisoformat(manifest["updated_at"])
+    except (KeyError, TypeError, ValueError):
+        return True, "неизвестно время последнего обновления"
+    age_hours = (datetime.datetime.now(datetime.timezone.utc) - updated_at).total_seconds() / 3600
+    if KB_MAX_AGE_HOURS <= 0 or age_hours > KB_MAX_AGE_HOURS:
+        return True, f"база сверялась с Google Drive {age_hours:.1f} ч назад (лимит {KB_MAX_AGE_HOURS:g} ч)"
+    return False, f"база '{snapshot.version}' сверялась с Google Drive {age_hours:.1f} ч назад, файлов: {len(manifest['files'])}"
+
+def _load_chromadb():
+    import chromadb
+    return chromadb
+
+def _load_text_splitters():
+    from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
 
 def get_drive_service():
     try:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
         credentials = service_account.Credentials.from_service_account_file(
             SERVICE_ACCOUNT_FILE,
             scopes=['https://www.googleapis.com/auth/drive.readonly']
@@ -239,7 +407,22 @@ def get_drive_service():
         logger.error(f"Ошибка при получении сервиса Google Drive: {e}", exc_info=True)
         return None
 
-drive_service = get_drive_service()
+# Общий сервис Drive для списка файлов создается при первом обновлении БЗ (discovery небыстрый)
+drive_service: Optional[Any] = None
+
+def get_shared_drive_service():
+    global drive_service
+    if drive_service is None:
+        drive_service = get_drive_service()
+    return drive_service
+
+document_parser = DocumentParsingService(
+    workers=DOCUMENT_PARSE_WORKERS, timeout=DOCUMENT_PARSE_TIMEOUT_SECONDS,
+    memory_limit_mb=DOCUMENT_PARSE_MEMORY_LIMIT_MB,
+)
+# Каждый поток скачивания создает себе отдельный сервис через get_drive_service
+drive_reader = DriveDocumentReader(get_drive_service, document_parser, download_workers=DRIVE_DOWNLOAD_WORKERS)
+startup_timings.mark("config_and_clients")
 
 # --- Helper Functions ---
 def get_user_key(user_id: int) -> str:
@@ -253,123 +436,91 @@ def is_non_working_hours() -> bool:
     is_non_working = current_time_local >= WORK_END_TIME or current_time_local < WORK_START_TIME
     return is_non_working
 
+def _forget_own_message(peer_id: int, random_id: int):
+    if not random_id:
+        return
+    state_store.forget_own_message(peer_id, random_id)
+    logger.debug(f"Удален random_id {random_id} из-за ошибки отправки для peer_id={peer_id}")
+
 async def send_vk_message(peer_id: int, message: str):
     if not message:
         logger.warning(f"Попытка отправить пустое сообщение в peer_id={peer_id}")
         return
-    current_random_id = 0 # Инициализация для блока finally
+    if not vk_sender:
+        logger.error(f"Отправка сообщения в peer_id={peer_id} невозможна: очередь VK не инициализирована.")
+        return
+    current_random_id = 0 # Инициализация для блока except
     try:
-        current_random_id = vk_api.utils.get_random_id()
-        MY_PENDING_RANDOM_IDS.add(current_random_id)
-        logger.debug(f"Добавлен random_id {current_random_id} в MY_PENDING_RANDOM_IDS для peer_id={peer_id}")
+        current_random_id = get_random_id()
+        state_store.remember_own_message(peer_id, current_random_id)
+        logger.debug(f"Сохранен random_id {current_random_id} собственного сообщения для peer_id={peer_id}")
 
-        await asyncio.to_thread(
-            vk_session_api.method,
+        await vk_sender.call(
             'messages.send',
             {
                 'peer_id': peer_id,
                 'message': message,
                 'random_id': current_random_id
-            }
+            },
+            peer_id=peer_id
         )
-    except vk_api.exceptions.ApiError as e:
+    except VkApiError as e:
         logger.error(f"Ошибка VK API при отправке сообщения в peer_id={peer_id}: {e}", exc_info=True)
-        # Исправление №2: Упрощение условия
-        if current_random_id in MY_PENDING_RANDOM_IDS:
-            MY_PENDING_RANDOM_IDS.remove(current_random_id)
-            logger.debug(f"Удален random_id {current_random_id} из MY_PENDING_RANDOM_IDS из-за ошибки отправки для peer_id={peer_id}")
+        _forget_own_message(peer_id, current_random_id)
     except Exception as e:
         logger.error(f"Непредвиденная ошибка при отправке сообщения в peer_id={peer_id}: {e}", exc_info=True)
-        # Исправление №2: Упрощение условия
-        if current_random_id in MY_PENDING_RANDOM_IDS:
-            MY_PENDING_RANDOM_IDS.remove(current_random_id)
-            logger.debug(f"Удален random_id {current_random_id} из MY_PENDING_RANDOM_IDS из-за ошибки отправки для peer_id={peer_id}")
+        _forget_own_message(peer_id, current_random_id)
+
 
+def _log_typing_result(peer_id: int, future: asyncio.Future):
+    if future.cancelled():
+        return
+    if future.exception():
+        logger.warning(f"Не удалось установить статус 'typing' для peer_id={peer_id}: {future.exception()}")
 
 async def set_typing_activity(peer_id: int):
+     if not vk_sender:
+         return
+     # Статус "печатает" не ждем: он не должен задерживать запрос к ассистенту
      try:
-        await asyncio.to_thread(
-             vk_session_api.method,
-             'messages.setActivity',
-             {'type': 'typing', 'peer_id': peer_id}
-         )
+        future = vk_sender.submit_nowait('messages.setActivity', {'type': 'typing', 'peer_id': peer_id}, peer_id=peer_id)
+        future.add_done_callback(lambda f: _log_typing_result(peer_id, f))
+     except VkSendQueueFull as e:
+         logger.warning(f"Статус 'typing' для peer_id={peer_id} пропущен: {e}")
      except Exception as e:
          logger.warning(f"Не удалось установить статус 'typing' для peer_id={peer_id}: {e}")
 
 # --- Silence Mode Management (Permanent Only) ---
-async def save_silence_state_to_file():
-    logger.debug("Сохранение состояния постоянных режимов молчания в файл...")
-    data_to_save = {str(peer_id): True for peer_id, is_silent in chat_silence_state.items() if is_silent}
+async def migrate_silence_state_file():
+    # Раньше режимы молчания хранились в JSON; переносим их в хранилище состояния один раз
     try:
-        def _save():
-            with open(SILENCE_STATE_FILE, "w", encoding="utf-8") as f:
-                json.dump(data_to_save, f, indent=4)
-        await asyncio.to_thread(_save)
-        logger.info(f"Состояние постоянных режимов молчания сохранено в {SILENCE_STATE_FILE}")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении состояния режимов молчания: {e}", exc_info=True)
-
-async def load_silence_state_from_file():
-    global chat_silence_state
-    logger.info("Загрузка состояния постоянных режимов молчания из файла...")
-    try:
-        def _load():
-            if not os.path.exists(SILENCE_STATE_FILE):
-                logger.info(f"Файл {SILENCE_STATE_FILE} не найден. Пропускаем загрузку.")
-                return None
-            with open(SILENCE_STATE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        
-        loaded_data = await asyncio.to_thread(_load)
-
-        if not loaded_data:
-            return
-
-        restored_count = 0
-        for peer_id_str, should_be_silent in loaded_data.items():
-            try:
-                peer_id = int(peer_id_str)
-                if should_be_silent:
-                    chat_silence_state[peer_id] = True
-                    logger.info(f"Восстановлен постоянный режим молчания для peer_id={peer_id}")
-                    restored_count += 1
-            except (ValueError, KeyError) as e:
-                logger.error(f"Ошибка при обработке записи для peer_id_str='{peer_id_str}': {e}", exc_info=True)
-        
-        if restored_count > 0:
-            logger.info(f"Успешно восстановлено {restored_count} состояний постоянного молчания.")
-        else:
-            logger.info("Активных состояний постоянного молчания для восстановления не найдено.")
-    except FileNotFoundError: # Обработка FileNotFoundError здесь, если _load() вернет None из-за отсутствия файла
-        logger.info(f"Файл {SILENCE_STATE_FILE} не найден. Запуск с чистым состоянием молчания.")
+        imported = await state_store.import_silence_json(SILENCE_STATE_FILE)
+        if imported:
+            logger.info(f"Режимы молчания из {SILENCE_STATE_FILE} перенесены в {STATE_DB_FILE} ({imported} шт.).")
     except json.JSONDecodeError:
         logger.error(f"Ошибка декодирования JSON из файла {SILENCE_STATE_FILE}. Возможно, файл поврежден.")
     except Exception as e:
-        logger.error(f"Непредвиденная ошибка при загрузке состояния режимов молчания: {e}", exc_info=True)
+        logger.error(f"Непредвиденная ошибка при переносе состояния режимов молчания: {e}", exc_info=True)
 
 async def silence_user(peer_id: int):
-    if chat_silence_state.get(peer_id):
+    if not await state_store.silence(peer_id):
         logger.info(f"Постоянный режим молчания для peer_id={peer_id} уже был активен.")
         return
-    logger.info(f"Активация постоянного режима молчания для peer_id={peer_id}.")
-    chat_silence_state[peer_id] = True
-    await save_silence_state_to_file()
+    logger.info(f"Активирован постоянный режим молчания для peer_id={peer_id}.")
 
 async def unsilence_user(peer_id: int):
-    if peer_id in chat_silence_state:
+    if await state_store.unsilence(peer_id):
         logger.info(f"Ручная деактивация (командой speak) режима молчания для peer_id={peer_id}.")
-        chat_silence_state.pop(peer_id)
-        await save_silence_state_to_file()
     else:
          logger.debug(f"Попытка снять молчание для peer_id={peer_id}, но бот и так был активен.")
 
 # --- Функции буферизации сообщений ---
-async def schedule_buffered_processing(peer_id: int, original_user_id: int):
+async def schedule_buffered_processing(peer_id: int, original_user_id: int, delay: float = MESSAGE_BUFFER_SECONDS):
     log_prefix = f"schedule_buffered_processing(peer:{peer_id}, user:{original_user_id}):"
     current_task = asyncio.current_task()
     try:
-        logger.debug(f"{log_prefix} Ожидание {MESSAGE_BUFFER_SECONDS} секунд...")
-        await asyncio.sleep(MESSAGE_BUFFER_SECONDS)
+        logger.debug(f"{log_prefix} Ожидание {delay:.1f} секунд...")
+        await asyncio.sleep(delay)
         task_in_dict = user_message_timers.get(peer_id)
         if task_in_dict is not current_task:
             logger.info(f"{log_prefix} Таймер сработал, но он устарел. Обработка отменена.")
@@ -385,12 +536,34 @@ async def schedule_buffered_processing(peer_id: int, original_user_id: int):
         if peer_id in user_message_timers and user_message_timers.get(peer_id) is current_task:
             del user_message_timers[peer_id]
 
+def restore_buffered_messages():
+    # Сообщения, буферизованные до перезапуска, обрабатываем в их исходный срок (или сразу, если он прошел)
+    now_ts = time_module.time()
+    timers = state_store.buffer_timers()
+    restored = 0
+    for peer_id in state_store.pending_peers():
+        if peer_id in user_message_timers:
+            continue
+        timer = timers.get(peer_id)
+        if not timer:
+            continue
+        original_user_id, due_at = timer
+        delay = max(0.0, due_at - now_ts)
+        user_message_timers[peer_id] = asyncio.create_task(schedule_buffered_processing(peer_id, original_user_id, delay))
+        restored += 1
+    for peer_id in timers:
+        if peer_id not in user_message_timers:
+            state_store.clear_buffer_timer(peer_id)
+    if restored:
+        logger.info(f"Восстановлено {restored} буферов сообщений после перезапуска.")
+
 async def process_buffered_messages(peer_id: int, original_user_id: int):
     log_prefix = f"process_buffered_messages(peer:{peer_id}, user:{original_user_id}):"
     logger.debug(f"{log_prefix} Начало обработки буферизованных сообщений.")
     async with user_processing_locks[peer_id]:
         logger.debug(f"{log_prefix} Блокировка для peer_id={peer_id} получена.")
-        messages_to_process = pending_messages.pop(peer_id, [])
+        messages_to_process = state_store.pop_pending(peer_id)
+        state_store.clear_buffer_timer(peer_id)
         if peer_id in user_message_timers:
             logger.warning(f"{log_prefix} Таймер для peer_id={peer_id} все еще существовал! Отменяем и удаляем.")
             timer_to_cancel = user_message_timers.pop(peer_id)
@@ -419,39 +592,289 @@ async def process_buffered_messages(peer_id: int, original_user_id: int):
         finally:
             logger.debug(f"{log_prefix} Блокировка для peer_id={peer_id} освобождена.")
 
+# --- Thread/Run State Tracking ---
+# Локально помним, какие треды уже проверены и какой run мы запустили в каждом.
+# Проверки в OpenAI (messages.list / runs.list) нужны только после ошибки или перезапуска.
+OPENAI_TERMINAL_RUN_STATUSES = ('completed', 'failed', 'cancelled', 'expired')
+
+class ThreadRunTracker:
+    # Вытесненный тред просто снова проверяется в OpenAI, поэтому размер можно ограничить
+    def __init__(self, maxsize: int = STATE_CACHE_MAX_ENTRIES, ttl: float = STATE_CACHE_TTL_SECONDS):
+        self._states: TTLCache[str, Dict[str, Any]] = TTLCache(maxsize, ttl, name="thread_runs")
+
+    def is_verified(self, thread_id: str) -> bool:
+        state = self._states.get(thread_id)
+        return bool(state and state["verified"] and not state["dirty"])
+
+    def mark_verified(self, thread_id: str, runs_checked: bool = False):
+        # runs_checked=False: тред существует, но о его run'ах (например, до перезапуска) мы ничего не знаем
+        state = self._states.setdefault(thread_id, {
+            "verified": False, "runs_checked": False, "dirty": False, "active_run_id": None, "finished_at": None,
+        })
+        state["verified"] = True
+        state["dirty"] = False
+        state["runs_checked"] = state["runs_checked"] or runs_checked
+
+    def needs_run_check(self, thread_id: str) -> bool:
+        state = self._states.get(thread_id)
+        return not state or not state["runs_checked"] or state["dirty"] or state["active_run_id"] is not None
+
+    def mark_runs_clean(self, thread_id: str):
+        state = self._states.get(thread_id)
+        if state:
+            state["active_run_id"] = None
+            state["runs_checked"] = True
+            state["dirty"] = False
+
+    def mark_run_started(self, thread_id: str, run_id: str):
+        state = self._states.get(thread_id)
+        if state:
+            state["active_run_id"] = run_id
+
+    def mark_run_finished(self, thread_id: str, run_id: str):
+        state = self._states.get(thread_id)
+        if state and state["active_run_id"] == run_id:
+            state["active_run_id"] = None
+            state["finished_at"] = time_module.time()
+
+    def mark_dirty(self, thread_id: str):
+        state = self._states.get(thread_id)
+        if state:
+            state["dirty"] = True
+
+    def forget(self, thread_id: str):
+        self._states.pop(thread_id, None)
+
+    def clear(self):
+        self._states.clear()
+
+    def sweep(self) -> int:
+        return self._states.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._states.stats()
+
+thread_run_tracker = ThreadRunTracker()
+
+# Длительность chat_with_assistant (сек) для оценки p50/p95 задержки ответа
+REPLY_LATENCY_SAMPLES_LIMIT = 1000
+reply_latency_samples: deque = deque(maxlen=REPLY_LATENCY_SAMPLES_LIMIT)
+
+def reply_latency_stats() -> Dict[str, float]:
+    samples = sorted(reply_latency_samples)
+    if not samples:
+        return {"count": 0, "p50_s": 0.0, "p95_s": 0.0}
+    return {
+        "count": len(samples),
+        "p50_s": round(samples[len(samples) // 2], 2),
+        "p95_s": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+    }
+
 # --- OpenAI Assistant Interaction ---
 async def get_or_create_thread(user_id: int) -> Optional[str]:
     user_key = get_user_key(user_id)
-    if user_key in user_threads:
-        thread_id = user_threads[user_key]
+    thread_id = await state_store.get_thread(user_key)
+    if thread_id:
+        if thread_run_tracker.is_verified(thread_id):
+            logger.info(f"Используем существующий тред {thread_id} для user_id={user_id}")
+            return thread_id
         try:
             await openai_client.beta.threads.messages.list(thread_id=thread_id, limit=1)
-            logger.info(f"Используем существующий тред {thread_id} для user_id={user_id}")
+            thread_run_tracker.mark_verified(thread_id)
+            logger.info(f"Используем существующий тред {thread_id} для user_id={user_id} (проверен в OpenAI)")
             return thread_id
         except openai.NotFoundError:
             logger.warning(f"Тред {thread_id} не найден в OpenAI для user_id={user_id}. Создаем новый.")
-            if user_key in user_threads: del user_threads[user_key]
+            thread_run_tracker.forget(thread_id)
+            state_store.discard_thread(user_key)
         except Exception as e:
             logger.error(f"Ошибка доступа к треду {thread_id} для user_id={user_id}: {e}. Создаем новый.")
-            if user_key in user_threads: del user_threads[user_key]
+            thread_run_tracker.forget(thread_id)
+            state_store.discard_thread(user_key)
     try:
         logger.info(f"Создаем новый тред для user_id={user_id}...")
         thread = await openai_client.beta.threads.create()
         thread_id = thread.id
-        user_threads[user_key] = thread_id
+        state_store.set_thread(user_key, thread_id)
+        # Новый тред пуст, активных run в нем нет
+        thread_run_tracker.mark_verified(thread_id, runs_checked=True)
         logger.info(f"Создан новый тред {thread_id} для user_id={user_id}")
         return thread_id
     except Exception as e:
         logger.error(f"Критическая ошибка при создании нового треда для user_id={user_id}: {e}", exc_info=True)
         return None
 
+def _extract_text_content(message) -> Optional[str]:
+    if message.content and message.content[0].type == 'text':
+        return message.content[0].text.value
+    return None
+
+async def _cancel_run_quietly(thread_id: str, run_id: str, reason: str):
+    try:
+        await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        logger.info(f"Отменен run {run_id} ({reason}).")
+    except Exception as cancel_error:
+        logger.warning(f"Не удалось отменить run {run_id} ({reason}): {cancel_error}")
+
+def _log_failed_run(run_id: str, status: str, last_error) -> None:
+    error_message = f"Run {run_id} завершился со статусом '{status}'."
+    if last_error: error_message += f" Ошибка: {last_error.message} (Код: {last_error.code})"
+    logger.error(error_message)
+
+async def _stream_assistant_run(thread_id: str, result: Dict[str, Any]):
+    # Ответ приходит событием thread.message.completed, статус — thread.run.*
+    async with openai_client.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=ASSISTANT_ID
+    ) as stream:
+        async for event in stream:
+            if event.event == "thread.run.created":
+                result["run_id"] = event.data.id
+                thread_run_tracker.mark_run_started(thread_id, event.data.id)
+                logger.info(f"Запущен новый run {event.data.id} для треда {thread_id} (streaming)")
+            elif event.event == "thread.message.completed":
+                if event.data.role == "assistant":
+                    text = _extract_text_content(event.data)
+                    if text: result["text"] = text
+            elif event.event == "thread.run.completed":
+                result["status"] = "completed"
+                logger.info(f"Run {event.data.id} успешно завершен.")
+            elif event.event in ("thread.run.failed", "thread.run.cancelled", "thread.run.expired"):
+                result["status"] = event.data.status
+                _log_failed_run(event.data.id, event.data.status, getattr(event.data, 'last_error', None))
+            elif event.event == "thread.run.requires_action":
+                result["status"] = "requires_action"
+                break
+
+async def _poll_assistant_run(thread_id: str, run_id: str, result: Dict[str, Any]):
+    # Опрос с адаптивной паузой: первые проверки частые, дальше реже
+    delay = OPENAI_POLL_INITIAL_DELAY_SECONDS
+    while True:
+        await asyncio.sleep(delay)
+        run_status = await openai_client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+        if run_status.status == 'completed':
+            logger.info(f"Run {run_id} успешно завершен.")
+            result["status"] = "completed"
+            return
+        elif run_status.status in ['failed', 'cancelled', 'expired']:
+            _log_failed_run(run_id, run_status.status, getattr(run_status, 'last_error', None))
+            result["status"] = run_status.status
+            return
+        elif run_status.status == 'requires_action':
+            result["status"] = "requires_action"
+            return
+        delay = min(delay * OPENAI_POLL_BACKOFF_FACTOR, OPENAI_POLL_MAX_DELAY_SECONDS)
+
+async def _find_started_run(thread_id: str, not_before: Optional[int]):
+    # Поток мог оборваться после того, как OpenAI принял run, но до события thread.run.created.
+    # Новый runs.create тогда упал бы с "already has an active run" или, если run успел
+    # завершиться, запустил бы второй платный run. Свой run — активный или созданный не раньше вопроса
+    runs = await openai_client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+    if not runs.data:
+        return None
+    run = runs.data[0]
+    if run.status not in OPENAI_TERMINAL_RUN_STATUSES or (not_before is not None and run.created_at >= not_before):
+        return run
+    return None
+
+async def _run_assistant_with_fallback(thread_id: str, result: Dict[str, Any], not_before: Optional[int]):
+    if OPENAI_USE_STREAMING:
+        try:
+            await _stream_assistant_run(thread_id, result)
+            if result["status"] is not None:
+                return
+            logger.warning(f"Поток run {result['run_id']} закрылся без финального статуса. Переходим на опрос.")
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            raise
+        except Exception as e_stream:
+            logger.warning(f"Streaming run для треда {thread_id} не удался: {e_stream}. Переходим на опрос.")
+        if result["run_id"] is None:
+            started_run = await _find_started_run(thread_id, not_before)
+            if started_run:
+                result["run_id"] = started_run.id
+                thread_run_tracker.mark_run_started(thread_id, started_run.id)
+                logger.info(f"Найден уже запущенный run {started_run.id} (статус '{started_run.status}') "
+                            f"для треда {thread_id}, продолжаем опросом.")
+    if result["run_id"] is None:
+        run = await openai_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=ASSISTANT_ID)
+        result["run_id"] = run.id
+        thread_run_tracker.mark_run_started(thread_id, run.id)
+        logger.info(f"Запущен новый run {run.id} для треда {thread_id}")
+    await _poll_assistant_run(thread_id, result["run_id"], result)
+
+async def run_assistant(thread_id: str, not_before: Optional[int] = None) -> Dict[str, Any]:
+    # status: completed / failed / cancelled / expired / requires_action / timeout
+    # not_before — created_at сообщения пользователя: run, созданный не раньше, отвечает на него
+    result: Dict[str, Any] = {"run_id": None, "status": None, "text": None}
+    try:
+        await asyncio.wait_for(_run_assistant_with_fallback(thread_id, result, not_before), OPENAI_RUN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"Превышено время ожидания ({OPENAI_RUN_TIMEOUT_SECONDS}s) ответа от OpenAI для run {result['run_id']}, тред {thread_id}")
+        result["status"] = "timeout"
+        if result["run_id"]:
+            await _cancel_run_quietly(thread_id, result["run_id"], "таймаут")
+        # Отмена асинхронная: перед следующим запуском проверим треды в OpenAI
+        thread_run_tracker.mark_dirty(thread_id)
+        return result
+    if result["status"] == "requires_action":
+        logger.warning(f"Run {result['run_id']} требует действия (Function Calling?), что не поддерживается.")
+        await _cancel_run_quietly(thread_id, result["run_id"], "requires_action")
+        thread_run_tracker.mark_dirty(thread_id)
+    elif result["status"] in OPENAI_TERMINAL_RUN_STATUSES:
+        thread_run_tracker.mark_run_finished(thread_id, result["run_id"])
+    return result
+
+async def _cancel_active_runs(thread_id: str):
+    try:
+        runs = await openai_client.beta.threads.runs.list(thread_id=thread_id)
+        active_runs = [run for run in runs.data if run.status in ['queued', 'in_progress', 'requires_action']]
+        if active_runs:
+            logger.warning(f"Найдены активные запуски ({len(active_runs)}) для треда {thread_id}. Отменяем...")
+            for run in active_runs:
+                try:
+                    await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                    logger.info(f"Отменен активный запуск {run.id} для треда {thread_id}")
+                except Exception as cancel_error:
+                    logger.warning(f"Не удалось отменить запуск {run.id}: {cancel_error}")
+                    return
+        thread_run_tracker.mark_runs_clean(thread_id)
+    except Exception as list_runs_error:
+        logger.warning(f"Ошибка при проверке активных запусков для треда {thread_id}: {list_runs_error}")
+
+async def _append_cached_exchange(thread_id: str, message_text: str, answer: str):
+    # Run не создается, но вопрос и ответ все равно попадают в тред, чтобы ассистент видел историю
+    if thread_run_tracker.needs_run_check(thread_id):
+        await _cancel_active_runs(thread_id)
+    await openai_client.beta.threads.messages.create(thread_id=thread_id, role="user", content=message_text)
+    await openai_client.beta.threads.messages.create(thread_id=thread_id, role="assistant", content=answer)
+
 async def chat_with_assistant(user_id: int, message_text: str) -> str:
+    started_at = time_module.monotonic()
+    try:
+        return await _chat_with_assistant(user_id, message_text)
+    finally:
+        reply_latency_samples.append(time_module.monotonic() - started_at)
+
+async def _chat_with_assistant(user_id: int, message_text: str) -> str:
     thread_id = await get_or_create_thread(user_id)
     if not thread_id:
         return "Произошла внутренняя ошибка (не удалось создать тред)."
     try:
+        answer_scope = (kb_snapshots.state_key, ASSISTANT_ID)
+        query_embedding: Optional[List[float]] = None
+        if ANSWER_CACHE_ENABLED:
+            try:
+                query_embedding = await get_query_embedding(message_text)
+            except Exception as e:
+                logger.warning(f"Кеш ответов пропущен: не удалось получить эмбеддинг запроса: {e}")
+            cached = answer_cache.lookup(query_embedding, answer_scope) if query_embedding else None
+            if cached:
+                logger.info(f"Ответ для user_id={user_id} взят из кеша (близость {cached.similarity:.3f} "
+                            f"к вопросу '{cached.question[:50]}...').")
+                await _append_cached_exchange(thread_id, message_text, cached.answer)
+                await log_context(user_id, message_text, "[ответ из кеша]", cached.answer)
+                return cached.answer
         context = ""
-        if vector_collection:
+        if kb_snapshots.current:
              context = await get_relevant_context(message_text, k=RELEVANT_CONTEXT_COUNT)
              # Исправление №3: Убрать первый вызов log_context
              # await log_context(user_id, message_text, context)
@@ -460,70 +883,42 @@ async def chat_with_assistant(user_id: int, message_text: str) -> str:
             full_prompt = f"Используй следующую информацию из базы знаний для ответа:\n--- НАЧАЛО КОНТЕКСТА ---\n{context}\n--- КОНЕЦ КОНТЕКСТА ---\n\nВопрос пользователя: {message_text}"
         else:
             logger.info(f"Контекст для запроса user_id={user_id} не найден или база знаний отключена.")
-        try:
-            runs = await openai_client.beta.threads.runs.list(thread_id=thread_id)
-            active_runs = [run for run in runs.data if run.status in ['queued', 'in_progress', 'requires_action']]
-            if active_runs:
-                logger.warning(f"Найдены активные запуски ({len(active_runs)}) для треда {thread_id}. Отменяем...")
-                for run in active_runs:
-                    try:
-                        await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                        logger.info(f"Отменен активный запуск {run.id} для треда {thread_id}")
-                    except Exception as cancel_error:
-                        logger.warning(f"Не удалось отменить запуск {run.id}: {cancel_error}")
-        except Exception as list_runs_error:
-            logger.warning(f"Ошибка при проверке активных запусков для треда {thread_id}: {list_runs_error}")
-        await openai_client.beta.threads.messages.create(
+        if thread_run_tracker.needs_run_check(thread_id):
+            await _cancel_active_runs(thread_id)
+        user_message = await openai_client.beta.threads.messages.create(
             thread_id=thread_id, role="user", content=full_prompt
         )
         logger.info(f"Сообщение добавлено в тред {thread_id} для user_id={user_id}")
-        run = await openai_client.beta.threads.runs.create(
-            thread_id=thread_id, assistant_id=ASSISTANT_ID
-        )
-        logger.info(f"Запущен новый run {run.id} для треда {thread_id}")
-        start_time = time_module.time()
-        while time_module.time() - start_time < OPENAI_RUN_TIMEOUT_SECONDS:
-            await asyncio.sleep(1)
-            run_status = await openai_client.beta.threads.runs.retrieve(
-                thread_id=thread_id, run_id=run.id
-            )
-            if run_status.status == 'completed':
-                logger.info(f"Run {run.id} успешно завершен.")
-                break
-            elif run_status.status in ['failed', 'cancelled', 'expired']:
-                error_message = f"Run {run.id} завершился со статусом '{run_status.status}'."
-                last_error = getattr(run_status, 'last_error', None)
-                if last_error: error_message += f" Ошибка: {last_error.message} (Код: {last_error.code})"
-                logger.error(error_message)
-                return "Произошла внутренняя ошибка при обработке вашего запроса (статус OpenAI)."
-            elif run_status.status == 'requires_action':
-                 logger.warning(f"Run {run.id} требует действия (Function Calling?), что не поддерживается.")
-                 await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                 return "Произошла внутренняя ошибка при обработке вашего запроса (OpenAI requires_action)."
-        else:
-            logger.warning(f"Превышено время ожидания ({OPENAI_RUN_TIMEOUT_SECONDS}s) ответа от OpenAI для run {run.id}, тред {thread_id}")
-            try:
-                await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                logger.info(f"Отменен run {run.id} из-за таймаута.")
-            except Exception as cancel_error:
-                logger.warning(f"Не удалось отменить run {run.id} после таймаута: {cancel_error}")
+        run_result = await run_assistant(thread_id, user_message.created_at)
+        run_id, run_status = run_result["run_id"], run_result["status"]
+        if run_status == 'timeout':
             return "Произошла внутренняя ошибка при обработке вашего запроса (таймаут OpenAI)."
-        messages_response = await openai_client.beta.threads.messages.list(
-            thread_id=thread_id, order="desc", limit=5
-        )
-        assistant_response_content = None
-        for msg in messages_response.data:
-            if msg.role == "assistant" and msg.run_id == run.id:
-                if msg.content and msg.content[0].type == 'text':
-                    assistant_response_content = msg.content[0].text.value
-                    logger.info(f"Получен ответ от ассистента для user_id={user_id}: {assistant_response_content[:100]}...")
-                    break
+        if run_status == 'requires_action':
+            return "Произошла внутренняя ошибка при обработке вашего запроса (OpenAI requires_action)."
+        if run_status != 'completed':
+            return "Произошла внутренняя ошибка при обработке вашего запроса (статус OpenAI)."
+        assistant_response_content = run_result.get("text")
+        if assistant_response_content:
+            logger.info(f"Получен ответ от ассистента для user_id={user_id}: {assistant_response_content[:100]}...")
+        else:
+            # Ответ не пришел в потоке (или работал опрос) — забираем его из треда
+            messages_response = await openai_client.beta.threads.messages.list(
+                thread_id=thread_id, order="desc", limit=5
+            )
+            for msg in messages_response.data:
+                if msg.role == "assistant" and msg.run_id == run_id:
+                    assistant_response_content = _extract_text_content(msg)
+                    if assistant_response_content:
+                        logger.info(f"Получен ответ от ассистента для user_id={user_id}: {assistant_response_content[:100]}...")
+                        break
         if assistant_response_content:
             # Исправление №3: log_context вызывается один раз здесь
             await log_context(user_id, message_text, context, assistant_response_content)
+            if query_embedding:
+                answer_cache.store(query_embedding, answer_scope, message_text, assistant_response_content)
             return assistant_response_content
         else:
-            logger.warning(f"Не найдено текстового ответа от ассистента в треде {thread_id} после run {run.id}. Ответы: {messages_response.data}")
+            logger.warning(f"Не найдено текстового ответа от ассистента в треде {thread_id} после run {run_id}.")
             # Исправление №4: Не возвращать ответ от другого run
             # for msg in messages_response.data:
             #      if msg.role == "assistant":
@@ -533,38 +928,89 @@ async def chat_with_assistant(user_id: int, message_text: str) -> str:
             return "К сожалению, не удалось получить ответ от ассистента в этот раз. Попробуйте позже."
     except openai.APIError as e:
          logger.error(f"OpenAI API ошибка для user_id={user_id}: {e}", exc_info=True)
+         thread_run_tracker.mark_dirty(thread_id)
          return "Произошла внутренняя ошибка (API OpenAI)."
     except Exception as e:
         logger.error(f"Непредвиденная ошибка в chat_with_assistant для user_id={user_id}: {e}", exc_info=True)
+        thread_run_tracker.mark_dirty(thread_id)
         return "Произошла внутренняя ошибка при обработке вашего запроса."
 
 # --- Vector Store Management (ChromaDB) ---
+async def get_query_embedding(query: str) -> List[float]:
+    cached = query_embedding_cache.get(query)
+    if cached is not None:
+        logger.debug(f"Эмбеддинг для запроса '{query[:50]}...' взят из кеша.")
+        return cached
+    query_embedding_response = await openai_client.embeddings.create(
+         input=[query],
+         model=EMBEDDING_MODEL,
+         dimensions=EMBEDDING_DIMENSIONS if EMBEDDING_DIMENSIONS else None
+    )
+    query_embedding = query_embedding_response.data[0].embedding
+    query_embedding_cache.put(query, query_embedding)
+    logger.debug(f"Эмбеддинг для запроса '{query[:50]}...' создан.")
+    return query_embedding
+
+async def _fetch_chunks(snapshot: KbSnapshot, ids: List[str]) -> Dict[str, Any]:
+    if not ids:
+        return {}
+    if snapshot.vector_index is not None:
+        return snapshot.vector_index.get(ids)
+    data = await asyncio.to_thread(snapshot.collection.get, ids=ids, include=["documents", "metadatas"])
+    return {chunk_id: (doc, meta or {}) for chunk_id, doc, meta in zip(data["ids"], data["documents"], data["metadatas"])}
+
+async def _fuse_with_lexical_results(query: str, vector_results: Dict[str, Any], snapshot: KbSnapshot, k: int) -> Dict[str, Any]:
+    # Результат в формате Chroma query (без distances), чтобы дальше контекст собирался как раньше
+    vector_ids = vector_results["ids"][0] if vector_results and vector_results.get("ids") else []
+    chunks = {
+        chunk_id: (doc, meta or {})
+        for chunk_id, doc, meta in zip(vector_ids, vector_results.get("documents", [[]])[0] or [],
+                                       vector_results.get("metadatas", [[]])[0] or [{}] * len(vector_ids))
+    }
+    lexical_ids = [chunk_id for chunk_id, _ in snapshot.lexical_index.search(query, limit=k * HYBRID_CANDIDATES_MULTIPLIER)]
+    fused_ids = reciprocal_rank_fusion([vector_ids, lexical_ids])[:k]
+    chunks.update(await _fetch_chunks(snapshot, [chunk_id for chunk_id in fused_ids if chunk_id not in chunks]))
+    fused_ids = [chunk_id for chunk_id in fused_ids if chunk_id in chunks]
+    logger.debug(f"Гибридный поиск для '{query[:50]}...': {len(vector_ids)} векторных и {len(lexical_ids)} лексических кандидатов.")
+    return {
+        "ids": [fused_ids],
+        "documents": [[chunks[chunk_id][0] for chunk_id in fused_ids]],
+        "metadatas": [[chunks[chunk_id][1] for chunk_id in fused_ids]],
+    }
+
 async def get_relevant_context(query: str, k: int) -> str:
-    if not vector_collection:
-        logger.warning("Запрос контекста, но ChromaDB не инициализирована.")
-        return ""
+    # Снимок БЗ удерживается до конца поиска: обновление не удалит его каталог посреди запроса
+    with kb_snapshots.reading() as snapshot:
+        if snapshot is None:
+            logger.warning("Запрос контекста, но ChromaDB не инициализирована.")
+            return ""
+        return await _get_relevant_context(snapshot, query, k)
+
+async def _get_relevant_context(snapshot: KbSnapshot, query: str, k: int) -> str:
     try:
         try:
-            query_embedding_response = await openai_client.embeddings.create(
-                 input=[query],
-                 model=EMBEDDING_MODEL,
-                 dimensions=EMBEDDING_DIMENSIONS if EMBEDDING_DIMENSIONS else None
-            )
-            query_embedding = query_embedding_response.data[0].embedding
-            logger.debug(f"Эмбеддинг для запроса '{query[:50]}...' создан.")
+            query_embedding = await get_query_embedding(query)
         except Exception as e:
             logger.error(f"Ошибка при создании эмбеддинга запроса: {e}", exc_info=True)
             return ""
         try:
-            results = await asyncio.to_thread(
-                vector_collection.query,
-                query_embeddings=[query_embedding],
-                n_results=k,
-                include=["documents", "metadatas", "distances"]
-            )
-            logger.debug(f"Поиск в ChromaDB для '{query[:50]}...' выполнен.")
+            n_candidates = k * HYBRID_CANDIDATES_MULTIPLIER if snapshot.lexical_index is not None else k
+            if snapshot.vector_index is not None:
+                # Точный поиск по матрице занимает миллисекунды — поток не нужен
+                results = snapshot.vector_index.query(query_embedding, n_results=n_candidates)
+                logger.debug(f"Поиск в индексе NumPy для '{query[:50]}...' выполнен.")
+            else:
+                results = await asyncio.to_thread(
+                    snapshot.collection.query,
+                    query_embeddings=[query_embedding],
+                    n_results=n_candidates,
+                    include=["documents", "metadatas", "distances"]
+                )
+                logger.debug(f"Поиск в ChromaDB для '{query[:50]}...' выполнен.")
+            if snapshot.lexical_index is not None:
+                results = await _fuse_with_lexical_results(query, results, snapshot, k)
         except Exception as e:
-            logger.error(f"Ошибка при выполнении поиска в ChromaDB: {e}", exc_info=True)
+            logger.error(f"Ошибка при выполнении поиска в базе знаний: {e}", exc_info=True)
             return ""
         if not results or not results.get("ids") or not results["ids"][0]:
             logger.info(f"Релевантных документов не найдено для запроса: '{query[:50]}...'")
@@ -602,13 +1048,207 @@ async def get_relevant_context(query: str, k: int) -> str:
         logger.error(f"Непредвиденная ошибка при получении контекста: {e}", exc_info=True)
         return ""
 
-async def update_vector_store():
+kb_update_lock = asyncio.Lock()
+chunk_embedding_store: Optional[ChunkEmbeddingStore] = None
+
+def _get_chunk_embedding_store() -> Optional[ChunkEmbeddingStore]:
+    # Открывается при первом обновлении БЗ, а не при импорте
+    global chunk_embedding_store
+    if chunk_embedding_store is None and CHUNK_EMBEDDING_CACHE_DIR:
+        try:
+            chunk_embedding_store = ChunkEmbeddingStore(CHUNK_EMBEDDING_CACHE_DIR, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+        except Exception as e:
+            logger.error(f"Кеш эмбеддингов чанков недоступен: {e}", exc_info=True)
+    return chunk_embedding_store
+
+async def _embed_chunks(texts: List[str], stats: EmbeddingRunStats) -> List[List[float]]:
+    # Статистика запросов к OpenAI копится в stats (chunks — сколько текстов не нашлось в кеше)
+    store = await asyncio.to_thread(_get_chunk_embedding_store)
+    embeddings: List[Optional[List[float]]] = await asyncio.to_thread(store.get_many, texts) if store else [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    logger.info(f"Эмбеддинги чанков: {len(texts) - len(missing)} из кеша, {len(missing)} запрашиваем в OpenAI.")
+    fetched, _ = await embedding_pipeline.embed([texts[i] for i in missing], stats)
+    for i, embedding in zip(missing, fetched):
+        embeddings[i] = embedding
+    return embeddings
+
+def _remember_chunk_embeddings(texts: List[str], embeddings: List[Any]):
+    store = _get_chunk_embedding_store()
+    if not store:
+        return
+    try:
+        store.put_many(texts, embeddings)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить эмбеддинги чанков в кеш: {e}", exc_info=True)
+
+def _compact_chunk_embeddings(keep_keys: set):
+    store = _get_chunk_embedding_store()
+    if not store:
+        return
+    try:
+        store.compact(keep_keys)
+        store.flush()
+    except Exception as e:
+        logger.error(f"Не удалось сжать кеш эмбеддингов чанков: {e}", exc_info=True)
+
+def _split_document_into_chunks(doc_info: Dict[str, Any]) -> Tuple[List[str], List[Dict[str, Any]]]:
+    texts: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+    doc_name, doc_content_str = doc_info['name'], doc_info['content']
+    file_meta = {"source": doc_name, "file_id": doc_info['id']}
+    if not doc_content_str or not doc_content_str.strip():
+        logger.warning(f"Документ '{doc_name}' пуст. Пропускаем.")
+        return texts, metadatas
+    RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter = _load_text_splitters()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")]) # Пример
+    MD_SECTION_MAX_LEN = 2000
+    # Исправление №5: Правильное экранирование
+    enhanced_doc_content = f"Документ: {doc_name}\n\n{doc_content_str}"
+    chunk_idx = 0
+    is_md = doc_name.lower().endswith(('.md', '.markdown'))
+    try:
+        if is_md:
+            md_splits = markdown_splitter.split_text(enhanced_doc_content)
+            for md_split in md_splits:
+                headers_meta = {k: v for k, v in md_split.metadata.items() if k.startswith('h')}
+                if len(md_split.page_content) > MD_SECTION_MAX_LEN:
+                    sub_chunks = text_splitter.split_text(md_split.page_content)
+                    for sub_chunk_text in sub_chunks:
+                        texts.append(sub_chunk_text)
+                        metadatas.append({**file_meta, **headers_meta, "type": "md_split", "chunk": chunk_idx})
+                        chunk_idx += 1
+                else:
+                    texts.append(md_split.page_content)
+                    metadatas.append({**file_meta, **headers_meta, "type": "md", "chunk": chunk_idx})
+                    chunk_idx += 1
+        else:
+            chunks = text_splitter.split_text(enhanced_doc_content)
+            for chunk_text in chunks:
+                texts.append(chunk_text)
+                metadatas.append({**file_meta, "type": "text", "chunk": chunk_idx})
+                chunk_idx += 1
+        logger.info(f"Документ '{doc_name}' разбит на {chunk_idx} чанков.")
+    except Exception as e_split:
+        logger.error(f"Ошибка при разбиении '{doc_name}': {e_split}", exc_info=True)
+        texts, metadatas = [], []
+        if is_md: # Fallback for markdown
+            try:
+                chunks = text_splitter.split_text(enhanced_doc_content)
+                chunk_idx_fb = 0 # Новый счетчик для fallback
+                for chunk_text in chunks:
+                    texts.append(chunk_text)
+                    metadatas.append({**file_meta, "type": "text_fallback", "chunk": chunk_idx_fb})
+                    chunk_idx_fb += 1
+                logger.info(f"Документ '{doc_name}' (fallback) разбит на {chunk_idx_fb} чанков.")
+            except Exception as e_fallback:
+                 logger.error(f"Ошибка fallback-разбиения '{doc_name}': {e_fallback}", exc_info=True)
+    return texts, metadatas
+
+async def update_vector_store(force_full: bool = False):
+    # Ручной /update и ночное обновление не должны собирать базу одновременно
+    if kb_update_lock.locked():
+        logger.warning("Обновление БЗ уже выполняется, повторный запуск пропущен.")
+        return {"success": False, "error": "Обновление уже выполняется", "added_chunks": 0, "total_chunks": 0}
+    async with kb_update_lock:
+        # Активная версия нужна до конца обновления: из нее переносятся чанки неизменившихся файлов
+        with kb_snapshots.reading() as source_snapshot:
+            return await _update_vector_store(force_full, source_snapshot)
+
+async def _ingest_documents(files: List[Dict[str, Any]], store_batch, manifest_files: Dict[str, Dict[str, Any]],
+                            embedding_stats: EmbeddingRunStats, known_chunk_ids: Optional[set] = None) -> int:
+    # Конвейер: скачивание -> разбор -> разбиение -> эмбеддинги -> store_batch пачками по KB_INGEST_BATCH_CHUNKS.
+    # Документы приходят по мере скачивания и разбора, их чанки уходят на эмбеддинг, пока остальные файлы
+    # еще загружаются. Чанки из known_chunk_ids уже лежат в коллекции с тем же текстом — их пропускаем.
+    # Возвращает число записанных чанков; manifest_files дополняется всеми прочитанными без ошибок файлами.
+    files_by_id = {file_item["id"]: file_item for file_item in files}
+    pending_batches: deque = deque()  # (задача эмбеддинга, ids, texts, metadatas) в порядке документов
+    batch_ids: List[str] = []
+    batch_texts: List[str] = []
+    batch_metadatas: List[Dict[str, Any]] = []
+    stored = 0
+    # Первый импорт LangChain занимает секунды — делаем его вне event loop
+    await asyncio.to_thread(_load_text_splitters)
+
+    async def _store_ready_batches(max_pending: int) -> int:
+        # Пачки пишутся в порядке отправки; ожидание здесь притормаживает чтение новых документов
+        count = 0
+        while len(pending_batches) > max_pending:
+            task, ids, texts, metadatas = pending_batches.popleft()
+            await store_batch(ids, texts, metadatas, await task)
+            count += len(ids)
+        return count
+
+    try:
+        async for doc_info in drive_reader.iter_documents(files):
+            texts, metadatas = _split_document_into_chunks(doc_info)
+            # Файл без текста тоже записывается в манифест (с пустым chunk_ids): иначе он считался бы
+            # измененным при каждой синхронизации, а его прежние чанки не удалялись бы
+            ids = [chunk_id(doc_info['id'], meta['chunk'], text) for text, meta in zip(texts, metadatas)]
+            manifest_files[doc_info['id']] = {**drive_file_fingerprint(files_by_id[doc_info['id']]), "chunk_ids": ids}
+            for new_id, text, meta in zip(ids, texts, metadatas):
+                if known_chunk_ids and new_id in known_chunk_ids:
+                    continue
+                batch_ids.append(new_id)
+                batch_texts.append(text)
+                batch_metadatas.append(meta)
+            while len(batch_texts) >= KB_INGEST_BATCH_CHUNKS:
+                size = KB_INGEST_BATCH_CHUNKS
+                task = asyncio.create_task(_embed_chunks(batch_texts[:size], embedding_stats))
+                pending_batches.append((task, batch_ids[:size], batch_texts[:size], batch_metadatas[:size]))
+                del batch_ids[:size], batch_texts[:size], batch_metadatas[:size]
+                stored += await _store_ready_batches(KB_INGEST_MAX_PENDING_BATCHES)
+        if batch_texts:
+            task = asyncio.create_task(_embed_chunks(batch_texts, embedding_stats))
+            pending_batches.append((task, batch_ids, batch_texts, batch_metadatas))
+        stored += await _store_ready_batches(0)
+    finally:
+        for task, *_ in pending_batches:
+            task.cancel()
+    if embedding_stats.chunks:
+        throughput = embedding_stats.as_dict()
+        logger.info(f"Эмбеддинги чанков: {embedding_stats.chunks} за {throughput['seconds']}с "
+                    f"в {embedding_stats.requests} запросах ({throughput['chunks_per_second']} чанков/с, "
+                    f"{throughput['tokens_per_second']} токенов/с, повторов: {embedding_stats.retries}).")
+    return stored
+
+async def _update_vector_store(force_full: bool, source_snapshot: Optional[KbSnapshot]):
     logger.info("--- Запуск обновления базы знаний ---")
-    previous_active_subpath = _get_active_db_subpath()
     os.makedirs(VECTOR_DB_BASE_PATH, exist_ok=True)
-    if not drive_service:
+    if not await asyncio.to_thread(get_shared_drive_service):
         logger.error("Обновление БЗ невозможно: сервис Google Drive не инициализирован.")
         return {"success": False, "error": "Сервис Google Drive не инициализирован", "added_chunks": 0, "total_chunks": 0}
+    try:
+        drive_files = await asyncio.to_thread(list_drive_files)
+    except Exception as e_list:
+        logger.error(f"Не удалось получить список файлов Google Drive: {e_list}", exc_info=True)
+        return {"success": False, "error": f"Drive list error: {e_list}", "added_chunks": 0, "total_chunks": 0}
+    if not drive_files:
+        logger.warning("Не найдено документов в Google Drive. Обновление прервано.")
+        return {"success": False, "error": "No documents in Google Drive", "added_chunks": 0, "total_chunks": 0}
+
+    # Сравниваем файлы Drive с манифестом активной базы: скачиваем и эмбеддим только изменившиеся
+    previous_manifest = None
+    if source_snapshot and source_snapshot.collection and not force_full:
+        previous_manifest = load_manifest(source_snapshot.path)
+    if force_full:
+        plan = KbUpdatePlan(full_rebuild=True, reason="запрошена вручную", changed=list(drive_files))
+    else:
+        plan = plan_kb_update(previous_manifest, drive_files, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+    logger.info(f"План обновления БЗ: {plan.summary()}.")
+    if plan.is_noop:
+        # Время в манифесте — последняя сверка с Drive: по нему при старте решается, нужно ли обновление
+        await asyncio.to_thread(save_manifest, source_snapshot.path, previous_manifest["files"],
+                                EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+        total = await asyncio.to_thread(source_snapshot.collection.count)
+        logger.info("--- База знаний актуальна, обновление не требуется ---")
+        return {"success": True, "unchanged": True, "added_chunks": 0, "total_chunks": total}
+    if plan.full_rebuild:
+        return await _rebuild_kb_snapshot(plan)
+    return await _update_kb_snapshot_in_place(source_snapshot, plan, previous_manifest)
+
+async def _rebuild_kb_snapshot(plan: KbUpdatePlan) -> Dict[str, Any]:
+    # Полная пересборка в новый каталог (blue/green): активная версия обслуживает запросы до переключения
     timestamp_dir_name = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + "_new"
     new_db_path = os.path.join(VECTOR_DB_BASE_PATH, timestamp_dir_name)
     logger.info(f"Создание новой временной директории для БД: {new_db_path}")
@@ -617,211 +1257,196 @@ async def update_vector_store():
     except Exception as e_mkdir:
         logger.error(f"Не удалось создать временную директорию '{new_db_path}': {e_mkdir}.", exc_info=True)
         return {"success": False, "error": f"Failed to create temp dir: {e_mkdir}", "added_chunks": 0, "total_chunks": 0}
-    
-    temp_vector_collection: Optional[chromadb.api.models.Collection.Collection] = None
+
+    temp_vector_collection: Optional[Any] = None
+    vector_writer: Optional[NumpyVectorIndexWriter] = None
     try:
+        chromadb = await asyncio.to_thread(_load_chromadb)
         temp_chroma_client = chromadb.PersistentClient(path=new_db_path)
         temp_vector_collection = temp_chroma_client.get_or_create_collection(name=VECTOR_DB_COLLECTION_NAME)
         logger.info(f"Временная коллекция '{VECTOR_DB_COLLECTION_NAME}' создана/получена в '{new_db_path}'.")
-        logger.info("Получение данных из Google Drive...")
-        documents_data = await asyncio.to_thread(read_data_from_drive)
-        if not documents_data:
-            logger.warning("Не найдено документов в Google Drive. Обновление прервано.")
-            if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
-            return {"success": False, "error": "No documents in Google Drive", "added_chunks": 0, "total_chunks": 0}
-        logger.info(f"Получено {len(documents_data)} документов из Google Drive.")
-        all_texts: List[str] = []
-        all_metadatas: List[Dict[str, Any]] = []
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")]) # Пример
-        MD_SECTION_MAX_LEN = 2000
-        for doc_info in documents_data:
-            doc_name, doc_content_str = doc_info['name'], doc_info['content']
-            if not doc_content_str or not doc_content_str.strip():
-                logger.warning(f"Документ '{doc_name}' пуст. Пропускаем.")
-                continue
-            # Исправление №5: Правильное экранирование
-            enhanced_doc_content = f"Документ: {doc_name}\n\n{doc_content_str}"
-            chunk_idx = 0
-            is_md = doc_name.lower().endswith(('.md', '.markdown'))
-            try:
-                if is_md:
-                    md_splits = markdown_splitter.split_text(enhanced_doc_content)
-                    for md_split in md_splits:
-                        headers_meta = {k: v for k, v in md_split.metadata.items() if k.startswith('h')}
-                        if len(md_split.page_content) > MD_SECTION_MAX_LEN:
-                            sub_chunks = text_splitter.split_text(md_split.page_content)
-                            for sub_chunk_text in sub_chunks:
-                                all_texts.append(sub_chunk_text)
-                                all_metadatas.append({"source": doc_name, **headers_meta, "type": "md_split", "chunk": chunk_idx})
-                                chunk_idx += 1
-                        else:
-                            all_texts.append(md_split.page_content)
-                            all_metadatas.append({"source": doc_name, **headers_meta, "type": "md", "chunk": chunk_idx})
-                            chunk_idx += 1
-                else:
-                    chunks = text_splitter.split_text(enhanced_doc_content)
-                    for chunk_text in chunks:
-                        all_texts.append(chunk_text)
-                        all_metadatas.append({"source": doc_name, "type": "text", "chunk": chunk_idx})
-                        chunk_idx += 1
-                logger.info(f"Документ '{doc_name}' разбит на {chunk_idx} чанков.")
-            except Exception as e_split:
-                logger.error(f"Ошибка при разбиении '{doc_name}': {e_split}", exc_info=True)
-                if is_md: # Fallback for markdown
-                    try:
-                        chunks = text_splitter.split_text(enhanced_doc_content)
-                        chunk_idx_fb = 0 # Новый счетчик для fallback
-                        for chunk_text in chunks:
-                            all_texts.append(chunk_text)
-                            all_metadatas.append({"source": doc_name, "type": "text_fallback", "chunk": chunk_idx_fb})
-                            chunk_idx_fb += 1
-                        logger.info(f"Документ '{doc_name}' (fallback) разбит на {chunk_idx_fb} чанков.")
-                    except Exception as e_fallback:
-                         logger.error(f"Ошибка fallback-разбиения '{doc_name}': {e_fallback}", exc_info=True)
-                continue
-        if not all_texts:
+
+        # Ничего не копится на всю базу, кроме ID чанков, манифеста и постингов BM25
+        if VECTOR_BACKEND == "numpy":
+            vector_writer = NumpyVectorIndexWriter(new_db_path, EMBEDDING_DIMENSIONS)
+        lexical_builder = LexicalIndexBuilder() if HYBRID_SEARCH_ENABLED else None
+        manifest_files: Dict[str, Dict[str, Any]] = {}
+        kept_chunk_keys: set = set()
+        embedding_stats = EmbeddingRunStats()
+
+        async def _store_batch(ids: List[str], texts: List[str], metadatas: List[Dict[str, Any]], embeddings: List[Any]):
+            await asyncio.to_thread(
+               temp_vector_collection.add, ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts
+            )
+            if vector_writer:
+                await asyncio.to_thread(vector_writer.append, ids, embeddings, texts, metadatas)
+            if lexical_builder:
+                await asyncio.to_thread(lexical_builder.add, ids, texts)
+            await asyncio.to_thread(_remember_chunk_embeddings, texts, embeddings)
+            kept_chunk_keys.update(chunk_key(text) for text in texts)
+
+        logger.info(f"Загрузка {len(plan.changed)} файлов из Google Drive...")
+        added_count = await _ingest_documents(plan.changed, _store_batch, manifest_files, embedding_stats)
+        if not added_count:
             logger.warning("Нет текстовых данных для добавления в базу. Обновление прервано.")
+            if vector_writer: vector_writer.abort()
             if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
             return {"success": False, "error": "No text data to add", "added_chunks": 0, "total_chunks": 0}
-        logger.info(f"Добавление {len(all_texts)} чанков во временную коллекцию...")
-        try:
-            all_ids = [f"{meta['source']}_{meta.get('type','unknown')}_{meta['chunk']}_{random.randint(1000,9999)}" for meta in all_metadatas]
-            logger.info(f"Создание эмбеддингов для {len(all_texts)} чанков...")
-            embeddings_response = await openai_client.embeddings.create(
-                input=all_texts, model=EMBEDDING_MODEL,
-                dimensions=EMBEDDING_DIMENSIONS if EMBEDDING_DIMENSIONS else None
-            )
-            all_embeddings = [item.embedding for item in embeddings_response.data]
-            if temp_vector_collection: # Проверка что коллекция существует
-                await asyncio.to_thread(
-                   temp_vector_collection.add,
-                   ids=all_ids, embeddings=all_embeddings, metadatas=all_metadatas, documents=all_texts
-                )
-                final_added, final_total = len(all_ids), temp_vector_collection.count()
-                logger.info(f"Успешно добавлено {final_added} чанков. Всего: {final_total}.")
-            else: # Это не должно произойти если код выше корректен
-                logger.error("temp_vector_collection не была инициализирована!")
-                return {"success": False, "error": "temp_vector_collection is None", "added_chunks": 0, "total_chunks": 0}
-
-            active_db_info_filepath = os.path.join(VECTOR_DB_BASE_PATH, ACTIVE_DB_INFO_FILE)
-            with open(active_db_info_filepath, "w", encoding="utf-8") as f: f.write(timestamp_dir_name)
-            logger.info(f"Путь к новой активной базе '{timestamp_dir_name}' сохранен.")
-            await _initialize_active_vector_collection() # Перезагружаем глобальную коллекцию
-            if not vector_collection: # Проверяем успешность перезагрузки
-                 logger.error("Критическая ошибка: не удалось перезагрузить vector_collection на новую активную базу!")
-                 return {"success": False, "error": "Failed to reload global vector_collection", "added_chunks": final_added, "total_chunks": final_total}
-            if previous_active_subpath and previous_active_subpath != timestamp_dir_name:
-                prev_path = os.path.join(VECTOR_DB_BASE_PATH, previous_active_subpath)
-                if os.path.exists(prev_path):
-                    try:
-                        shutil.rmtree(prev_path)
-                        logger.info(f"Удалена предыдущая активная директория БД: '{prev_path}'")
-                    except Exception as e_rm_old:
-                        logger.error(f"Не удалось удалить предыдущую БД '{prev_path}': {e_rm_old}", exc_info=True)
-            logger.info("--- Обновление базы знаний успешно завершено ---")
-            return {"success": True, "added_chunks": final_added, "total_chunks": final_total, "new_active_path": timestamp_dir_name}
-        except openai.APIError as e_openai:
-             logger.error(f"OpenAI API ошибка при эмбеддингах: {e_openai}", exc_info=True)
-             if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
-             return {"success": False, "error": f"OpenAI API error: {e_openai}", "added_chunks": 0, "total_chunks": 0}
-        except Exception as e_add:
-            logger.error(f"Ошибка при добавлении в ChromaDB: {e_add}", exc_info=True)
-            if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
-            return {"success": False, "error": f"ChromaDB add error: {e_add}", "added_chunks": 0, "total_chunks": 0}
+
+        final_added, final_total = added_count, await asyncio.to_thread(temp_vector_collection.count)
+        logger.info(f"Успешно добавлено {final_added} чанков. Всего: {final_total}.")
+        new_vector_index = await asyncio.to_thread(vector_writer.finish) if vector_writer else None
+        new_lexical_index = lexical_builder.build() if lexical_builder else None
+        if new_lexical_index:
+            await asyncio.to_thread(new_lexical_index.save, new_db_path)
+        await asyncio.to_thread(save_manifest, new_db_path, manifest_files, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+        await asyncio.to_thread(_compact_chunk_embeddings, kept_chunk_keys)
+
+        # Новая версия публикуется с уже открытыми клиентом и индексами — повторно с диска ничего не читаем.
+        # Предыдущая удаляется, когда закончатся запросы, которые начались до переключения.
+        await asyncio.to_thread(write_active_pointer, VECTOR_DB_BASE_PATH, ACTIVE_DB_INFO_FILE, timestamp_dir_name)
+        logger.info(f"Путь к новой активной базе '{timestamp_dir_name}' сохранен.")
+        _activate_kb_snapshot(KbSnapshot(
+            timestamp_dir_name, new_db_path, temp_chroma_client, temp_vector_collection,
+            vector_index=new_vector_index, lexical_index=new_lexical_index, file_ids=set(manifest_files),
+        ))
+        logger.info("--- Обновление базы знаний успешно завершено ---")
+        return {
+            "success": True, "added_chunks": final_added, "total_chunks": final_total,
+            "reused_chunks": 0, "embedded_chunks": embedding_stats.chunks,
+            "embedding_stats": embedding_stats.as_dict(),
+            "changed_files": len(plan.changed), "removed_files": 0, "full_rebuild": True,
+            "new_active_path": timestamp_dir_name,
+        }
+    except openai.APIError as e_openai:
+        logger.error(f"OpenAI API ошибка при эмбеддингах: {e_openai}", exc_info=True)
+        if vector_writer: vector_writer.abort()
+        if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
+        return {"success": False, "error": f"OpenAI API error: {e_openai}", "added_chunks": 0, "total_chunks": 0}
     except Exception as e_main_update:
         logger.error(f"Критическая ошибка во время обновления БЗ: {e_main_update}", exc_info=True)
+        if vector_writer: vector_writer.abort()
         if os.path.exists(new_db_path): shutil.rmtree(new_db_path)
         return {"success": False, "error": f"Critical update error: {e_main_update}", "added_chunks": 0, "total_chunks": 0}
 
-# --- Google Drive Reading ---
-# Исправление №6: Циклическая загрузка файлов
-def _download_file_content(service, file_id, export_mime_type=None):
-    if export_mime_type:
-        request = service.files().export_media(fileId=file_id, mimeType=export_mime_type)
-    else:
-        request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        if status: logger.debug(f"Загрузка файла {file_id}: {int(status.progress() * 100)}%.")
-    fh.seek(0)
-    return fh
-
-def read_data_from_drive() -> List[Dict[str,str]]:
-    if not drive_service:
-        logger.error("Чтение из Google Drive невозможно: сервис не инициализирован.")
-        return []
-    result_docs: List[Dict[str,str]] = []
+def _rebuild_indexes_from_collection(path: str, collection: Any) -> Tuple[Optional[NumpyVectorIndex], Optional[LexicalIndex], set]:
+    # Индексы NumPy и BM25 пересобираются постранично из коллекции. Файлы заменяются через os.replace,
+    # поэтому memmap предыдущего индекса у запросов, которые еще идут, остается рабочим.
+    vector_writer = NumpyVectorIndexWriter(path, EMBEDDING_DIMENSIONS) if VECTOR_BACKEND == "numpy" else None
+    lexical_builder = LexicalIndexBuilder() if HYBRID_SEARCH_ENABLED else None
+    include = ["documents", "metadatas", "embeddings"] if vector_writer else ["documents"]
+    kept_chunk_keys: set = set()
     try:
-        files_response = drive_service.files().list(
-            q=f"'{FOLDER_ID}' in parents and trashed=false",
-            fields="files(id, name, mimeType)", pageSize=1000
-        ).execute()
-        files = files_response.get('files', [])
-        logger.info(f"Найдено {len(files)} файлов в папке Google Drive.")
-        downloader_map = {
-            'application/vnd.google-apps.document': lambda s, f_id: download_google_doc(s, f_id),
-            'application/pdf': lambda s, f_id: download_pdf(s, f_id),
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': lambda s, f_id: download_docx(s, f_id),
-            'text/plain': lambda s, f_id: download_text(s, f_id),
-            'text/markdown': lambda s, f_id: download_text(s, f_id), # .md как text
-        }
-        for file_item in files:
-            file_id, mime_type, file_name = file_item['id'], file_item['mimeType'], file_item['name']
-            if mime_type in downloader_map:
-                logger.info(f"Обработка файла: '{file_name}' (ID: {file_id}, Type: {mime_type})")
-                try:
-                    content_str = downloader_map[mime_type](drive_service, file_id)
-                    if content_str and content_str.strip():
-                        result_docs.append({'name': file_name, 'content': content_str})
-                        logger.info(f"Успешно прочитан файл: '{file_name}' ({len(content_str)} симв)")
-                    else:
-                        logger.warning(f"Файл '{file_name}' пуст или не удалось извлечь контент.")
-                except Exception as e_read_file:
-                    logger.error(f"Ошибка чтения файла '{file_name}': {e_read_file}", exc_info=True)
-            else:
-                logger.debug(f"Файл '{file_name}' имеет неподдерживаемый тип ({mime_type}).")
-    except Exception as e:
-        logger.error(f"Критическая ошибка при чтении из Google Drive: {e}", exc_info=True)
-        return []
-    logger.info(f"Чтение из Google Drive завершено. Прочитано {len(result_docs)} документов.")
-    return result_docs
-
-def download_google_doc(service, file_id) -> str:
-    fh = _download_file_content(service, file_id, export_mime_type='text/plain')
-    return fh.getvalue().decode('utf-8', errors='ignore')
-
-def download_pdf(service, file_id) -> str:
-    fh = _download_file_content(service, file_id)
-    try:
-        pdf_reader = PyPDF2.PdfReader(fh)
-        return "".join(page.extract_text() + "\n" for page in pdf_reader.pages if page.extract_text())
-    except Exception as e:
-         logger.error(f"Ошибка обработки PDF (ID: {file_id}): {e}", exc_info=True)
-         return ""
+        offset = 0
+        while True:
+            page = collection.get(include=include, limit=KB_INGEST_BATCH_CHUNKS, offset=offset)
+            if not page["ids"]:
+                break
+            if vector_writer:
+                vector_writer.append(page["ids"], page["embeddings"], page["documents"], page["metadatas"])
+            if lexical_builder:
+                lexical_builder.add(page["ids"], page["documents"])
+            kept_chunk_keys.update(chunk_key(text) for text in page["documents"])
+            offset += len(page["ids"])
+    except Exception:
+        if vector_writer: vector_writer.abort()
+        raise
+    new_vector_index = vector_writer.finish() if vector_writer else None
+    new_lexical_index = lexical_builder.build() if lexical_builder else None
+    if new_lexical_index:
+        new_lexical_index.save(path)
+    return new_vector_index, new_lexical_index, kept_chunk_keys
+
+def _file_chunk_ids(collection: Any, file_id: str) -> List[str]:
+    return collection.get(where={"file_id": file_id}, include=[])["ids"]
+
+async def _update_kb_snapshot_in_place(snapshot: KbSnapshot, plan: KbUpdatePlan,
+                                       previous_manifest: Dict[str, Any]) -> Dict[str, Any]:
+    # Инкрементальное обновление прямо в активной коллекции: ID чанков детерминированы
+    # (файл, позиция, хеш текста), поэтому новые и измененные чанки пишутся через upsert. Устаревшие
+    # чанки ищутся по file_id в самой коллекции, а не в манифесте: так удаляются и чанки, записанные
+    # прошлым прогоном, который упал до сохранения манифеста. Индексы пересобираются и публикуются
+    # новой ревизией того же снимка.
+    collection = snapshot.collection
+    previous_files = previous_manifest["files"]
+    manifest_files = {file_id: entry for file_id, entry in previous_files.items() if file_id not in plan.removed}
+    # Чанки с тем же ID уже лежат в коллекции; если файл переименован, у них сменились метаданные
+    known_chunk_ids = {
+        known_id for file_item in plan.changed
+        if previous_files.get(file_item["id"], {}).get("name") == file_item["name"]
+        for known_id in previous_files[file_item["id"]]["chunk_ids"]
+    }
+    embedding_stats = EmbeddingRunStats()
+
+    async def _store_batch(ids: List[str], texts: List[str], metadatas: List[Dict[str, Any]], embeddings: List[Any]):
+        await asyncio.to_thread(collection.upsert, ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+        await asyncio.to_thread(_remember_chunk_embeddings, texts, embeddings)
 
-def download_docx(service, file_id) -> str:
-    fh = _download_file_content(service, file_id)
     try:
-        doc = docx.Document(fh)
-        return "\n".join(paragraph.text for paragraph in doc.paragraphs if paragraph.text)
-    except Exception as e:
-         logger.error(f"Ошибка обработки DOCX (ID: {file_id}): {e}", exc_info=True)
-         return ""
+        logger.info(f"Загрузка {len(plan.changed)} новых/измененных файлов из Google Drive...")
+        upserted = await _ingest_documents(plan.changed, _store_batch, manifest_files, embedding_stats, known_chunk_ids)
+        # Файлы, которые не удалось прочитать, остаются со старыми чанками и старым отпечатком —
+        # при следующей синхронизации они попадут в план снова
+        stale_ids: List[str] = []
+        for file_item in plan.changed:
+            entry = manifest_files.get(file_item["id"])
+            if entry is None or entry is previous_files.get(file_item["id"]):
+                continue
+            current_ids = set(entry["chunk_ids"])
+            stored_ids = await asyncio.to_thread(_file_chunk_ids, collection, file_item["id"])
+            stale_ids.extend(stored_id for stored_id in stored_ids if stored_id not in current_ids)
+        for file_id in plan.removed:
+            stale_ids.extend(await asyncio.to_thread(_file_chunk_ids, collection, file_id))
+        for start in range(0, len(stale_ids), KB_INGEST_BATCH_CHUNKS):
+            await asyncio.to_thread(collection.delete, ids=stale_ids[start:start + KB_INGEST_BATCH_CHUNKS])
+        deleted = len(stale_ids)
+        total = await asyncio.to_thread(collection.count)
+        logger.info(f"Обновление на месте: записано {upserted} чанков, удалено {deleted}. Всего: {total}.")
+
+        new_vector_index, new_lexical_index, kept_chunk_keys = await asyncio.to_thread(
+            _rebuild_indexes_from_collection, snapshot.path, collection
+        )
+        await asyncio.to_thread(save_manifest, snapshot.path, manifest_files, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+        await asyncio.to_thread(_compact_chunk_embeddings, kept_chunk_keys)
+        _activate_kb_snapshot(KbSnapshot(
+            snapshot.version, snapshot.path, snapshot.client, collection,
+            vector_index=new_vector_index, lexical_index=new_lexical_index, file_ids=set(manifest_files),
+            revision=snapshot.revision + 1,
+        ))
+        logger.info("--- Обновление базы знаний успешно завершено ---")
+        return {
+            "success": True, "in_place": True, "added_chunks": upserted, "deleted_chunks": deleted,
+            "total_chunks": total, "reused_chunks": total - upserted, "embedded_chunks": embedding_stats.chunks,
+            "embedding_stats": embedding_stats.as_dict(),
+            "changed_files": len(plan.changed), "removed_files": len(plan.removed), "full_rebuild": False,
+        }
+    except openai.APIError as e_openai:
+        logger.error(f"OpenAI API ошибка при эмбеддингах: {e_openai}", exc_info=True)
+        return {"success": False, "error": f"OpenAI API error: {e_openai}", "added_chunks": 0, "total_chunks": 0}
+    except Exception as e_main_update:
+        logger.error(f"Критическая ошибка во время обновления БЗ: {e_main_update}", exc_info=True)
+        return {"success": False, "error": f"Critical update error: {e_main_update}", "added_chunks": 0, "total_chunks": 0}
 
-def download_text(service, file_id) -> str:
-    fh = _download_file_content(service, file_id)
-    try:
-        return fh.getvalue().decode('utf-8')
-    except UnicodeDecodeError:
-         logger.warning(f"Не удалось декодировать {file_id} как UTF-8, пробуем cp1251.")
-         try: return fh.getvalue().decode('cp1251', errors='ignore')
-         except Exception as e:
-              logger.error(f"Не удалось декодировать {file_id}: {e}")
-              return ""
+# --- Google Drive Reading ---
+def list_drive_files() -> List[Dict[str, Any]]:
+    # Только поддерживаемые типы; modifiedTime/md5Checksum/version нужны для инкрементального обновления
+    files: List[Dict[str, Any]] = []
+    page_token = None
+    while True:
+        files_response = get_shared_drive_service().files().list(
+            q=f"'{FOLDER_ID}' in parents and trashed=false",
+            fields=f"nextPageToken, files({DRIVE_FILE_FIELDS})", pageSize=1000, pageToken=page_token
+        ).execute()
+        for file_item in files_response.get('files', []):
+            if file_item['mimeType'] in DOCUMENT_PARSERS:
+                files.append(file_item)
+            else:
+                logger.debug(f"Файл '{file_item['name']}' имеет неподдерживаемый тип ({file_item['mimeType']}).")
+        page_token = files_response.get('nextPageToken')
+        if not page_token:
+            break
+    logger.info(f"Найдено {len(files)} поддерживаемых файлов в папке Google Drive.")
+    return files
 
 # --- History and Context Management ---
 async def log_context(user_id: int, message_text: str, context: str, response_text: Optional[str]=None):
@@ -858,6 +1483,12 @@ async def cleanup_old_context_logs():
     except Exception as e:
         logger.error(f"Критическая ошибка при очистке логов контекста: {e}", exc_info=True)
 
+# --- Bounded In-Memory State ---
+def sweep_bounded_state():
+    evicted = user_processing_locks.sweep() + thread_run_tracker.sweep() + state_store.sweep_caches()
+    stats = [user_processing_locks.stats(), thread_run_tracker.stats(), *state_store.cache_stats()]
+    logger.info(f"Очистка кешей в памяти: вытеснено {evicted} записей по TTL. Состояние: {stats}")
+
 # --- Background Cleanup Task ---
 last_auto_update_date: Optional[datetime.date] = None
 
@@ -868,18 +1499,31 @@ async def background_cleanup_task():
         logger.info("Запуск периодической фоновой задачи...")
         try:
             now_local = datetime.datetime.now(TARGET_TZ)
-            if now_local.hour == 4 and (last_auto_update_date is None or last_auto_update_date < now_local.date()):
+            # При включенном DRIVE_SYNC_ENABLED правки подхватывает наблюдатель Drive
+            if not DRIVE_SYNC_ENABLED and now_local.hour == 4 and (last_auto_update_date is None or last_auto_update_date < now_local.date()):
                 logger.info(f"Время для ежедневного обновления БЗ ({now_local.hour}:00). Запускаем...")
                 await run_update_and_notify_admin(ADMIN_USER_ID)
                 last_auto_update_date = now_local.date()
         except Exception as e_auto_update:
             logger.error(f"Ошибка в логике ежедневного обновления БЗ: {e_auto_update}", exc_info=True)
         await cleanup_old_context_logs()
+        state_store.prune_cooldowns(time_module.time() - MESSAGE_COOLDOWN_SECONDS)
+        state_store.prune_own_messages(time_module.time() - OWN_MESSAGE_TTL_SECONDS)
+        sweep_bounded_state()
+        if vk_sender:
+            logger.info(f"Статистика исходящей очереди VK: {vk_sender.stats()}")
+        logger.info(f"Задержка ответа ассистента: {reply_latency_stats()}")
+        query_embedding_cache.flush()
+        logger.info(f"Кеш эмбеддингов запросов: {query_embedding_cache.stats()}")
+        if ANSWER_CACHE_ENABLED:
+            logger.info(f"Кеш ответов: {answer_cache.stats()}")
+        if drive_watcher:
+            logger.info(f"Наблюдатель Google Drive: {drive_watcher.stats()}")
+        logger.info(f"Разбор документов: {document_parser.stats()}")
         logger.info("Периодическая фоновая задача завершила цикл.")
 
 # --- Main Event Handler ---
 async def handle_new_message(event: VkBotEvent):
-    # global user_threads # user_threads и так глобальная
     try:
         if event.object.message and event.object.message.get('from_id') and event.object.message.get('from_id') > 0 : # Сообщение от пользователя
             user_id = event.object.message['from_id']
@@ -889,22 +1533,25 @@ async def handle_new_message(event: VkBotEvent):
                  logger.info(f"Пустое сообщение от user_id={user_id}. Игнорируем.")
                  return
 
-            if message_text.lower() == "/update" and user_id == ADMIN_USER_ID:
-                logger.info(f"Администратор {user_id} инициировал обновление БЗ.")
+            if message_text.lower() in ("/update", "/update full") and user_id == ADMIN_USER_ID:
+                force_full = message_text.lower() == "/update full"
+                logger.info(f"Администратор {user_id} инициировал обновление БЗ (полное: {force_full}).")
                 await send_vk_message(peer_id, "🔄 Запускаю обновление базы знаний...")
-                asyncio.create_task(run_update_and_notify_admin(peer_id)) 
+                asyncio.create_task(run_update_and_notify_admin(peer_id, force_full=force_full))
                 return
             
             if message_text.lower() == "/reset":
                 user_key = get_user_key(user_id)
                 log_prefix = f"handle_new_message(reset for peer:{peer_id}, user:{user_id}):"
                 logger.info(f"{log_prefix} Получена команда сброса диалога.") # logger вместо logging
-                if peer_id in pending_messages: del pending_messages[peer_id]
+                state_store.pop_pending(peer_id)
+                state_store.clear_buffer_timer(peer_id)
                 if peer_id in user_message_timers:
                     old_timer = user_message_timers.pop(peer_id)
                     if not old_timer.done(): old_timer.cancel()
-                thread_id_to_forget = user_threads.pop(user_key, None)
-                if thread_id_to_forget: logger.info(f"{log_prefix} Тред {thread_id_to_forget} удален из памяти.") # logger вместо logging
+                thread_id_to_forget = await state_store.reset_thread(user_key)
+                if thread_id_to_forget: thread_run_tracker.forget(thread_id_to_forget)
+                if thread_id_to_forget: logger.info(f"{log_prefix} Тред {thread_id_to_forget} удален из хранилища.") # logger вместо logging
                 await send_vk_message(peer_id, "🔄 Диалог сброшен.")
                 return
             
@@ -915,10 +1562,9 @@ async def handle_new_message(event: VkBotEvent):
                 for task in list(user_message_timers.values()): # Итерируемся по копии
                     if not task.done(): task.cancel()
                 user_message_timers.clear()
-                pending_count = len(pending_messages)
-                pending_messages.clear()
-                threads_count = len(user_threads)
-                user_threads.clear()
+                reset_counts = await state_store.reset_all()
+                pending_count, threads_count = reset_counts["pending"], reset_counts["threads"]
+                thread_run_tracker.clear()
                 await send_vk_message(peer_id, f"🔄 СБРОС ВСЕХ ДИАЛОГОВ ВЫПОЛНЕН.\n- Таймеров: {active_timer_count}\n- Буферов: {pending_count}\n- Тредов: {threads_count}")
                 return
 
@@ -930,20 +1576,20 @@ async def handle_new_message(event: VkBotEvent):
                     await send_vk_message(peer_id, "🤖 Режим молчания снят. Бот снова активен.")
                     return
 
-            if chat_silence_state.get(peer_id, False):
+            if await state_store.is_silenced(peer_id):
                 logger.info(f"Бот в режиме молчания для peer_id={peer_id} (CRM). Сообщение от user_id={user_id} игнорируется.")
                 return
 
-            now_dt = datetime.datetime.now()
-            last_time = user_last_message_time.get(user_id)
-            if last_time and now_dt - last_time < datetime.timedelta(seconds=MESSAGE_COOLDOWN_SECONDS):
+            now_ts = time_module.time()
+            last_time = await state_store.get_last_message_time(user_id)
+            if last_time and now_ts - last_time < MESSAGE_COOLDOWN_SECONDS:
                 logger.warning(f"Кулдаун для user_id={user_id}. Игнорируем.")
                 return
-            user_last_message_time[user_id] = now_dt
+            state_store.set_last_message_time(user_id, now_ts)
 
             logger.info(f"Получено сообщение от user_id={user_id} (peer_id={peer_id}): '{message_text[:100]}...'")
-            pending_messages.setdefault(peer_id, []).append(message_text)
-            logger.debug(f"Сообщение от peer_id={peer_id} добавлено в буфер: {pending_messages[peer_id]}")
+            state_store.append_pending(peer_id, user_id, message_text)
+            logger.debug(f"Сообщение от peer_id={peer_id} добавлено в буфер: {state_store.pending_messages(peer_id)}")
             if peer_id in user_message_timers:
                 old_timer = user_message_timers.pop(peer_id)
                 if not old_timer.done():
@@ -952,6 +1598,7 @@ async def handle_new_message(event: VkBotEvent):
             logger.debug(f"Запуск таймера буферизации для peer_id={peer_id} ({MESSAGE_BUFFER_SECONDS} сек).")
             new_timer_task = asyncio.create_task(schedule_buffered_processing(peer_id, user_id))
             user_message_timers[peer_id] = new_timer_task
+            state_store.set_buffer_timer(peer_id, user_id, now_ts + MESSAGE_BUFFER_SECONDS)
         
         # elif event.from_chat: # Убрано, так как from_user/from_chat теперь через event.object.message.from_id
         #     # Логика для чатов, если from_id < 0 (от сообщества) или если это чат (peer_id > 2_000_000_000)
@@ -963,140 +1610,292 @@ async def handle_new_message(event: VkBotEvent):
         logger.error(f"Критическая ошибка в handle_new_message: {e}", exc_info=True)
 
 # --- Main Application Logic ---
-async def run_update_and_notify_admin(notification_peer_id: int):
-    logger.info(f"run_update_and_notify_admin: Запуск обновления БЗ для peer_id={notification_peer_id}")
+async def sync_knowledge_base_from_drive(changes: List[Dict[str, Any]]) -> bool:
+    # Вызывается наблюдателем Drive: что именно пересчитать, решает сверка с манифестом
     update_result = await update_vector_store()
+    if update_result.get("success") and not update_result.get("unchanged"):
+        await notify_admin_about_update(ADMIN_USER_ID, update_result)
+    return bool(update_result.get("success"))
+
+async def run_update_and_notify_admin(notification_peer_id: int, force_full: bool = False):
+    logger.info(f"run_update_and_notify_admin: Запуск обновления БЗ для peer_id={notification_peer_id}")
+    update_result = await update_vector_store(force_full=force_full)
+    await notify_admin_about_update(notification_peer_id, update_result)
+
+async def notify_admin_about_update(notification_peer_id: int, update_result: Dict[str, Any]):
     current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     admin_message = f"🔔 Отчет об обновлении БЗ ({current_time_str}):\n"
-    if update_result.get("success"):
-        admin_message += (f"✅ Успешно!\n➕ Добавлено: {update_result.get('added_chunks', 'N/A')}\n"
+    if update_result.get("success") and update_result.get("unchanged"):
+        admin_message += (f"✅ Изменений в Google Drive нет, база актуальна.\n"
                           f"📊 Всего: {update_result.get('total_chunks', 'N/A')}\n")
+    elif update_result.get("success"):
+        admin_message += (f"✅ Успешно{' (полная пересборка)' if update_result.get('full_rebuild') else ''}!\n"
+                          f"➕ Добавлено: {update_result.get('added_chunks', 'N/A')}\n"
+                          f"♻️ Без изменений: {update_result.get('reused_chunks', 0)}\n"
+                          f"{'🗑 Удалено чанков: ' + str(update_result['deleted_chunks']) + chr(10) if update_result.get('deleted_chunks') else ''}"
+                          f"🧮 Запрошено эмбеддингов: {update_result.get('embedded_chunks', 0)}\n"
+                          f"📝 Изменено файлов: {update_result.get('changed_files', 0)}, "
+                          f"удалено: {update_result.get('removed_files', 0)}\n"
+                          f"📊 Всего: {update_result.get('total_chunks', 'N/A')}\n")
+        embedding_stats = update_result.get("embedding_stats") or {}
+        if embedding_stats.get("chunks"):
+            admin_message += (f"⚡ Эмбеддинги: {embedding_stats['seconds']}с, {embedding_stats['requests']} запросов, "
+                              f"{embedding_stats['chunks_per_second']} чанков/с, "
+                              f"{embedding_stats['tokens_per_second']} токенов/с"
+                              f"{', повторов: ' + str(embedding_stats['retries']) if embedding_stats.get('retries') else ''}\n")
         if update_result.get("new_active_path"): admin_message += f"📁 Путь: {update_result['new_active_path']}"
     else:
         admin_message += f"❌ Ошибка: {update_result.get('error', 'N/A')}\nБаза могла не измениться."
     logger.info(f"Результат обновления БЗ: {admin_message}")
     try:
-        await send_vk_message(notification_peer_id, admin_message)
+        notifications = [send_vk_message(notification_peer_id, admin_message)]
         # Исправление №8: Упрощение условия
         if ADMIN_USER_ID > 0 and notification_peer_id != ADMIN_USER_ID:
-            await send_vk_message(ADMIN_USER_ID, "[Авто] " + admin_message)
+            notifications.append(send_vk_message(ADMIN_USER_ID, "[Авто] " + admin_message))
+        # Отправляем одновременно, чтобы очередь VK могла объединить их в один execute
+        await asyncio.gather(*notifications)
     except Exception as e_notify:
         logger.error(f"Не удалось отправить уведомление админу: {e_notify}", exc_info=True)
 
+async def _save_drive_page_token(token: str):
+    await state_store.set_value(DRIVE_PAGE_TOKEN_KEY, token)
+
+async def notify_admin_about_startup(kb_update_needed: bool, kb_decision: str):
+    admin_message = (f"🚀 Бот запущен за {startup_timings.total:.1f}с.\n"
+                     f"📚 База знаний: {kb_decision}.\n"
+                     f"{'🔄 Запущено обновление БЗ.' if kb_update_needed else '✅ Обновление при старте не требуется.'}")
+    try:
+        if ADMIN_USER_ID > 0:
+            await send_vk_message(ADMIN_USER_ID, admin_message)
+    except Exception as e_notify:
+        logger.error(f"Не удалось отправить уведомление админу о запуске: {e_notify}", exc_info=True)
+
+async def run_drive_watcher(update_first: bool = False):
+    # Сервис Drive собирается уже после старта приема сообщений: discovery и импорт googleapiclient
+    # не задерживают ответы пользователям
+    global drive_watcher
+    if update_first:
+        # Сохраненный page token покрывает только правки в Drive, а не отсутствующую или устаревшую базу
+        await run_update_and_notify_admin(ADMIN_USER_ID)
+    drive_watcher_service = await asyncio.to_thread(get_drive_service)
+    if not drive_watcher_service:
+        logger.warning("Наблюдатель Google Drive не запущен: нет сервиса Google Drive.")
+        return
+    # Отдельный клиент Drive: httplib2 не потокобезопасен, а обновление БЗ идет в другом потоке.
+    # Первый опрос сам сверит папку с базой (в том числе правки, сделанные пока бот был выключен).
+    drive_watcher = DriveChangesWatcher(
+        drive_watcher_service, FOLDER_ID,
+        load_token=lambda: state_store.get_value(DRIVE_PAGE_TOKEN_KEY),
+        save_token=_save_drive_page_token,
+        on_changes=sync_knowledge_base_from_drive,
+        is_tracked=lambda file_id: file_id in kb_snapshots.file_ids,
+        interval=DRIVE_SYNC_INTERVAL_SECONDS,
+    )
+    logger.info(f"Наблюдатель Google Drive запущен (опрос раз в {DRIVE_SYNC_INTERVAL_SECONDS}с).")
+    await drive_watcher.run()
+
 async def main():
+    global vk_http_session, vk_client, vk_sender
     logger.info("--- Запуск VK бота ---")
     
     # Исправление №11: Инициализация переменных
     cleanup_task: Optional[asyncio.Task] = None
     listen_task: Optional[asyncio.Task] = None
-
-    await load_silence_state_from_file()
+    drive_sync_task: Optional[asyncio.Task] = None
+
+    vk_http_session = create_vk_http_session(pool_size=VK_HTTP_POOL_SIZE)
+    vk_client = AsyncVkApi(vk_http_session, VK_GROUP_TOKEN, VK_API_VERSION, timeout=VK_API_TIMEOUT_SECONDS)
+    logger.info("Асинхронный клиент VK API инициализирован.")
+    vk_sender = VkOutboundScheduler(
+        vk_client,
+        rate_per_second=VK_RATE_LIMIT_PER_SECOND,
+        max_queue_size=VK_SEND_QUEUE_SIZE,
+        max_retries=VK_SEND_MAX_RETRIES,
+        batch_linger=VK_BATCH_LINGER_MS / 1000,
+    )
+    vk_sender.start()
+    logger.info(f"Очередь исходящих запросов VK запущена ({VK_RATE_LIMIT_PER_SECOND} запр/с).")
+    startup_timings.mark("vk_client")
+    await state_store.open()
+    await migrate_silence_state_file()
+    restore_buffered_messages()
+    startup_timings.mark("state_store")
     await _initialize_active_vector_collection()
-    logger.info("Запуск фонового обновления БЗ при старте...")
-    asyncio.create_task(run_update_and_notify_admin(ADMIN_USER_ID))
+    startup_timings.mark("knowledge_base")
+    kb_update_needed, kb_decision = await asyncio.to_thread(_startup_kb_decision)
+    if kb_update_needed:
+        logger.info(f"Обновление БЗ при старте: {kb_decision}. Запускаем в фоне, пока отвечаем по текущей базе.")
+    else:
+        logger.info(f"Обновление БЗ при старте пропущено: {kb_decision}.")
+    if DRIVE_SYNC_ENABLED:
+        drive_sync_task = asyncio.create_task(run_drive_watcher(update_first=kb_update_needed), name="DriveChangesWatcher")
+    elif kb_update_needed:
+        asyncio.create_task(run_update_and_notify_admin(ADMIN_USER_ID))
     cleanup_task = asyncio.create_task(background_cleanup_task())
     logger.info("Фоновая задача очистки запущена.")
-    logger.warning("Используется СИНХРОННЫЙ VkBotLongPoll. Это БЛОКИРУЕТ асинхронный цикл.")
     
     try:
-        loop = asyncio.get_running_loop()
-        listen_task = asyncio.create_task(asyncio.to_thread(run_longpoll_sync, loop), name="VKLongPollListener")
+        if VK_INGRESS_MODE == "callback":
+            listen_task = asyncio.create_task(run_callback_ingress(), name="VKCallbackServer")
+        else:
+            listen_task = asyncio.create_task(run_longpoll(), name="VKLongPollListener")
+        startup_timings.mark("background_tasks")
+        logger.info(f"Запуск бота занял {startup_timings.summary()}.")
+        asyncio.create_task(notify_admin_about_startup(kb_update_needed, kb_decision))
         if listen_task: await listen_task # Ждем завершения задачи
-    except vk_api.exceptions.ApiError as e:
-        logger.critical(f"Критическая ошибка VK API в Long Poll: {e}", exc_info=True)
     except Exception as e:
          logger.critical(f"Критическая ошибка в главном цикле: {e}", exc_info=True)
     finally:
         logger.info("Завершение работы фоновых задач...")
         if cleanup_task and not cleanup_task.done():
             cleanup_task.cancel()
+        if drive_sync_task and not drive_sync_task.done():
+            drive_sync_task.cancel()
         if listen_task and not listen_task.done():
              listen_task.cancel()
-             logger.warning("Запрошена отмена задачи Long Poll.")
+             logger.warning(f"Запрошена отмена задачи приема событий VK ({VK_INGRESS_MODE}).")
         
         tasks_to_gather = []
         if cleanup_task: tasks_to_gather.append(cleanup_task)
+        if drive_sync_task: tasks_to_gather.append(drive_sync_task)
         if listen_task: tasks_to_gather.append(listen_task)
         
         if tasks_to_gather:
             await asyncio.gather(*tasks_to_gather, return_exceptions=True)
+
+        if vk_sender:
+            await vk_sender.stop()
+        drive_reader.close()
+        await kb_snapshots.aclose()
+        document_parser.close()
+        query_embedding_cache.flush()
+        try:
+            await state_store.close()
+        except Exception as e_store:
+            logger.error(f"Ошибка при закрытии хранилища состояния: {e_store}", exc_info=True)
+        if vk_http_session and not vk_http_session.closed:
+            await vk_http_session.close()
         
         logger.info("--- Бот остановлен ---")
 
-def run_longpoll_sync(async_loop: asyncio.AbstractEventLoop):
-    logger.info("Запуск синхронного Long Poll в отдельном потоке...")
+# --- VK Events Ingress ---
+_VK_MESSAGE_EVENT_TYPES = {
+    VkBotEventType.MESSAGE_NEW.value,
+    VkBotEventType.MESSAGE_REPLY.value,
+    VkBotEventType.MESSAGE_EDIT.value,
+}
+
+def build_vk_event(raw_event: Dict[str, Any]) -> VkBotEvent:
+    # Те же классы событий, что создавал VkBotLongPoll, чтобы обработчики не менялись
+    if raw_event.get('type') in _VK_MESSAGE_EVENT_TYPES:
+        return VkBotMessageEvent(raw_event)
+    return VkBotEvent(raw_event)
+
+async def handle_message_reply(event: VkBotEvent):
+    logger.debug(f"Получено MESSAGE_REPLY: {event.object}") # event.object вместо event.obj
+    try:
+        # VK_GROUP_ID уже int
+        is_outgoing_from_group = (event.object.get('out') == 1 and 
+                                  event.object.get('from_id') == -VK_GROUP_ID)
+        
+        if is_outgoing_from_group:
+            event_random_id = event.object.get('random_id')
+            peer_id = event.object.get('peer_id')
+            # admin_author_id есть только у сообщений, написанных администратором сообщества в VK;
+            # ответы бота и CRM уходят через API без него, их различаем по random_id из state_store
+            is_own_message = (not event.object.get('admin_author_id') and event_random_id and peer_id
+                              and await state_store.pop_own_message(peer_id, event_random_id))
+
+            if is_own_message:
+                logger.debug(f"MESSAGE_REPLY от бота (random_id: {event_random_id}) для peer_id={peer_id}. Удален.")
+            else:
+                crm_message_text = event.object.get('text', '') 
+                logger.info(f"MESSAGE_REPLY от CRM/оператора (текст: '{crm_message_text[:50]}...', random_id: {event_random_id}) для peer_id={peer_id}. Активируем ПОСТОЯННЫЙ режим молчания.")
+                if peer_id:
+                    await silence_user(peer_id)
+                else:
+                    logger.warning(f"Не удалось определить peer_id из MESSAGE_REPLY для CRM: {event.object}")
+        else:
+             logger.debug(f"Пропускаем MESSAGE_REPLY (не от нашей группы или не исходящее): {event.object}")
+    except Exception as e_reply_proc:
+        logger.error(f"Ошибка при обработке MESSAGE_REPLY: {e_reply_proc}", exc_info=True)
+        logger.debug(f"Ошибочный MESSAGE_REPLY: {event.object}")
+
+async def dispatch_vk_event(event: VkBotEvent):
+    if event.type == VkBotEventType.MESSAGE_NEW:
+        # Обработка сообщения не должна задерживать получение следующих событий
+        asyncio.create_task(handle_new_message(event))
+    elif event.type == VkBotEventType.MESSAGE_REPLY:
+        await handle_message_reply(event)
+    else:
+        logger.debug(f"Пропускаем событие типа {event.type}")
+
+async def handle_raw_vk_event(raw_event: Dict[str, Any]):
+    await dispatch_vk_event(build_vk_event(raw_event))
+
+async def run_callback_ingress():
+    logger.info(f"Запуск приема событий через Callback API на {VK_CALLBACK_HOST}:{VK_CALLBACK_PORT}{VK_CALLBACK_PATH}...")
+    if not VK_CALLBACK_SECRET:
+        logger.warning("VK_CALLBACK_SECRET не задан: подлинность событий Callback API не проверяется.")
+    app = create_callback_app(
+        handle_raw_vk_event,
+        group_id=VK_GROUP_ID,
+        confirmation_code=VK_CALLBACK_CONFIRMATION_CODE,
+        secret_key=VK_CALLBACK_SECRET,
+        path=VK_CALLBACK_PATH,
+    )
+    await run_callback_server(app, VK_CALLBACK_HOST, VK_CALLBACK_PORT)
+
+async def run_longpoll():
+    logger.info("Запуск асинхронного Long Poll...")
     MAX_RECONNECT_ATTEMPTS, RECONNECT_DELAY_SECONDS = 5, 30
     current_attempts = 0
-    # global vk_session_api, VK_GROUP_ID # Они и так доступны как глобальные
     
     while True:
         try:
-            if not vk_session_api:
-                logger.error("[Thread LongPoll] vk_session_api не инициализирована.")
-                time_module.sleep(RECONNECT_DELAY_SECONDS * 5)
+            if not vk_client or vk_client.session.closed:
+                logger.error("[LongPoll] Клиент VK API не инициализирован.")
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS * 5)
                 continue
 
-            logger.info(f"[Thread LongPoll] Инициализация VkBotLongPoll (попытка {current_attempts + 1}).")
-            # VK_GROUP_ID уже int
-            current_longpoll = VkBotLongPoll(vk_session_api, VK_GROUP_ID)
-            logger.info("[Thread LongPoll] VkBotLongPoll инициализирован.")
+            logger.info(f"[LongPoll] Инициализация Long Poll (попытка {current_attempts + 1}).")
+            longpoll = AsyncVkBotLongPoll(vk_client, VK_GROUP_ID, wait=VK_LONGPOLL_WAIT_SECONDS)
+            await longpoll.update_longpoll_server()
+            logger.info("[LongPoll] Long Poll сервер получен.")
             current_attempts = 0
-            logger.info("[Thread LongPoll] Начало прослушивания событий...")
-            for event in current_longpoll.listen():
-                if event.type == VkBotEventType.MESSAGE_NEW:
-                    asyncio.run_coroutine_threadsafe(handle_new_message(event), async_loop)
-                elif event.type == VkBotEventType.MESSAGE_REPLY:
-                    logger.debug(f"Получено MESSAGE_REPLY: {event.object}") # event.object вместо event.obj
-                    try:
-                        # VK_GROUP_ID уже int
-                        is_outgoing_from_group = (event.object.get('out') == 1 and 
-                                                  event.object.get('from_id') == -VK_GROUP_ID)
-                        
-                        if is_outgoing_from_group:
-                            event_random_id = event.object.get('random_id')
-                            peer_id = event.object.get('peer_id')
-
-                            if event_random_id is not None and event_random_id in MY_PENDING_RANDOM_IDS:
-                                MY_PENDING_RANDOM_IDS.remove(event_random_id)
-                                logger.debug(f"MESSAGE_REPLY от бота (random_id: {event_random_id}) для peer_id={peer_id}. Удален.")
-                            else:
-                                crm_message_text = event.object.get('text', '') 
-                                logger.info(f"MESSAGE_REPLY от CRM/оператора (текст: '{crm_message_text[:50]}...', random_id: {event_random_id}) для peer_id={peer_id}. Активируем ПОСТОЯННЫЙ режим молчания.")
-                                if peer_id:
-                                    asyncio.run_coroutine_threadsafe(silence_user(peer_id), async_loop)
-                                else:
-                                    logger.warning(f"Не удалось определить peer_id из MESSAGE_REPLY для CRM: {event.object}")
-                        else:
-                             logger.debug(f"Пропускаем MESSAGE_REPLY (не от нашей группы или не исходящее): {event.object}")
-                    except Exception as e_reply_proc:
-                        logger.error(f"Ошибка при обработке MESSAGE_REPLY: {e_reply_proc}", exc_info=True)
-                        logger.debug(f"Ошибочный MESSAGE_REPLY: {event.object}")
-                else:
-                    logger.debug(f"Пропускаем событие типа {event.type}")
-            logger.warning("[Thread LongPoll] Цикл listen() завершился. Перезапуск...")
-            current_attempts = 0
-            time_module.sleep(RECONNECT_DELAY_SECONDS)
-        except (requests.exceptions.RequestException, vk_api.exceptions.VkApiError) as e_net:
-            logger.error(f"[Thread LongPoll] Ошибка сети/VK API: {e_net}", exc_info=True)
+            logger.info("[LongPoll] Начало прослушивания событий...")
+            async for raw_event in longpoll.listen():
+                try:
+                    await handle_raw_vk_event(raw_event)
+                except Exception as e_dispatch:
+                    logger.error(f"[LongPoll] Ошибка при обработке события {raw_event.get('type')}: {e_dispatch}", exc_info=True)
+        except asyncio.CancelledError:
+            logger.info("[LongPoll] Задача Long Poll отменена.")
+            raise
+        except VkAuthError as e_auth:
+            logger.critical(f"[LongPoll] Ошибка авторизации VK: {e_auth}. Проверьте токен группы.", exc_info=True)
+            break
+        except (VkTransportError, VkApiError, VkLongPollError) as e_net:
+            logger.error(f"[LongPoll] Ошибка сети/VK API: {e_net}", exc_info=True)
             current_attempts += 1
             if MAX_RECONNECT_ATTEMPTS > 0 and current_attempts >= MAX_RECONNECT_ATTEMPTS:
-                logger.critical(f"[Thread LongPoll] Превышено макс. попыток переподключения. Остановка.")
+                logger.critical(f"[LongPoll] Превышено макс. попыток переподключения. Остановка.")
                 if ADMIN_USER_ID > 0: # Отправляем админу только если ID валидный
-                    asyncio.run_coroutine_threadsafe(send_vk_message(ADMIN_USER_ID, "Критическая ошибка: VK Long Poll остановлен."), async_loop)
+                    await send_vk_message(ADMIN_USER_ID, "Критическая ошибка: VK Long Poll остановлен.")
                 break
-            logger.info(f"[Thread LongPoll] Пауза {RECONNECT_DELAY_SECONDS}с перед попыткой {current_attempts + 1}...")
-            time_module.sleep(RECONNECT_DELAY_SECONDS)
+            logger.info(f"[LongPoll] Пауза {RECONNECT_DELAY_SECONDS}с перед попыткой {current_attempts + 1}...")
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
         except Exception as e_fatal:
-            logger.critical(f"[Thread LongPoll] Непредвиденная критическая ошибка: {e_fatal}", exc_info=True)
+            logger.critical(f"[LongPoll] Непредвиденная критическая ошибка: {e_fatal}", exc_info=True)
             current_attempts += 1
             if MAX_RECONNECT_ATTEMPTS > 0 and current_attempts >= MAX_RECONNECT_ATTEMPTS:
-                 logger.critical(f"[Thread LongPoll] Превышено макс. попыток после непредвиденной ошибки. Остановка.")
+                 logger.critical(f"[LongPoll] Превышено макс. попыток после непредвиденной ошибки. Остановка.")
                  if ADMIN_USER_ID > 0:
-                     asyncio.run_coroutine_threadsafe(send_vk_message(ADMIN_USER_ID, "Критическая ошибка: VK Long Poll остановлен (непредвиденная ошибка)."), async_loop)
+                     await send_vk_message(ADMIN_USER_ID, "Критическая ошибка: VK Long Poll остановлен (непредвиденная ошибка).")
                  break
-            logger.info(f"[Thread LongPoll] Пауза {RECONNECT_DELAY_SECONDS * 2}с перед попыткой {current_attempts + 1}...")
-            time_module.sleep(RECONNECT_DELAY_SECONDS * 2)
-    logger.info("[Thread LongPoll] Поток Long Poll завершен.")
+            logger.info(f"[LongPoll] Пауза {RECONNECT_DELAY_SECONDS * 2}с перед попыткой {current_attempts + 1}...")
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS * 2)
+    logger.info("[LongPoll] Long Poll завершен.")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    # Словарь с ограничением по размеру (LRU) и времени жизни записи (TTL, продлевается при обращении).
+    # can_evict позволяет запретить вытеснение записей, которые еще используются
+    # (например, занятых asyncio.Lock). default_factory работает как у defaultdict.
+    def __init__(self, maxsize: int, ttl: float, default_factory: Optional[Callable[[], V]] = None,
+                 can_evict: Optional[Callable[[K, V], bool]] = None, name: str = ""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._default_factory = default_factory
+        self._can_evict = can_evict
+        self._data: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+
+    def _evictable(self, key: K, value: V) -> bool:
+        return self._can_evict is None or self._can_evict(key, value)
+
+    def _expire_if_needed(self, key: K, item: Tuple[V, float], now: float) -> bool:
+        if item[1] <= now and self._evictable(key, item[0]):
+            del self._data[key]
+            self.evicted_ttl += 1
+            return True
+        return False
+
+    def get(self, key: K, default: Any = None) -> Any:
+        item = self._data.get(key)
+        now = time.monotonic()
+        if item is None or self._expire_if_needed(key, item, now):
+            self.misses += 1
+            return default
+        self._data[key] = (item[0], now + self.ttl)
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def __getitem__(self, key: K) -> V:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if self._default_factory is None:
+                raise KeyError(key)
+            value = self._default_factory()
+            self[key] = value
+        return value
+
+    def __setitem__(self, key: K, value: V):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._enforce_size()
+
+    def __contains__(self, key: object) -> bool:
+        item = self._data.get(key)  # type: ignore[arg-type]
+        return item is not None and not self._expire_if_needed(key, item, time.monotonic())  # type: ignore[arg-type]
+
+    def __delitem__(self, key: K):
+        del self._data[key]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def setdefault(self, key: K, default: V) -> V:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            self[key] = default
+            return default
+        return value
+
+    def pop(self, key: K, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self) -> List[Tuple[K, V]]:
+        return [(key, item[0]) for key, item in self._data.items()]
+
+    def values(self) -> List[V]:
+        return [item[0] for item in self._data.values()]
+
+    def _enforce_size(self):
+        # Вытесняем самые давние записи, пропуская те, что сейчас нельзя трогать
+        for key in list(self._data):
+            if len(self._data) <= self.maxsize:
+                break
+            if self._evictable(key, self._data[key][0]):
+                del self._data[key]
+                self.evicted_lru += 1
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (value, expires_at) in self._data.items()
+                   if expires_at <= now and self._evictable(key, value)]
+        for key in expired:
+            del self._data[key]
+        self.evicted_ttl += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_lru": self.evicted_lru,
+        }
+
+
+def lock_is_idle(_key: Any, lock: asyncio.Lock) -> bool:
+    # Свободный lock без ожидающих можно выбросить: следующий вызов создаст новый.
+    # Ожидающих проверяем отдельно: между release() и пробуждением ожидающего lock уже не занят.
+    return not lock.locked() and not getattr(lock, "_waiters", None)
@@ -0,0 +1,188 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_DOC_MIME_TYPE = "application/vnd.google-apps.document"
+PDF_MIME_TYPE = "application/pdf"
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Google Docs нельзя скачать как есть — только экспортировать в другой формат
+DRIVE_EXPORT_MIME_TYPES = {GOOGLE_DOC_MIME_TYPE: "text/plain"}
+DOCUMENT_PARSE_WORKERS = 2
+DOCUMENT_PARSE_TIMEOUT_SECONDS = 120
+DOCUMENT_PARSE_MEMORY_LIMIT_MB = 1024
+
+
+# PyPDF2 и python-docx импортируются при первом разборе, то есть в процессах-воркерах,
+# а не при старте бота
+
+def parse_pdf(data: bytes) -> str:
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+    texts = (page.extract_text() for page in pdf_reader.pages)
+    return "".join(text + "\n" for text in texts if text)
+
+
+def parse_docx(data: bytes) -> str:
+    import docx
+    doc = docx.Document(io.BytesIO(data))
+    return "\n".join(paragraph.text for paragraph in doc.paragraphs if paragraph.text)
+
+
+def decode_exported_text(data: bytes) -> str:
+    return data.decode("utf-8", errors="ignore")
+
+
+def decode_text(data: bytes) -> str:
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        logger.warning("Файл не в UTF-8, пробуем cp1251.")
+        return data.decode("cp1251", errors="ignore")
+
+
+DOCUMENT_PARSERS: Dict[str, Callable[[bytes], str]] = {
+    GOOGLE_DOC_MIME_TYPE: decode_exported_text,
+    PDF_MIME_TYPE: parse_pdf,
+    DOCX_MIME_TYPE: parse_docx,
+    "text/plain": decode_text,
+    "text/markdown": decode_text,  # .md как text
+}
+
+
+def parse_document(mime_type: str, data: bytes) -> str:
+    # Вызывается и в процессах-воркерах, поэтому функция верхнего уровня (передается через pickle)
+    return DOCUMENT_PARSERS[mime_type](data)
+
+
+def _process_pool_context():
+    # bot.py при импорте создает клиентов и хранилище состояния, а spawn/forkserver выполняют главный
+    # модуль в каждом воркере заново (__mp_main__) — поэтому на Linux используем fork. Воркер после
+    # fork выполняет только разбор из этого модуля и не трогает унаследованные клиенты и потоки.
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+def _current_address_space() -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmSize:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _limit_worker_memory(budget_bytes: int):
+    # Адресное пространство воркера ограничено: на битом или огромном PDF разбор упадет с MemoryError,
+    # а не съест память всего сервера. После fork воркер наследует адресное пространство бота
+    # (numpy, memmap кешей, стеки потоков), поэтому лимит — текущий VmSize плюс бюджет на разбор.
+    try:
+        import resource
+        current = _current_address_space()
+        if current is None:
+            logger.warning("Не удалось узнать размер адресного пространства воркера, память не ограничена.")
+            return
+        limit = current + budget_bytes
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"Не удалось ограничить память воркера разбора документов: {e}")
+
+
+class DocumentParsingService:
+    # Разбор документов любых поддерживаемых типов в пуле процессов: PyPDF2 и python-docx держат GIL,
+    # и в потоках бота они тормозили бы ответы пользователям во время обновления БЗ.
+    # Зависший разбор нельзя отменить внутри процесса, поэтому по таймауту пул пересоздается,
+    # а файлы, которые разбирались в нем одновременно, отправляются в новый пул еще раз.
+    def __init__(self, workers: int = DOCUMENT_PARSE_WORKERS, timeout: float = DOCUMENT_PARSE_TIMEOUT_SECONDS,
+                 memory_limit_mb: Optional[int] = DOCUMENT_PARSE_MEMORY_LIMIT_MB):
+        self._workers = max(1, workers)
+        self._timeout = timeout
+        # Бюджет памяти на разбор сверх унаследованного от бота адресного пространства
+        self._memory_limit_bytes = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # В пул отдается не больше задач, чем в нем процессов: таймаут считается от начала разбора,
+        # а не от постановки в очередь
+        self._slots = asyncio.Semaphore(self._workers)
+        self._generation = 0
+        self.parsed = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            initializer, initargs = None, ()
+            if self._memory_limit_bytes:
+                initializer, initargs = _limit_worker_memory, (self._memory_limit_bytes,)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._workers, mp_context=_process_pool_context(),
+                initializer=initializer, initargs=initargs,
+            )
+        return self._pool
+
+    def _restart_pool(self, reason: str):
+        pool, self._pool = self._pool, None
+        self._generation += 1
+        self.restarts += 1
+        logger.warning(f"Пул разбора документов пересоздается: {reason}.")
+        if pool is None:
+            return
+        # shutdown() не останавливает уже запущенные задачи — завершаем процессы сами
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            if process.is_alive():
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def parse(self, mime_type: str, data: bytes, name: str = "") -> str:
+        if mime_type not in DOCUMENT_PARSERS:
+            raise ValueError(f"Неподдерживаемый тип документа: {mime_type}")
+        resubmitted = False
+        while True:
+            async with self._slots:
+                generation = self._generation
+                future = self._get_pool().submit(parse_document, mime_type, data)
+                try:
+                    content = await asyncio.wait_for(asyncio.wrap_future(future), self._timeout)
+                    self.parsed += 1
+                    return content
+                except asyncio.CancelledError:
+                    if not future.cancelled() or generation == self._generation or resubmitted:
+                        raise
+                    resubmitted = True  # задачу снял перезапуск пула, а не отмена вызывающего
+                    continue
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    if generation == self._generation:
+                        self._restart_pool(f"разбор '{name}' дольше {self._timeout:.0f}с")
+                    raise TimeoutError(f"разбор документа '{name}' не уложился в {self._timeout:.0f}с")
+                except BrokenProcessPool:
+                    if generation != self._generation and not resubmitted:
+                        resubmitted = True  # пул убили из-за другого файла — пробуем еще раз в новом
+                        continue
+                    self.failures += 1
+                    if generation == self._generation:
+                        self._restart_pool(f"процесс-воркер аварийно завершился на '{name}'")
+                    raise
+                except Exception:
+                    self.failures += 1
+                    raise
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"parsed": self.parsed, "timeouts": self.timeouts, "failures": self.failures, "restarts": self.restarts}
@@ -0,0 +1,108 @@
+import asyncio
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional
+
+from document_parsing import DRIVE_EXPORT_MIME_TYPES, DocumentParsingService
+
+logger = logging.getLogger(__name__)
+
+DRIVE_DOWNLOAD_WORKERS = 8
+
+
+class DriveDocumentReader:
+    # Конвейер чтения БЗ из Google Drive: файлы скачиваются пулом потоков (у каждого потока свой
+    # сервис и свой HTTP-объект — googleapiclient не потокобезопасен) и разбираются в пуле процессов
+    # DocumentParsingService. Документы отдаются по мере готовности, в работе не больше
+    # 2 * download_workers файлов, поэтому скачанные, но не обработанные файлы не копятся в памяти.
+    def __init__(self, service_factory: Callable[[], Any], parser: DocumentParsingService,
+                 download_workers: int = DRIVE_DOWNLOAD_WORKERS):
+        self._service_factory = service_factory
+        self._parser = parser
+        self._download_workers = max(1, download_workers)
+        self._download_pool: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+
+    def _get_download_pool(self) -> ThreadPoolExecutor:
+        if self._download_pool is None:
+            self._download_pool = ThreadPoolExecutor(
+                max_workers=self._download_workers, thread_name_prefix="drive-download",
+            )
+        return self._download_pool
+
+    def _thread_service(self) -> Any:
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._service_factory()
+            if service is None:
+                raise RuntimeError("сервис Google Drive не инициализирован")
+            self._local.service = service
+        return service
+
+    def _download(self, file_item: Dict[str, Any]) -> bytes:
+        from googleapiclient.http import MediaIoBaseDownload  # только для обновления БЗ, не при старте бота
+        service = self._thread_service()
+        export_mime_type = DRIVE_EXPORT_MIME_TYPES.get(file_item["mimeType"])
+        if export_mime_type:
+            request = service.files().export_media(fileId=file_item["id"], mimeType=export_mime_type)
+        else:
+            request = service.files().get_media(fileId=file_item["id"])
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+            if status: logger.debug(f"Загрузка файла {file_item['id']}: {int(status.progress() * 100)}%.")
+        return fh.getvalue()
+
+    async def _read_one(self, file_item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # None — только при ошибке скачивания или разбора
+        file_id, mime_type, file_name = file_item["id"], file_item["mimeType"], file_item["name"]
+        logger.info(f"Обработка файла: '{file_name}' (ID: {file_id}, Type: {mime_type})")
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(self._get_download_pool(), self._download, file_item)
+            content = await self._parser.parse(mime_type, data, file_name)
+        except Exception as e:
+            logger.error(f"Ошибка чтения файла '{file_name}': {e}", exc_info=True)
+            return None
+        if not content or not content.strip():
+            # Файл прочитан, но текста в нем нет (пустой документ, PDF без текстового слоя). Его все равно
+            # отдаем: он попадет в манифест без чанков, а его прежние чанки будут удалены
+            logger.warning(f"Файл '{file_name}' пуст или не удалось извлечь контент.")
+            return {"id": file_id, "name": file_name, "content": ""}
+        logger.info(f"Успешно прочитан файл: '{file_name}' ({len(content)} симв)")
+        return {"id": file_id, "name": file_name, "content": content}
+
+    async def iter_documents(self, files: Iterable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        # Порядок — по готовности, а не по списку файлов
+        pending_files = iter(files)
+        in_flight: set = set()
+        max_in_flight = self._download_workers * 2
+        read_count = 0
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    file_item = next(pending_files, None)
+                    if file_item is None:
+                        break
+                    in_flight.add(asyncio.create_task(self._read_one(file_item)))
+                if not in_flight:
+                    break
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    document = task.result()
+                    if document:
+                        read_count += 1
+                        yield document
+        finally:
+            for task in in_flight:
+                task.cancel()
+        logger.info(f"Чтение из Google Drive завершено. Прочитано {read_count} документов.")
+
+    def close(self):
+        if self._download_pool is not None:
+            self._download_pool.shutdown(wait=False, cancel_futures=True)
+            self._download_pool = None
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DRIVE_SYNC_INTERVAL_SECONDS = 180
+DRIVE_SYNC_MAX_BACKOFF_SECONDS = 1800
+DRIVE_PAGE_TOKEN_KEY = "drive_changes_page_token"
+_CHANGE_FIELDS = (
+    "nextPageToken, newStartPageToken, "
+    "changes(fileId, removed, file(id, name, mimeType, parents, trashed, modifiedTime, md5Checksum, version))"
+)
+
+
+class DriveChangesWatcher:
+    # Следит за папкой базы знаний через Drive changes.list и запускает инкрементальное обновление.
+    # Page token хранится снаружи (load_token/save_token) и сдвигается только после успешного
+    # обновления: если оно упало, те же изменения придут при следующем опросе.
+    # service — объект googleapiclient (или подделка с тем же интерфейсом changes().…().execute()).
+    def __init__(self, service: Any, folder_id: str,
+                 load_token: Callable[[], Awaitable[Optional[str]]],
+                 save_token: Callable[[str], Awaitable[None]],
+                 on_changes: Callable[[List[Dict[str, Any]]], Awaitable[bool]],
+                 is_tracked: Callable[[str], bool] = lambda file_id: False,
+                 interval: float = DRIVE_SYNC_INTERVAL_SECONDS):
+        self._service = service
+        self._folder_id = folder_id
+        self._load_token = load_token
+        self._save_token = save_token
+        self._on_changes = on_changes
+        self._is_tracked = is_tracked
+        self._interval = interval
+        self.polls = 0
+        self.syncs = 0
+        self.failures = 0
+
+    def _get_start_page_token(self) -> str:
+        response = self._service.changes().getStartPageToken(supportsAllDrives=True).execute()
+        return response["startPageToken"]
+
+    def _list_changes(self, page_token: str) -> Dict[str, Any]:
+        # Все страницы изменений с page_token; возвращает изменения и токен для следующего опроса
+        changes: List[Dict[str, Any]] = []
+        while True:
+            response = self._service.changes().list(
+                pageToken=page_token, fields=_CHANGE_FIELDS, pageSize=1000, includeRemoved=True,
+                supportsAllDrives=True, includeItemsFromAllDrives=True, spaces="drive",
+            ).execute()
+            changes.extend(response.get("changes", []))
+            if response.get("newStartPageToken"):
+                return {"changes": changes, "new_start_page_token": response["newStartPageToken"]}
+            page_token = response["nextPageToken"]
+
+    def _is_relevant(self, change: Dict[str, Any]) -> bool:
+        # Файл в нашей папке, либо файл, который был в базе (удален, перемещен, отправлен в корзину)
+        file_id = change.get("fileId")
+        file_item = change.get("file") or {}
+        if self._folder_id in (file_item.get("parents") or []):
+            return True
+        return bool(file_id) and self._is_tracked(file_id)
+
+    async def poll_once(self) -> bool:
+        # True — были изменения в папке и обновление прошло успешно
+        self.polls += 1
+        page_token = await self._load_token()
+        if not page_token:
+            # Первый запуск: не знаем, что менялось раньше, поэтому сверяемся с Drive целиком
+            start_token = await asyncio.to_thread(self._get_start_page_token)
+            logger.info("Drive changes: сохраненного page token нет, выполняем сверку всей папки.")
+            if not await self._on_changes([]):
+                self.failures += 1
+                return False
+            await self._save_token(start_token)
+            self.syncs += 1
+            return True
+
+        result = await asyncio.to_thread(self._list_changes, page_token)
+        relevant = [change for change in result["changes"] if self._is_relevant(change)]
+        if relevant:
+            names = ", ".join(sorted({(c.get("file") or {}).get("name") or c.get("fileId", "?") for c in relevant}))
+            logger.info(f"Drive changes: {len(relevant)} изменений в папке БЗ ({names[:300]}). Запускаем обновление.")
+            if not await self._on_changes(relevant):
+                self.failures += 1
+                return False
+            self.syncs += 1
+        elif result["changes"]:
+            logger.debug(f"Drive changes: {len(result['changes'])} изменений вне папки БЗ, пропускаем.")
+        await self._save_token(result["new_start_page_token"])
+        return bool(relevant)
+
+    async def run(self):
+        delay = self._interval
+        while True:
+            try:
+                await self.poll_once()
+                delay = self._interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                delay = min(delay * 2, DRIVE_SYNC_MAX_BACKOFF_SECONDS)
+                logger.error(f"Drive changes: ошибка опроса ({e}), следующая попытка через {delay:.0f}с.", exc_info=True)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, int]:
+        return {"polls": self.polls, "syncs": self.syncs, "failures": self.failures}
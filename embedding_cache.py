@@ -0,0 +1,328 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+try:
+    import numpy as np
+except ImportError:  # numpy нужен только дисковому уровню кеша
+    np = None
+
+logger = logging.getLogger(__name__)
+
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+QUERY_EMBEDDING_DISK_CAPACITY = 50000
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.,!?;:()\"'«»-—…"
+
+
+def normalize_query(text: str) -> str:
+    # "Сколько стоит?" и "сколько  стоит" должны попадать в один ключ
+    text = _WHITESPACE_RE.sub(" ", text.lower().replace("ё", "е"))
+    return text.strip(_EDGE_PUNCTUATION)
+
+
+def _query_key(normalized: str) -> bytes:
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest().encode("ascii")
+
+
+class _DiskEmbeddingStore:
+    # Кольцевой буфер из двух memmap-файлов: векторы float32 и параллельный массив ключей (sha1 текста)
+    # с порядковыми номерами. Индекс ключ -> слот восстанавливается при открытии по маленькому файлу ключей,
+    # не читая векторы. При смене модели или размерности файлы создаются заново.
+    def __init__(self, directory: str, model: str, dimensions: int, capacity: int):
+        self._capacity = capacity
+        slot_dtype = np.dtype([("key", "S40"), ("seq", "<i8")])
+        self._meta = {"model": model, "dimensions": dimensions, "capacity": capacity}
+        os.makedirs(directory, exist_ok=True)
+        data_path = os.path.join(directory, "query_embeddings.f32")
+        keys_path = os.path.join(directory, "query_embeddings.keys")
+        meta_path = os.path.join(directory, "query_embeddings.json")
+
+        existing_meta = None
+        if all(os.path.exists(p) for p in (meta_path, data_path, keys_path)):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    existing_meta = json.load(f)
+            except (OSError, ValueError):
+                existing_meta = None
+        mode = "r+" if existing_meta == self._meta else "w+"
+        if mode == "w+" and existing_meta is not None:
+            logger.info(f"Дисковый кеш эмбеддингов запросов создан для {existing_meta}, сейчас {self._meta}. Сбрасываем.")
+        self._vectors = np.memmap(data_path, dtype="<f4", mode=mode, shape=(capacity, dimensions))
+        self._slots = np.memmap(keys_path, dtype=slot_dtype, mode=mode, shape=(capacity,))
+        if mode == "w+":
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(self._meta, f)
+
+        self._index: Dict[bytes, int] = {}
+        self._next_seq = 0
+        for slot, (key, seq) in enumerate(zip(self._slots["key"], self._slots["seq"])):
+            if key:
+                self._index[bytes(key)] = slot
+                self._next_seq = max(self._next_seq, int(seq) + 1)
+        logger.info(f"Дисковый кеш эмбеддингов запросов: {len(self._index)} записей в {data_path}.")
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: bytes) -> Optional[List[float]]:
+        slot = self._index.get(key)
+        if slot is None:
+            return None
+        return self._vectors[slot].tolist()
+
+    def put(self, key: bytes, embedding: List[float]):
+        if key in self._index:
+            return
+        slot = self._next_seq % self._capacity
+        old_key = bytes(self._slots["key"][slot])
+        if old_key:
+            self._index.pop(old_key, None)
+        # Сначала вектор, потом ключ: оборванная запись не будет прочитана как валидная
+        self._slots["key"][slot] = b""
+        self._vectors[slot] = embedding
+        self._slots["seq"][slot] = self._next_seq
+        self._slots["key"][slot] = key
+        self._index[key] = slot
+        self._next_seq += 1
+
+    def flush(self):
+        self._vectors.flush()
+        self._slots.flush()
+
+
+class QueryEmbeddingCache:
+    # Нормализованный текст запроса -> эмбеддинг. В памяти — LRU, на диске (по желанию) — memmap.
+    # Ключ не включает модель: кеш создается под конкретные модель и размерность, дисковый уровень
+    # сбрасывается, если они изменились.
+    def __init__(self, model: str, dimensions: int, maxsize: int = QUERY_EMBEDDING_CACHE_SIZE,
+                 disk_dir: Optional[str] = None, disk_capacity: int = QUERY_EMBEDDING_DISK_CAPACITY):
+        self.model = model
+        self.dimensions = dimensions
+        self._maxsize = maxsize
+        self._memory: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._disk: Optional[_DiskEmbeddingStore] = None
+        if disk_dir:
+            if np is None:
+                logger.warning("numpy не установлен: дисковый кеш эмбеддингов запросов отключен.")
+            else:
+                try:
+                    self._disk = _DiskEmbeddingStore(disk_dir, model, dimensions, disk_capacity)
+                except Exception as e:
+                    logger.error(f"Не удалось открыть дисковый кеш эмбеддингов в {disk_dir}: {e}", exc_info=True)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, query: str) -> Optional[List[float]]:
+        key = _query_key(normalize_query(query))
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return embedding
+        if self._disk is not None:
+            embedding = self._disk.get(key)
+            if embedding is not None:
+                self._remember(key, embedding)
+                self.disk_hits += 1
+                return embedding
+        self.misses += 1
+        return None
+
+    def put(self, query: str, embedding: List[float]):
+        if len(embedding) != self.dimensions:
+            logger.warning(f"Эмбеддинг размерности {len(embedding)} не кешируется (ожидалась {self.dimensions}).")
+            return
+        key = _query_key(normalize_query(query))
+        self._remember(key, embedding)
+        if self._disk is not None:
+            self._disk.put(key, embedding)
+
+    def _remember(self, key: bytes, embedding: List[float]):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._maxsize:
+            self._memory.popitem(last=False)
+
+    def flush(self):
+        if self._disk is not None:
+            self._disk.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_size": len(self._memory),
+            "disk_size": len(self._disk) if self._disk is not None else None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+CHUNK_EMBEDDINGS_INITIAL_CAPACITY = 1024
+# Сжимаем файл, когда неиспользуемых записей становится больше, чем живых
+CHUNK_EMBEDDINGS_COMPACT_RATIO = 0.5
+
+
+def chunk_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest().encode("ascii")
+
+
+class ChunkEmbeddingStore:
+    # Постоянный кеш эмбеддингов чанков базы знаний: sha256(текст) -> вектор float32.
+    # Векторы и ключи лежат в двух растущих memmap-файлах, записи дописываются в конец.
+    # Счетчик записей в метаданных обновляется в flush() после записи векторов, поэтому
+    # недописанные при падении записи просто не видны. Модель и размерность — в метаданных;
+    # при их смене кеш создается заново.
+    # get_many и put_many вызываются из разных потоков (asyncio.to_thread) одновременно, поэтому
+    # индекс и memmap-файлы меняются только под self._lock; ключ попадает в индекс, когда строка
+    # с вектором уже записана.
+    def __init__(self, directory: str, model: str, dimensions: int):
+        if np is None:
+            raise RuntimeError("Для кеша эмбеддингов чанков нужен numpy")
+        self._dimensions = dimensions
+        self._lock = threading.Lock()
+        self._meta = {"model": model, "dimensions": dimensions}
+        os.makedirs(directory, exist_ok=True)
+        self._vectors_path = os.path.join(directory, "chunk_embeddings.f32")
+        self._keys_path = os.path.join(directory, "chunk_embeddings.keys")
+        self._meta_path = os.path.join(directory, "chunk_embeddings.json")
+        self._key_dtype = np.dtype("S64")
+
+        meta = None
+        if all(os.path.exists(p) for p in (self._meta_path, self._vectors_path, self._keys_path)):
+            try:
+                with open(self._meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+        if meta and meta.get("model") == model and meta.get("dimensions") == dimensions:
+            self._count = int(meta.get("count", 0))
+            self._capacity = max(int(meta.get("capacity", 0)), self._count, CHUNK_EMBEDDINGS_INITIAL_CAPACITY)
+        else:
+            if meta:
+                logger.info(f"Кеш эмбеддингов чанков создан для {meta.get('model')}/{meta.get('dimensions')}, "
+                            f"сейчас {model}/{dimensions}. Сбрасываем.")
+            for path in (self._vectors_path, self._keys_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._count = 0
+            self._capacity = CHUNK_EMBEDDINGS_INITIAL_CAPACITY
+        self._open_maps()
+        self._index: Dict[bytes, int] = {bytes(key): row for row, key in enumerate(self._keys[:self._count]) if key}
+        self.hits = 0
+        self.misses = 0
+        self._write_meta()
+        logger.info(f"Кеш эмбеддингов чанков: {len(self._index)} записей в {self._vectors_path}.")
+
+    def _open_maps(self):
+        # Файлы дорастают до емкости (на большинстве ФС — разреженно), затем отображаются в память
+        for path, row_size in ((self._vectors_path, 4 * self._dimensions), (self._keys_path, self._key_dtype.itemsize)):
+            with open(path, "ab") as f:
+                if f.tell() < self._capacity * row_size:
+                    f.truncate(self._capacity * row_size)
+        self._vectors = np.memmap(self._vectors_path, dtype="<f4", mode="r+", shape=(self._capacity, self._dimensions))
+        self._keys = np.memmap(self._keys_path, dtype=self._key_dtype, mode="r+", shape=(self._capacity,))
+
+    def _grow(self, needed: int):
+        # Вызывается под self._lock: пока карты переоткрываются, читатели ждут
+        if needed <= self._capacity:
+            return
+        self._flush_locked()
+        while self._capacity < needed:
+            self._capacity *= 2
+        del self._vectors, self._keys
+        self._open_maps()
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({**self._meta, "count": self._count, "capacity": self._capacity}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [chunk_key(text) for text in texts]
+        result: List[Optional[List[float]]] = []
+        with self._lock:
+            for key in keys:
+                row = self._index.get(key)
+                if row is None:
+                    self.misses += 1
+                    result.append(None)
+                else:
+                    self.hits += 1
+                    result.append(self._vectors[row].tolist())
+        return result
+
+    def put_many(self, texts: List[str], embeddings: List[Any]):
+        candidates = [(chunk_key(text), embedding) for text, embedding in zip(texts, embeddings)
+                      if len(embedding) == self._dimensions]
+        with self._lock:
+            new_rows: Dict[bytes, Any] = {}
+            for key, embedding in candidates:
+                if key not in self._index and key not in new_rows:
+                    new_rows[key] = embedding
+            if not new_rows:
+                return
+            self._grow(self._count + len(new_rows))
+            first_row = self._count
+            for row, (key, embedding) in enumerate(new_rows.items(), start=first_row):
+                self._vectors[row] = embedding
+                self._keys[row] = key
+            self._vectors.flush()
+            self._keys.flush()
+            for row, key in enumerate(new_rows, start=first_row):
+                self._index[key] = row
+            self._count = first_row + len(new_rows)
+
+    def compact(self, keep: Set[bytes]) -> int:
+        # Удаляет эмбеддинги чанков, которых больше нет в базе знаний (keep — их chunk_key);
+        # строки сдвигаются к началу файла
+        with self._lock:
+            return self._compact_locked(keep)
+
+    def _compact_locked(self, keep: Set[bytes]) -> int:
+        garbage = sum(1 for key in self._index if key not in keep)
+        if garbage <= len(self._index) * CHUNK_EMBEDDINGS_COMPACT_RATIO:
+            return 0
+        write_row = 0
+        new_index: Dict[bytes, int] = {}
+        for read_row in range(self._count):
+            key = bytes(self._keys[read_row])
+            if key not in keep or key in new_index:
+                continue
+            if read_row != write_row:
+                self._vectors[write_row] = self._vectors[read_row]
+                self._keys[write_row] = key
+            new_index[key] = write_row
+            write_row += 1
+        self._keys[write_row:self._count] = b""
+        self._count = write_row
+        self._index = new_index
+        self._flush_locked()
+        logger.info(f"Кеш эмбеддингов чанков сжат: удалено {garbage} записей, осталось {self._count}.")
+        return garbage
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._vectors.flush()
+        self._keys.flush()
+        self._write_meta()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._index), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Tuple
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Лимиты OpenAI для embeddings.create: до 2048 входов и до 300k токенов на запрос, до 8191 токена на вход
+EMBEDDING_MAX_INPUTS_PER_REQUEST = 2048
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 250_000
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_RETRY_BASE_DELAY = 1.0
+EMBEDDING_RETRY_MAX_DELAY = 60.0
+
+
+def _load_encoding(model: str) -> Optional[Any]:
+    try:
+        import tiktoken
+    except ImportError:  # без tiktoken размер запросов оценивается по длине текста
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+@dataclass
+class EmbeddingRunStats:
+    chunks: int = 0
+    tokens: int = 0
+    requests: int = 0
+    retries: int = 0
+    # Один объект статистики может собирать несколько параллельных вызовов embed():
+    # время — от начала первого до конца последнего
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def seconds(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    def as_dict(self) -> dict:
+        return {
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "requests": self.requests,
+            "retries": self.retries,
+            "seconds": round(self.seconds, 2),
+            "chunks_per_second": round(self.chunks / self.seconds, 1) if self.seconds else 0.0,
+            "tokens_per_second": round(self.tokens / self.seconds, 1) if self.seconds else 0.0,
+        }
+
+
+class EmbeddingPipeline:
+    # Разбивает входы на пачки по бюджету токенов, отправляет их параллельно (не больше concurrency
+    # запросов одновременно), повторяет при 429/5xx с экспоненциальной паузой и возвращает эмбеддинги
+    # в исходном порядке. embed() можно вызывать из нескольких задач сразу — лимит общий.
+    def __init__(self, client: Any, model: str, dimensions: Optional[int] = None,
+                 max_tokens_per_request: int = EMBEDDING_MAX_TOKENS_PER_REQUEST,
+                 max_inputs_per_request: int = EMBEDDING_MAX_INPUTS_PER_REQUEST,
+                 concurrency: int = EMBEDDING_CONCURRENCY, max_retries: int = EMBEDDING_MAX_RETRIES,
+                 retry_base_delay: float = EMBEDDING_RETRY_BASE_DELAY):
+        self._client = client
+        self._model = model
+        self._dimensions = dimensions
+        self._max_tokens = max_tokens_per_request
+        self._max_inputs = max_inputs_per_request
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_retries = max_retries
+        self._retry_base_delay = retry_base_delay
+        # Словарь tiktoken загружается при первом подсчете токенов, а не при старте бота
+        self._encoding = None
+        self._encoding_loaded = False
+
+    def _ensure_encoding(self):
+        if not self._encoding_loaded:
+            self._encoding = _load_encoding(self._model)
+            self._encoding_loaded = True
+
+    def count_tokens(self, text: str) -> int:
+        self._ensure_encoding()
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # Грубая оценка с запасом: в русском тексте токен — примерно 2–3 символа
+        return len(text) // 2 + 1
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        batches: List[List[int]] = []
+        current: List[int] = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if current and (current_tokens + tokens > self._max_tokens or len(current) >= self._max_inputs):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _embed_batch(self, inputs: List[str], stats: EmbeddingRunStats) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    response = await self._client.embeddings.create(
+                        input=inputs, model=self._model,
+                        dimensions=self._dimensions if self._dimensions else None,
+                    )
+                stats.requests += 1
+                usage = getattr(response, "usage", None)
+                stats.tokens += getattr(usage, "total_tokens", 0) or sum(self.count_tokens(t) for t in inputs)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except Exception as e:
+                attempt += 1
+                if not _is_retryable(e) or attempt > self._max_retries:
+                    raise
+                stats.retries += 1
+                delay = min(EMBEDDING_RETRY_MAX_DELAY, self._retry_base_delay * (2 ** (attempt - 1)))
+                delay *= random.uniform(0.8, 1.2)
+                logger.warning(f"Эмбеддинги: {type(e).__name__}: {e}. Повтор через {delay:.1f}с "
+                               f"(попытка {attempt + 1}/{self._max_retries + 1}).")
+                await asyncio.sleep(delay)
+
+    async def embed(self, texts: List[str],
+                    stats: Optional[EmbeddingRunStats] = None) -> Tuple[List[List[float]], EmbeddingRunStats]:
+        stats = stats if stats is not None else EmbeddingRunStats()
+        if not texts:
+            return [], stats
+        stats.chunks += len(texts)
+        started_at = time.monotonic()
+        if stats.started_at is None or started_at < stats.started_at:
+            stats.started_at = started_at
+        if not self._encoding_loaded:
+            await asyncio.to_thread(self._ensure_encoding)
+        batches = self.make_batches(texts)
+        logger.info(f"Эмбеддинги: {len(texts)} текстов в {len(batches)} запросах.")
+        results = await asyncio.gather(*(self._embed_batch([texts[i] for i in batch], stats) for batch in batches))
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+        stats.finished_at = max(stats.finished_at or 0.0, time.monotonic())
+        return embeddings, stats  # type: ignore[return-value]
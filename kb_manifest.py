@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+KB_MANIFEST_FILE = "kb_manifest.json"
+# Версия 2: детерминированные ID чанков; манифест версии 1 (случайные ID) ведет к полной пересборке
+KB_MANIFEST_FORMAT_VERSION = 2
+# Поля files.list, по которым определяется, изменился ли файл
+DRIVE_FILE_FIELDS = "id, name, mimeType, modifiedTime, md5Checksum, version"
+
+
+def chunk_id(file_id: str, position: int, text: str) -> str:
+    # Один и тот же текст на том же месте файла всегда получает тот же ID — это позволяет делать upsert
+    return f"{file_id}:{position}:{hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}"
+
+
+def drive_file_fingerprint(file_item: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "name": file_item.get("name"),
+        "mimeType": file_item.get("mimeType"),
+        "modifiedTime": file_item.get("modifiedTime"),
+        "md5Checksum": file_item.get("md5Checksum"),
+        "version": file_item.get("version"),
+    }
+
+
+def drive_file_changed(entry: Dict[str, Any], file_item: Dict[str, Any]) -> bool:
+    # Имя входит в текст чанков ("Документ: ...") и метаданные, поэтому переименование — тоже изменение.
+    # У загруженных файлов есть md5Checksum: сравниваем содержимое, а не время (повторная загрузка
+    # того же файла ничего не пересчитывает). У Google Docs md5 нет — смотрим на version и modifiedTime.
+    if entry.get("name") != file_item.get("name") or entry.get("mimeType") != file_item.get("mimeType"):
+        return True
+    if entry.get("md5Checksum") and file_item.get("md5Checksum"):
+        return entry["md5Checksum"] != file_item["md5Checksum"]
+    return (entry.get("version") != file_item.get("version")
+            or entry.get("modifiedTime") != file_item.get("modifiedTime"))
+
+
+def load_manifest(db_path: str) -> Optional[Dict[str, Any]]:
+    manifest_path = os.path.join(db_path, KB_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать манифест БЗ '{manifest_path}': {e}")
+        return None
+    if manifest.get("format") != KB_MANIFEST_FORMAT_VERSION or not isinstance(manifest.get("files"), dict):
+        logger.warning(f"Манифест БЗ '{manifest_path}' в неизвестном формате, будет полная пересборка.")
+        return None
+    return manifest
+
+
+def save_manifest(db_path: str, files: Dict[str, Dict[str, Any]], embedding_model: str, embedding_dimensions: int):
+    manifest_path = os.path.join(db_path, KB_MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "format": KB_MANIFEST_FORMAT_VERSION,
+            "embedding_model": embedding_model,
+            "embedding_dimensions": embedding_dimensions,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "files": files,
+        }, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+@dataclass
+class KbUpdatePlan:
+    full_rebuild: bool
+    reason: str = ""
+    unchanged: List[Dict[str, Any]] = field(default_factory=list)
+    changed: List[Dict[str, Any]] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+    @property
+    def is_noop(self) -> bool:
+        return not self.full_rebuild and not self.changed and not self.removed
+
+    def summary(self) -> str:
+        if self.full_rebuild:
+            return f"полная пересборка ({self.reason}), файлов: {len(self.changed)}"
+        return (f"изменено/новых: {len(self.changed)}, удалено: {len(self.removed)}, "
+                f"без изменений: {len(self.unchanged)}")
+
+
+def plan_kb_update(manifest: Optional[Dict[str, Any]], drive_files: List[Dict[str, Any]],
+                   embedding_model: str, embedding_dimensions: int) -> KbUpdatePlan:
+    if manifest is None:
+        return KbUpdatePlan(full_rebuild=True, reason="нет манифеста", changed=list(drive_files))
+    if (manifest.get("embedding_model") != embedding_model
+            or manifest.get("embedding_dimensions") != embedding_dimensions):
+        return KbUpdatePlan(full_rebuild=True, reason="сменилась модель эмбеддингов", changed=list(drive_files))
+    known = manifest["files"]
+    plan = KbUpdatePlan(full_rebuild=False)
+    for file_item in drive_files:
+        entry = known.get(file_item["id"])
+        if entry is None or drive_file_changed(entry, file_item):
+            plan.changed.append(file_item)
+        else:
+            plan.unchanged.append(file_item)
+    current_ids = {file_item["id"] for file_item in drive_files}
+    plan.removed = [file_id for file_id in known if file_id not in current_ids]
+    return plan
@@ -0,0 +1,127 @@
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+from typing import Any, Iterator, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def write_active_pointer(base_path: str, pointer_file: str, version: str):
+    # Указатель на активную БЗ заменяется атомарно: при падении остается старое или новое значение
+    pointer_path = os.path.join(base_path, pointer_file)
+    tmp_path = pointer_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path)
+
+
+class KbSnapshot:
+    # Одна версия базы знаний: каталог, открытый клиент Chroma, коллекция и индексы поиска.
+    # Снимок не меняется после публикации; readers — сколько запросов сейчас его читают.
+    # revision растет при обновлении на месте (тот же каталог и коллекция, новые индексы).
+    def __init__(self, version: str, path: str, client: Any, collection: Any,
+                 vector_index: Optional[Any] = None, lexical_index: Optional[Any] = None,
+                 file_ids: Optional[Set[str]] = None, revision: int = 0):
+        self.version = version
+        self.revision = revision
+        self.path = path
+        self.client = client
+        self.collection = collection
+        self.vector_index = vector_index
+        self.lexical_index = lexical_index
+        self.file_ids = frozenset(file_ids or ())
+        self.readers = 0
+        self.retired = False
+        self.delete_files = False
+
+    def close(self):
+        # У PersistentClient нет явного закрытия: отпускаем ссылки (и memmap индекса), затем удаляем каталог
+        self.collection = None
+        self.client = None
+        self.vector_index = None
+        self.lexical_index = None
+        if self.delete_files and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+            logger.info(f"Удалена предыдущая версия БЗ: '{self.path}'")
+
+
+class KbSnapshotRegistry:
+    # Активная версия БЗ с подсчетом читателей. swap() публикует новую версию сразу для новых запросов;
+    # старая закрывается и удаляется, только когда ее отпустит последний читатель.
+    # Счетчики меняются только из потока event loop, поэтому блокировки не нужны.
+    def __init__(self):
+        self._current: Optional[KbSnapshot] = None
+        self._disposals: Set[asyncio.Future] = set()
+
+    @property
+    def current(self) -> Optional[KbSnapshot]:
+        return self._current
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._current.version if self._current else None
+
+    @property
+    def state_key(self) -> Optional[Tuple[str, int]]:
+        # Меняется при любом изменении содержимого БЗ — входит в ключ кеша ответов
+        return (self._current.version, self._current.revision) if self._current else None
+
+    @property
+    def file_ids(self) -> frozenset:
+        return self._current.file_ids if self._current else frozenset()
+
+    def acquire(self) -> Optional[KbSnapshot]:
+        snapshot = self._current
+        if snapshot is not None:
+            snapshot.readers += 1
+        return snapshot
+
+    def release(self, snapshot: Optional[KbSnapshot]):
+        if snapshot is None:
+            return
+        snapshot.readers -= 1
+        if snapshot.retired and snapshot.readers == 0:
+            self._dispose(snapshot)
+
+    @contextlib.contextmanager
+    def reading(self) -> Iterator[Optional[KbSnapshot]]:
+        snapshot = self.acquire()
+        try:
+            yield snapshot
+        finally:
+            self.release(snapshot)
+
+    def swap(self, snapshot: Optional[KbSnapshot], delete_previous: bool = True) -> Optional[KbSnapshot]:
+        previous, self._current = self._current, snapshot
+        if previous is not None and previous is not snapshot:
+            previous.retired = True
+            previous.delete_files = delete_previous and (snapshot is None or previous.path != snapshot.path)
+            if previous.readers == 0:
+                self._dispose(previous)
+            else:
+                logger.info(f"Версия БЗ '{previous.version}' будет закрыта после {previous.readers} активных запросов.")
+        return previous
+
+    def _dispose(self, snapshot: KbSnapshot):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            snapshot.close()
+            return
+        future = loop.run_in_executor(None, snapshot.close)
+        self._disposals.add(future)
+        future.add_done_callback(self._on_disposed)
+
+    def _on_disposed(self, future: asyncio.Future):
+        self._disposals.discard(future)
+        if not future.cancelled() and future.exception():
+            logger.error(f"Не удалось закрыть предыдущую версию БЗ: {future.exception()}")
+
+    async def aclose(self):
+        # При остановке бота дожидаемся удаления старых версий
+        if self._disposals:
+            await asyncio.gather(*self._disposals, return_exceptions=True)
@@ -0,0 +1,150 @@
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+LEXICAL_INDEX_FORMAT_VERSION = 1
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+# Слово, число или код: "iphone-15", "a1234", "1.5", "б/у"
+_TOKEN_RE = re.compile(r"[0-9a-zа-я]+(?:[-./][0-9a-zа-я]+)*")
+_STOPWORDS = frozenset(
+    "а без бы в во вам вас весь все всё вы да для до же за и из или им их к как ли мне мы на над не нет ни "
+    "но о об от по под при с со так там то только у уже что чтобы это я".split()
+)
+# Легкий стемминг: отрезаем частые окончания, чтобы "цена", "цены" и "цену" совпадали
+_RUSSIAN_ENDINGS = sorted(
+    "иями ями ами ого его ому ему ыми ими ия ие ий ью ья ье ой ей ый ая яя ое ее ые ую юю "
+    "ам ям ах ях ом ем ов ев ть а я о е ы и у ю ь й".split(),
+    key=len, reverse=True,
+)
+_CYRILLIC_WORD_RE = re.compile(r"^[а-я]+$")
+
+
+def _stem(token: str) -> str:
+    if len(token) < 4 or not _CYRILLIC_WORD_RE.match(token):
+        return token  # коды, числа и латиницу не трогаем
+    for ending in _RUSSIAN_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= 3:
+            return token[:-len(ending)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+    return [_stem(token) for token in tokens if token not in _STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = RRF_K) -> List[str]:
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
+
+
+class LexicalIndex:
+    # BM25 по инвертированному индексу: термин -> [(номер документа, частота)].
+    # Поиск проходит только по спискам терминов запроса, поэтому укладывается в доли миллисекунды.
+    def __init__(self, ids: List[str], doc_lengths: List[int], postings: Dict[str, List[Tuple[int, int]]]):
+        self._ids = ids
+        self._doc_lengths = doc_lengths
+        self._postings = postings
+        avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        # Знаменатель BM25 без частоты термина зависит только от длины документа — считаем заранее
+        self._length_norms = [BM25_K1 * (1 - BM25_B + BM25_B * length / (avg_length or 1.0)) for length in doc_lengths]
+        total = len(ids)
+        self._idf = {
+            term: math.log(1 + (total - len(entries) + 0.5) / (len(entries) + 0.5))
+            for term, entries in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @classmethod
+    def build(cls, ids: Sequence[str], documents: Sequence[str]) -> "LexicalIndex":
+        builder = LexicalIndexBuilder()
+        builder.add(ids, documents)
+        return builder.build()
+
+    @classmethod
+    def build_from_collection(cls, collection: Any) -> "LexicalIndex":
+        data = collection.get(include=["documents"])
+        return cls.build(data["ids"], data.get("documents") or [])
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, LEXICAL_INDEX_FILE)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format": LEXICAL_INDEX_FORMAT_VERSION,
+                "ids": self._ids,
+                "doc_lengths": self._doc_lengths,
+                "postings": self._postings,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+        logger.info(f"Сохранен лексический индекс: {len(self._ids)} документов, {len(self._postings)} терминов.")
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(os.path.join(path, LEXICAL_INDEX_FILE), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != LEXICAL_INDEX_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат лексического индекса: {data.get('format')}")
+        postings = {term: [(doc, tf) for doc, tf in entries] for term, entries in data["postings"].items()}
+        return cls(data["ids"], data["doc_lengths"], postings)
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            entries = self._postings.get(term)
+            if not entries:
+                continue
+            weight = self._idf[term] * (BM25_K1 + 1)
+            length_norms = self._length_norms
+            for position, frequency in entries:
+                scores[position] = scores.get(position, 0.0) + weight * frequency / (frequency + length_norms[position])
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self._ids[position], score) for position, score in best]
+
+
+class LexicalIndexBuilder:
+    # Сборка индекса пачками: копятся только постинги и длины документов, сами тексты не хранятся
+    def __init__(self):
+        self._ids: List[str] = []
+        self._doc_lengths: List[int] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+
+    def add(self, ids: Sequence[str], documents: Sequence[str]):
+        for chunk_id, document in zip(ids, documents):
+            position = len(self._ids)
+            tokens = tokenize(document or "")
+            self._ids.append(chunk_id)
+            self._doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self._postings.setdefault(term, []).append((position, frequency))
+
+    def build(self) -> LexicalIndex:
+        return LexicalIndex(self._ids, self._doc_lengths, self._postings)
+
+
+def load_or_build_lexical_index(path: str, collection: Optional[Any] = None) -> Optional[LexicalIndex]:
+    if os.path.exists(os.path.join(path, LEXICAL_INDEX_FILE)):
+        return LexicalIndex.load(path)
+    if collection is None:
+        return None
+    logger.info(f"Лексический индекс в '{path}' не найден, собираем из коллекции Chroma...")
+    index = LexicalIndex.build_from_collection(collection)
+    index.save(path)
+    return index
@@ -0,0 +1,35 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimings:
+    # Длительность этапов запуска бота: mark() закрывает этап, начатый предыдущей отметкой.
+    # Отсчет идет от started_at — в bot.py это момент до импорта тяжелых зависимостей.
+    def __init__(self, started_at: Optional[float] = None):
+        self._started_at = started_at if started_at is not None else time.perf_counter()
+        self._last_mark = self._started_at
+        self._phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> float:
+        now = time.perf_counter()
+        elapsed = now - self._last_mark
+        self._last_mark = now
+        self._phases.append((phase, elapsed))
+        logger.debug(f"Этап запуска '{phase}': {elapsed:.3f}с")
+        return elapsed
+
+    @property
+    def total(self) -> float:
+        return self._last_mark - self._started_at
+
+    def as_dict(self) -> Dict[str, float]:
+        result = {phase: round(seconds, 3) for phase, seconds in self._phases}
+        result["total"] = round(self.total, 3)
+        return result
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{phase}={seconds:.2f}с" for phase, seconds in self._phases)
+        return f"{self.total:.2f}с ({phases})"
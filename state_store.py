@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bounded_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+STATE_FLUSH_INTERVAL_SECONDS = 0.5
+STATE_FLUSH_MAX_BATCH = 500
+STATE_CACHE_MAX_ENTRIES = 10000
+STATE_CACHE_TTL_SECONDS = 6 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_threads (
+    user_key TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS silenced_peers (
+    peer_id INTEGER PRIMARY KEY,
+    silenced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_cooldowns (
+    user_id INTEGER PRIMARY KEY,
+    last_message_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_cooldowns_last_message_at ON user_cooldowns (last_message_at);
+CREATE TABLE IF NOT EXISTS pending_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_pending_messages_peer_id ON pending_messages (peer_id, id);
+CREATE TABLE IF NOT EXISTS buffer_timers (
+    peer_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    due_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS own_messages (
+    peer_id INTEGER NOT NULL,
+    random_id INTEGER NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY (peer_id, random_id)
+);
+CREATE TABLE IF NOT EXISTS kv_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+_Op = Tuple[str, Sequence[Any]]
+
+
+class StateStore:
+    # Единое хранилище состояния бота: треды, режим молчания, кулдауны, буферы сообщений и их таймеры.
+    # SQLite в режиме WAL; все обращения к базе идут через один поток с одним соединением.
+    # В памяти держится зеркало данных; изменения копятся в журнале операций и уходят
+    # на диск одной транзакцией раз в полсекунды, так что обработка сообщений не ждет диска.
+    # Треды, молчание и кулдауны читаются лениво при первом обращении и держатся в ограниченных
+    # TTL/LRU-кешах (база остается источником истины); буферы и таймеры загружаются при старте
+    # целиком, чтобы досчитать сообщения, пришедшие перед падением.
+    def __init__(self, db_path: str, flush_interval: float = STATE_FLUSH_INTERVAL_SECONDS,
+                 max_batch: int = STATE_FLUSH_MAX_BATCH, cache_size: int = STATE_CACHE_MAX_ENTRIES,
+                 cache_ttl: float = STATE_CACHE_TTL_SECONDS, cooldown_ttl: float = STATE_CACHE_TTL_SECONDS):
+        self._db_path = db_path
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._ops: List[_Op] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+        # None — записи нет и в базе
+        self._threads: TTLCache[str, Optional[str]] = TTLCache(cache_size, cache_ttl, name="threads")
+        self._threads_generation = 0  # растет при reset_all, чтобы не кешировать прочитанное до сброса
+        self._silenced: TTLCache[int, bool] = TTLCache(cache_size, cache_ttl, name="silence")
+        self._cooldowns: TTLCache[int, Optional[float]] = TTLCache(cache_size, cooldown_ttl, name="cooldowns")
+        self._own_messages: TTLCache[Tuple[int, int], bool] = TTLCache(cache_size, cache_ttl, name="own_messages")
+        self._pending: Dict[int, List[str]] = {}
+        self._timers: Dict[int, Tuple[int, float]] = {}
+
+    # --- Работа с SQLite (только в потоке executor) ---
+    def _open_sync(self):
+        conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+
+    def _fetch_one_sync(self, sql: str, params: Sequence[Any]) -> Optional[tuple]:
+        return self._conn.execute(sql, params).fetchone()
+
+    def _fetch_all_sync(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return self._conn.execute(sql, params).fetchall()
+
+    def _apply_sync(self, ops: List[_Op]) -> List[int]:
+        rowcounts = []
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for sql, params in ops:
+                rowcounts.append(self._conn.execute(sql, params).rowcount)
+        return rowcounts
+
+    def _close_sync(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _queue(self, sql: str, params: Sequence[Any] = ()):
+        self._ops.append((sql, params))
+        if len(self._ops) >= self._max_batch:
+            self._wakeup.set()
+
+    async def _read_one(self, sql: str, params: Sequence[Any]) -> Optional[tuple]:
+        # Запись могла быть вытеснена из кеша до сброса на диск: сначала дописываем журнал
+        if self._ops:
+            await self.flush()
+        return await self._run(self._fetch_one_sync, sql, params)
+
+    async def _apply_now(self, ops: List[_Op]) -> List[int]:
+        # Накопленные операции идут в ту же транзакцию перед новыми, чтобы сохранить порядок
+        queued, self._ops = self._ops, []
+        try:
+            rowcounts = await self._run(self._apply_sync, queued + ops)
+        except Exception:
+            # Как и во flush(): отложенные изменения не теряем, повторим их перед более новыми
+            self._ops = queued + self._ops
+            raise
+        return rowcounts[len(queued):]
+
+    # --- Жизненный цикл ---
+    async def open(self):
+        await self._run(self._open_sync)
+        owners: Dict[int, int] = {}
+        for peer_id, user_id, text in await self._run(
+            self._fetch_all_sync, "SELECT peer_id, user_id, text FROM pending_messages ORDER BY id"
+        ):
+            self._pending.setdefault(peer_id, []).append(text)
+            owners.setdefault(peer_id, user_id)
+        for peer_id, user_id, due_at in await self._run(
+            self._fetch_all_sync, "SELECT peer_id, user_id, due_at FROM buffer_timers"
+        ):
+            self._timers[peer_id] = (user_id, due_at)
+        # Буфер без таймера (процесс упал между записями) обрабатываем сразу
+        for peer_id, user_id in owners.items():
+            if peer_id not in self._timers:
+                self.set_buffer_timer(peer_id, user_id, time.time())
+        self._flush_task = asyncio.create_task(self._flush_loop(), name="StateStoreFlusher")
+        logger.info(f"Хранилище состояния открыто: {self._db_path} "
+                    f"(буферов: {len(self._pending)}, таймеров: {len(self._timers)}).")
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=True)
+        logger.info("Хранилище состояния закрыто.")
+
+    async def flush(self):
+        if not self._ops or not self._conn:
+            return
+        ops, self._ops = self._ops, []
+        try:
+            await self._run(self._apply_sync, ops)
+            logger.debug(f"Хранилище состояния: записано операций: {len(ops)}.")
+        except Exception as e:
+            logger.error(f"Ошибка записи в хранилище состояния: {e}", exc_info=True)
+            # Не теряем изменения: повторим их перед более новыми
+            self._ops = ops + self._ops
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    # --- Треды OpenAI ---
+    async def get_thread(self, user_key: str) -> Optional[str]:
+        if user_key in self._threads:
+            return self._threads[user_key]
+        generation = self._threads_generation
+        row = await self._read_one("SELECT thread_id FROM user_threads WHERE user_key = ?", (user_key,))
+        if generation != self._threads_generation:
+            return self._threads.get(user_key)
+        # Пока читали, значение могли поменять в памяти — оно важнее прочитанного
+        if user_key not in self._threads:
+            self._threads[user_key] = row[0] if row else None
+        return self._threads[user_key]
+
+    def set_thread(self, user_key: str, thread_id: str):
+        self._threads[user_key] = thread_id
+        self._queue(
+            "INSERT INTO user_threads (user_key, thread_id, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(user_key) DO UPDATE SET thread_id = excluded.thread_id, updated_at = excluded.updated_at",
+            (user_key, thread_id, time.time()),
+        )
+
+    def discard_thread(self, user_key: str):
+        self._threads[user_key] = None
+        self._queue("DELETE FROM user_threads WHERE user_key = ?", (user_key,))
+
+    async def reset_thread(self, user_key: str) -> Optional[str]:
+        # Сброс пишется сразу, чтобы тред не "воскрес" после падения процесса
+        previous = await self.get_thread(user_key)
+        self._threads[user_key] = None
+        await self._apply_now([("DELETE FROM user_threads WHERE user_key = ?", (user_key,))])
+        return previous
+
+    # --- Режим молчания ---
+    async def is_silenced(self, peer_id: int) -> bool:
+        if peer_id in self._silenced:
+            return self._silenced[peer_id]
+        row = await self._read_one("SELECT 1 FROM silenced_peers WHERE peer_id = ?", (peer_id,))
+        if peer_id not in self._silenced:
+            self._silenced[peer_id] = row is not None
+        return self._silenced[peer_id]
+
+    async def silence(self, peer_id: int) -> bool:
+        if await self.is_silenced(peer_id):
+            return False
+        self._silenced[peer_id] = True
+        self._queue("INSERT OR REPLACE INTO silenced_peers (peer_id, silenced_at) VALUES (?, ?)", (peer_id, time.time()))
+        return True
+
+    async def unsilence(self, peer_id: int) -> bool:
+        if not await self.is_silenced(peer_id):
+            return False
+        self._silenced[peer_id] = False
+        self._queue("DELETE FROM silenced_peers WHERE peer_id = ?", (peer_id,))
+        return True
+
+    async def import_silence_json(self, path: str) -> int:
+        # Разовый перенос старого silence_state.json; после импорта файл переименовывается
+        if not os.path.exists(path):
+            return 0
+
+        def _read():
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        data = await self._run(_read)
+        now = time.time()
+        ops: List[_Op] = []
+        for peer_id_str, should_be_silent in (data or {}).items():
+            try:
+                peer_id = int(peer_id_str)
+            except ValueError:
+                logger.error(f"Некорректный peer_id '{peer_id_str}' в {path}. Пропускаем.")
+                continue
+            if should_be_silent:
+                self._silenced[peer_id] = True
+                ops.append(("INSERT OR REPLACE INTO silenced_peers (peer_id, silenced_at) VALUES (?, ?)", (peer_id, now)))
+        await self._apply_now(ops)
+        await self._run(os.replace, path, path + ".migrated")
+        logger.info(f"Импортировано {len(ops)} режимов молчания из {path}.")
+        return len(ops)
+
+    # --- Кулдауны ---
+    async def get_last_message_time(self, user_id: int) -> Optional[float]:
+        if user_id in self._cooldowns:
+            return self._cooldowns[user_id]
+        row = await self._read_one("SELECT last_message_at FROM user_cooldowns WHERE user_id = ?", (user_id,))
+        if user_id not in self._cooldowns:
+            self._cooldowns[user_id] = row[0] if row else None
+        return self._cooldowns[user_id]
+
+    def set_last_message_time(self, user_id: int, timestamp: float):
+        self._cooldowns[user_id] = timestamp
+        self._queue("INSERT OR REPLACE INTO user_cooldowns (user_id, last_message_at) VALUES (?, ?)", (user_id, timestamp))
+
+    def prune_cooldowns(self, older_than: float):
+        for user_id in [u for u, ts in self._cooldowns.items() if ts is None or ts < older_than]:
+            del self._cooldowns[user_id]
+        self._queue("DELETE FROM user_cooldowns WHERE last_message_at < ?", (older_than,))
+
+    # --- Буферы сообщений и их таймеры ---
+    def pending_messages(self, peer_id: int) -> List[str]:
+        return list(self._pending.get(peer_id, []))
+
+    def pending_peers(self) -> List[int]:
+        return list(self._pending)
+
+    def append_pending(self, peer_id: int, user_id: int, text: str):
+        self._pending.setdefault(peer_id, []).append(text)
+        self._queue(
+            "INSERT INTO pending_messages (peer_id, user_id, text, created_at) VALUES (?, ?, ?, ?)",
+            (peer_id, user_id, text, time.time()),
+        )
+
+    def pop_pending(self, peer_id: int) -> List[str]:
+        messages = self._pending.pop(peer_id, [])
+        if messages:
+            self._queue("DELETE FROM pending_messages WHERE peer_id = ?", (peer_id,))
+        return messages
+
+    def buffer_timers(self) -> Dict[int, Tuple[int, float]]:
+        return dict(self._timers)
+
+    def set_buffer_timer(self, peer_id: int, user_id: int, due_at: float):
+        self._timers[peer_id] = (user_id, due_at)
+        self._queue("INSERT OR REPLACE INTO buffer_timers (peer_id, user_id, due_at) VALUES (?, ?, ?)", (peer_id, user_id, due_at))
+
+    def clear_buffer_timer(self, peer_id: int):
+        if self._timers.pop(peer_id, None) is not None:
+            self._queue("DELETE FROM buffer_timers WHERE peer_id = ?", (peer_id,))
+
+    # --- Собственные исходящие сообщения бота ---
+    # random_id отправленных ботом сообщений сначала попадают в кеш в памяти, а в базу уходят через
+    # журнал операций, так что отправка ответа не ждет диска. База нужна, чтобы узнать свой ответ
+    # в message_reply, пришедшем после перезапуска бота или вытеснения записи из кеша
+    def remember_own_message(self, peer_id: int, random_id: int):
+        self._own_messages[(peer_id, random_id)] = True
+        self._queue("INSERT OR REPLACE INTO own_messages (peer_id, random_id, sent_at) VALUES (?, ?, ?)",
+                    (peer_id, random_id, time.time()))
+
+    def forget_own_message(self, peer_id: int, random_id: int):
+        self._own_messages.pop((peer_id, random_id))
+        self._queue("DELETE FROM own_messages WHERE peer_id = ? AND random_id = ?", (peer_id, random_id))
+
+    async def pop_own_message(self, peer_id: int, random_id: int) -> bool:
+        if (peer_id, random_id) not in self._own_messages:
+            row = await self._read_one("SELECT 1 FROM own_messages WHERE peer_id = ? AND random_id = ?",
+                                       (peer_id, random_id))
+            if row is None:
+                return False
+        self.forget_own_message(peer_id, random_id)
+        return True
+
+    def prune_own_messages(self, older_than: float):
+        self._queue("DELETE FROM own_messages WHERE sent_at < ?", (older_than,))
+
+    # --- Служебные значения (например, page token Google Drive) ---
+    async def get_value(self, key: str) -> Optional[str]:
+        row = await self._read_one("SELECT value FROM kv_state WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    async def set_value(self, key: str, value: str):
+        await self._apply_now([("INSERT OR REPLACE INTO kv_state (key, value, updated_at) VALUES (?, ?, ?)",
+                                (key, value, time.time()))])
+
+    # --- Ограничение памяти ---
+    def sweep_caches(self) -> int:
+        return (self._threads.sweep() + self._silenced.sweep() + self._cooldowns.sweep()
+                + self._own_messages.sweep())
+
+    def cache_stats(self) -> List[Dict[str, Any]]:
+        return [self._threads.stats(), self._silenced.stats(), self._cooldowns.stats(), self._own_messages.stats()]
+
+    # --- Массовый сброс ---
+    async def reset_all(self) -> Dict[str, int]:
+        # Одна транзакция: треды, буферы и таймеры сбрасываются вместе
+        pending = len(self._pending)
+        self._threads_generation += 1
+        self._threads.clear()
+        self._pending.clear()
+        self._timers.clear()
+        threads, _, _ = await self._apply_now([
+            ("DELETE FROM user_threads", ()),
+            ("DELETE FROM pending_messages", ()),
+            ("DELETE FROM buffer_timers", ()),
+        ])
+        return {"threads": threads, "pending": pending}
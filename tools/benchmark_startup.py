@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Время импорта bot.py по данным `python -X importtime` и проверка, что зависимости обновления БЗ
+# (chromadb, LangChain, клиент Google Drive, PyPDF2, python-docx, tiktoken) не грузятся при старте.
+# Импорт идет в отдельном процессе во временном каталоге; недостающие переменные .env подставляются
+# фиктивными значениями. Код выхода 1 — если загрузился запрещенный модуль или превышен --max-seconds.
+# Пример:
+#   python tools/benchmark_startup.py --runs 5 --top 15 --max-seconds 3
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INGESTION_ONLY_MODULES = ["chromadb", "langchain", "langchain_openai", "googleapiclient", "PyPDF2", "docx", "tiktoken"]
+DUMMY_ENV = {
+    "VK_GROUP_TOKEN": "benchmark",
+    "VK_GROUP_ID": "1",
+    "OPENAI_API_KEY": "benchmark",
+    "ASSISTANT_ID": "benchmark",
+    "GOOGLE_DRIVE_FOLDER_ID": "benchmark",
+    "ADMIN_USER_ID": "1",
+}
+_MODULES_MARKER = "__loaded_modules__="
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _run_import(module: str, watched: List[str], workdir: str) -> Tuple[Dict[str, int], List[str]]:
+    code = (
+        f"import json, sys; import {module}; "
+        f"print({_MODULES_MARKER!r} + json.dumps([m for m in {watched!r} if m in sys.modules]))"
+    )
+    env = dict(os.environ)
+    for name, value in DUMMY_ENV.items():
+        env.setdefault(name, value)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        # bot.py пишет лог (и ошибки инициализации) в stdout, трассировку импорта — в stderr
+        output = completed.stdout.strip().splitlines() + completed.stderr.strip().splitlines()[-5:]
+        tail = "\n".join(output[-15:])
+        raise RuntimeError(f"импорт '{module}' завершился с кодом {completed.returncode}:\n{tail}")
+    # Кумулятивное время модуля и его прямых импортов (отступ importtime не больше одного уровня)
+    cumulative: Dict[str, int] = {}
+    for line in completed.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match and len(match.group(3)) <= 3:
+            cumulative[match.group(4)] = int(match.group(2))
+    loaded: List[str] = []
+    for line in completed.stdout.splitlines():
+        if line.startswith(_MODULES_MARKER):
+            loaded = json.loads(line[len(_MODULES_MARKER):])
+    return cumulative, loaded
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного импорта бота (python -X importtime)")
+    parser.add_argument("--module", default="bot")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="порог медианного времени импорта модуля")
+    parser.add_argument("--forbid", nargs="*", default=INGESTION_ONLY_MODULES,
+                        help="модули, которых не должно быть в sys.modules после импорта")
+    args = parser.parse_args()
+
+    totals: List[float] = []
+    cumulative: Dict[str, int] = {}
+    loaded: List[str] = []
+    with tempfile.TemporaryDirectory(prefix="startup_bench_") as workdir:
+        for _ in range(max(1, args.runs)):
+            try:
+                cumulative, loaded = _run_import(args.module, args.forbid, workdir)
+            except RuntimeError as e:
+                print(f"Ошибка: {e}", file=sys.stderr)
+                return 1
+            totals.append(cumulative.get(args.module, 0) / 1_000_000)
+
+    median = statistics.median(totals)
+    print(f"Импорт '{args.module}': медиана {median:.3f}с, мин {min(totals):.3f}с, макс {max(totals):.3f}с "
+          f"({len(totals)} запусков)")
+    print(f"Самые тяжелые импорты (последний запуск, топ-{args.top}):")
+    for name, microseconds in sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {microseconds / 1000:9.1f} мс  {name}")
+
+    failed = False
+    if loaded:
+        print(f"Загружены модули, нужные только для обновления БЗ: {', '.join(loaded)}")
+        failed = True
+    else:
+        print("Модули обновления БЗ при импорте не загружаются.")
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"Медиана {median:.3f}с больше порога {args.max_seconds:.3f}с")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Сравнение скорости поиска: коллекция ChromaDB (через asyncio.to_thread, как в боте) и индекс NumPy.
+# Данные синтетические: случайные единичные векторы размерности эмбеддингов бота.
+# Пример:
+#   python tools/benchmark_vector_backends.py --chunks 3000 --queries 200
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import NumpyVectorIndex  # noqa: E402
+
+
+def _random_unit_vectors(rng: np.random.Generator, count: int, dimensions: int) -> np.ndarray:
+    vectors = rng.standard_normal((count, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def _measure(name: str, queries: np.ndarray, run_query: Callable) -> List[float]:
+    timings = []
+    for query in queries:
+        started_at = time.perf_counter()
+        await run_query(query)
+        timings.append((time.perf_counter() - started_at) * 1000)
+    timings.sort()
+    print(f"{name:>8}: p50={statistics.median(timings):.2f} мс  "
+          f"p95={timings[int(len(timings) * 0.95) - 1]:.2f} мс  max={timings[-1]:.2f} мс")
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска: ChromaDB против индекса NumPy")
+    parser.add_argument("--chunks", type=int, default=3000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    import chromadb
+
+    rng = np.random.default_rng(args.seed)
+    embeddings = _random_unit_vectors(rng, args.chunks, args.dimensions)
+    queries = _random_unit_vectors(rng, args.queries, args.dimensions)
+    ids = [f"chunk_{i}" for i in range(args.chunks)]
+    documents = [f"Текст фрагмента {i}" for i in range(args.chunks)]
+    metadatas = [{"source": f"doc_{i % 50}.docx", "chunk": i} for i in range(args.chunks)]
+
+    workdir = tempfile.mkdtemp(prefix="vector_bench_")
+    try:
+        collection = chromadb.PersistentClient(path=workdir).get_or_create_collection(name="bench")
+        batch = 5000
+        for start in range(0, args.chunks, batch):
+            end = start + batch
+            collection.add(ids=ids[start:end], embeddings=embeddings[start:end].tolist(),
+                           documents=documents[start:end], metadatas=metadatas[start:end])
+        index = NumpyVectorIndex.build(workdir, ids, embeddings, documents, metadatas)
+        print(f"Чанков: {args.chunks}, размерность: {args.dimensions}, запросов: {args.queries}, k={args.k}")
+
+        async def _chroma(query: np.ndarray):
+            return await asyncio.to_thread(
+                collection.query, query_embeddings=[query.tolist()], n_results=args.k,
+                include=["documents", "metadatas", "distances"],
+            )
+
+        async def _numpy(query: np.ndarray):
+            return index.query(query.tolist(), n_results=args.k)
+
+        async def _run():
+            chroma_timings = await _measure("chroma", queries, _chroma)
+            numpy_timings = await _measure("numpy", queries, _numpy)
+            print(f"Ускорение по медиане: x{statistics.median(chroma_timings) / statistics.median(numpy_timings):.1f}")
+
+            # HNSW в Chroma приближенный, NumPy — точный: показываем, насколько совпадает топ
+            same = 0
+            for query in queries[:50]:
+                chroma_ids = (await _chroma(query))["ids"][0]
+                numpy_ids = (await _numpy(query))["ids"][0]
+                same += len(set(chroma_ids) & set(numpy_ids))
+            print(f"Совпадение топ-{args.k} с Chroma: {same / (min(50, len(queries)) * args.k):.1%}")
+
+        asyncio.run(_run())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Проверка DocumentParsingService с лимитом памяти по умолчанию: родительский процесс сначала
+# резервирует больше 1 ГБ адресного пространства (как бот после долгой работы), затем воркер,
+# созданный через fork, должен разобрать небольшой текстовый файл без MemoryError.
+# Пример:
+#   python tools/check_document_parsing.py --reserve-mb 1536
+import argparse
+import asyncio
+import mmap
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_parsing import DocumentParsingService  # noqa: E402
+
+
+async def _parse(text: str) -> str:
+    service = DocumentParsingService(workers=1)
+    try:
+        return await service.parse("text/plain", text.encode("utf-8"), "check.txt")
+    finally:
+        service.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Разбор документа в воркере при большом адресном пространстве бота")
+    parser.add_argument("--reserve-mb", type=int, default=1536)
+    parser.add_argument("--text-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    # Анонимное отображение увеличивает VmSize, но не занимает физическую память
+    reserved = mmap.mmap(-1, args.reserve_mb * 1024 * 1024)
+    text = ("строка базы знаний " * 64 + "\n") * max(1, args.text_kb * 1024 // 1200)
+    try:
+        content = asyncio.run(_parse(text))
+    except Exception as e:
+        print(f"Ошибка: разбор не удался при зарезервированных {args.reserve_mb} МБ: {type(e).__name__}: {e}")
+        return 1
+    finally:
+        reserved.close()
+    if content != text:
+        print("Ошибка: разобранный текст не совпадает с исходным")
+        return 1
+    print(f"OK: разобрано {len(content)} символов при зарезервированных {args.reserve_mb} МБ")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
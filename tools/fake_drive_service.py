@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Подделка клиента Google Drive (только changes API) для локальной проверки DriveChangesWatcher.
+# Пример:
+#   python tools/fake_drive_service.py
+import asyncio
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drive_sync import DriveChangesWatcher  # noqa: E402
+
+
+class _Request:
+    def __init__(self, result: Dict[str, Any]):
+        self._result = result
+
+    def execute(self) -> Dict[str, Any]:
+        return self._result
+
+
+class _Changes:
+    def __init__(self, drive: "FakeDriveService"):
+        self._drive = drive
+
+    def getStartPageToken(self, **_kwargs) -> _Request:
+        return _Request({"startPageToken": str(len(self._drive.log))})
+
+    def list(self, pageToken: str, pageSize: int = 100, **_kwargs) -> _Request:
+        start = int(pageToken)
+        end = min(start + pageSize, len(self._drive.log))
+        response: Dict[str, Any] = {"changes": self._drive.log[start:end]}
+        if end < len(self._drive.log):
+            response["nextPageToken"] = str(end)
+        else:
+            response["newStartPageToken"] = str(end)
+        return _Request(response)
+
+
+class FakeDriveService:
+    # Журнал изменений — список; page token — позиция в нем, как и у настоящего API (непрозрачная строка)
+    def __init__(self):
+        self.log: List[Dict[str, Any]] = []
+
+    def changes(self) -> _Changes:
+        return _Changes(self)
+
+    def edit(self, file_id: str, name: str, parents: List[str], mime_type: str = "text/plain"):
+        self.log.append({"fileId": file_id, "removed": False,
+                         "file": {"id": file_id, "name": name, "parents": parents, "mimeType": mime_type}})
+
+    def remove(self, file_id: str):
+        self.log.append({"fileId": file_id, "removed": True})
+
+
+def main() -> int:
+    folder_id = "kb-folder"
+    drive = FakeDriveService()
+    token: Dict[str, Optional[str]] = {"value": None}
+    synced: List[List[Dict[str, Any]]] = []
+
+    async def _load():
+        return token["value"]
+
+    async def _save(value: str):
+        token["value"] = value
+
+    async def _on_changes(changes: List[Dict[str, Any]]) -> bool:
+        synced.append(changes)
+        return True
+
+    watcher = DriveChangesWatcher(drive, folder_id, _load, _save, _on_changes,
+                                  is_tracked=lambda file_id: file_id == "price")
+
+    async def _run():
+        assert await watcher.poll_once(), "первый опрос должен сверить папку целиком"
+        drive.edit("other", "Чужой файл", parents=["elsewhere"])
+        assert not await watcher.poll_once(), "изменения вне папки не запускают обновление"
+        drive.edit("faq", "FAQ", parents=[folder_id])
+        drive.remove("price")
+        assert await watcher.poll_once()
+        assert [c["fileId"] for c in synced[-1]] == ["faq", "price"]
+        assert not await watcher.poll_once(), "без новых изменений обновление не нужно"
+        print(f"OK: {watcher.stats()}, токен={token['value']}")
+
+    asyncio.run(_run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
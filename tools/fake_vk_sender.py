@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Локальная имитация VK Callback API: шлет боту события так же, как это делает VK.
+# Пример:
+#   python tools/fake_vk_sender.py --group-id 123 --secret s3cr3t confirm
+#   python tools/fake_vk_sender.py --group-id 123 --secret s3cr3t message --from-id 42 --text "адрес"
+#   python tools/fake_vk_sender.py --group-id 123 --secret s3cr3t reply --peer-id 42 --text "Оператор на связи"
+import argparse
+import asyncio
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+
+def build_event(event_type: str, group_id: int, secret: Optional[str], obj: Optional[Dict[str, Any]] = None,
+                api_version: str = "5.199") -> Dict[str, Any]:
+    event: Dict[str, Any] = {
+        "type": event_type,
+        "group_id": group_id,
+        "event_id": uuid.uuid4().hex,
+        "v": api_version,
+    }
+    if obj is not None:
+        event["object"] = obj
+    if secret:
+        event["secret"] = secret
+    return event
+
+
+def build_message_new(group_id: int, secret: Optional[str], from_id: int, text: str,
+                      peer_id: Optional[int] = None) -> Dict[str, Any]:
+    message = {
+        "date": int(time.time()),
+        "from_id": from_id,
+        "id": random.randint(1, 10**6),
+        "out": 0,
+        "peer_id": peer_id or from_id,
+        "text": text,
+        "conversation_message_id": random.randint(1, 10**6),
+        "random_id": 0,
+        "attachments": [],
+    }
+    return build_event("message_new", group_id, secret, {"message": message, "client_info": {}})
+
+
+def build_message_reply(group_id: int, secret: Optional[str], peer_id: int, text: str,
+                        random_id: int = 0) -> Dict[str, Any]:
+    message = {
+        "date": int(time.time()),
+        "from_id": -group_id,
+        "id": random.randint(1, 10**6),
+        "out": 1,
+        "peer_id": peer_id,
+        "text": text,
+        "random_id": random_id,
+        "attachments": [],
+    }
+    return build_event("message_reply", group_id, secret, message)
+
+
+async def send_event(url: str, event: Dict[str, Any]) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=event) as resp:
+            body = await resp.text()
+            print(f"HTTP {resp.status}: {body}")
+            return body
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Имитация VK Callback API для локальной проверки бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/vk/callback")
+    parser.add_argument("--group-id", type=int, required=True)
+    parser.add_argument("--secret", default=None)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("confirm")
+
+    p_message = sub.add_parser("message")
+    p_message.add_argument("--from-id", type=int, required=True)
+    p_message.add_argument("--peer-id", type=int, default=None)
+    p_message.add_argument("--text", required=True)
+    p_message.add_argument("--count", type=int, default=1, help="сколько одинаковых событий отправить")
+
+    p_reply = sub.add_parser("reply")
+    p_reply.add_argument("--peer-id", type=int, required=True)
+    p_reply.add_argument("--text", required=True)
+    p_reply.add_argument("--random-id", type=int, default=0)
+
+    args = parser.parse_args()
+
+    async def _run():
+        if args.command == "confirm":
+            await send_event(args.url, build_event("confirmation", args.group_id, args.secret))
+        elif args.command == "message":
+            for _ in range(args.count):
+                event = build_message_new(args.group_id, args.secret, args.from_id, args.text, args.peer_id)
+                await send_event(args.url, event)
+        elif args.command == "reply":
+            event = build_message_reply(args.group_id, args.secret, args.peer_id, args.text, args.random_id)
+            await send_event(args.url, event)
+
+    asyncio.run(_run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+import glob
+import json
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors.f32"
+CHUNKS_FILE = "chunks.json"
+META_FILE = "vector_index.json"
+# Версия 2: векторы и чанки лежат в файлах с ревизией в имени (vectors.<ревизия>.f32), а
+# vector_index.json — единственный указатель на текущую ревизию. Версия 1 (файлы без ревизии) читается.
+INDEX_FORMAT_VERSION = 2
+_LEGACY_INDEX_FORMAT_VERSION = 1
+
+
+def _revision_files(revision: str) -> Tuple[str, str]:
+    return f"vectors.{revision}.f32", f"chunks.{revision}.json"
+
+
+def _fsync_file(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _write_atomic(path: str, write):
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class NumpyVectorIndex:
+    # Все эмбеддинги базы знаний в одной непрерывной float32-матрице (memmap с диска).
+    # Векторы нормализуются при сборке, поэтому поиск — одно умножение матрицы на вектор и argpartition.
+    # Результат query() повторяет формат Chroma collection.query для одного запроса;
+    # distances — квадрат L2 между единичными векторами (2 - 2·cos), как у коллекции Chroma по умолчанию.
+    def __init__(self, vectors: np.ndarray, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]]):
+        self._vectors = vectors
+        self._ids = ids
+        self._documents = documents
+        self._metadatas = metadatas
+        self._positions = {chunk_id: position for position, chunk_id in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def dimensions(self) -> int:
+        return int(self._vectors.shape[1]) if self._vectors.ndim == 2 else 0
+
+    @staticmethod
+    def _read_meta(path: str) -> Dict[str, Any]:
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") == _LEGACY_INDEX_FORMAT_VERSION:
+            meta["vectors_file"], meta["chunks_file"] = VECTORS_FILE, CHUNKS_FILE
+        elif meta.get("format") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат векторного индекса: {meta.get('format')}")
+        return meta
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        try:
+            meta = cls._read_meta(path)
+        except (OSError, ValueError):
+            return False
+        return all(os.path.exists(os.path.join(path, meta[name])) for name in ("vectors_file", "chunks_file"))
+
+    @classmethod
+    def build(cls, path: str, ids: Sequence[str], embeddings: Sequence[Sequence[float]],
+              documents: Sequence[str], metadatas: Sequence[Dict[str, Any]]) -> "NumpyVectorIndex":
+        writer = NumpyVectorIndexWriter(path)
+        try:
+            writer.append(ids, embeddings, documents, metadatas)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.finish()
+
+    @classmethod
+    def build_from_collection(cls, path: str, collection: Any) -> "NumpyVectorIndex":
+        # Для баз, собранных до появления индекса: выгружаем все из коллекции Chroma
+        data = collection.get(include=["embeddings", "documents", "metadatas"])
+        embeddings = data.get("embeddings")
+        if embeddings is None:
+            embeddings = []
+        return cls.build(path, data["ids"], embeddings, data.get("documents") or [], data.get("metadatas") or [])
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyVectorIndex":
+        # Файлы ревизии берутся только из метаданных; их размеры сверяются с count и dimensions
+        meta = cls._read_meta(path)
+        count, dimensions = meta["count"], meta["dimensions"]
+        vectors_path = os.path.join(path, meta["vectors_file"])
+        with open(os.path.join(path, meta["chunks_file"]), "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        if not (len(chunks["ids"]) == len(chunks["documents"]) == len(chunks["metadatas"]) == count):
+            raise ValueError(f"Векторный индекс в '{path}' поврежден: {len(chunks['ids'])} чанков при {count} векторах")
+        if os.path.getsize(vectors_path) != count * dimensions * 4:
+            raise ValueError(f"Векторный индекс в '{path}' поврежден: размер '{meta['vectors_file']}' "
+                             f"не совпадает с {count}x{dimensions}")
+        if count:
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dimensions))
+        else:
+            vectors = np.zeros((0, dimensions), dtype=np.float32)
+        return cls(vectors, chunks["ids"], chunks["documents"], chunks["metadatas"])
+
+    def get(self, ids: Sequence[str]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+        # Документ и метаданные по ID чанка (для результатов, найденных не векторным поиском)
+        found = {}
+        for chunk_id in ids:
+            position = self._positions.get(chunk_id)
+            if position is not None:
+                found[chunk_id] = (self._documents[position], self._metadatas[position])
+        return found
+
+    def query(self, query_embedding: Sequence[float], n_results: int) -> Dict[str, List[List[Any]]]:
+        if not len(self._ids) or n_results <= 0:
+            return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm:
+            query_vector = query_vector / norm
+        scores = self._vectors @ query_vector
+        k = min(n_results, len(scores))
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return {
+            "ids": [[self._ids[i] for i in top]],
+            "documents": [[self._documents[i] for i in top]],
+            "metadatas": [[self._metadatas[i] for i in top]],
+            "distances": [[float(2.0 - 2.0 * scores[i]) for i in top]],
+        }
+
+
+class NumpyVectorIndexWriter:
+    # Сборка индекса пачками: векторы сразу дописываются во временный файл, документы и метаданные —
+    # во временный JSON Lines. В памяти остаются только текущая пачка и счетчик.
+    # finish() кладет файлы новой ревизии рядом с текущими и публикует их одной атомарной заменой
+    # vector_index.json, поэтому индекс можно пересобирать в каталоге активной базы: при падении
+    # или параллельном чтении виден либо старый, либо новый индекс целиком.
+    def __init__(self, path: str, dimensions: Optional[int] = None):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._dimensions = dimensions
+        self._count = 0
+        self._revision = uuid.uuid4().hex
+        self._vectors_tmp_path = os.path.join(path, VECTORS_FILE + ".tmp")
+        self._chunks_tmp_path = os.path.join(path, CHUNKS_FILE + "l.tmp")
+        self._vectors_file = open(self._vectors_tmp_path, "wb")
+        self._chunks_file = open(self._chunks_tmp_path, "w", encoding="utf-8")
+
+    def append(self, ids: Sequence[str], embeddings: Sequence[Sequence[float]],
+               documents: Sequence[str], metadatas: Sequence[Dict[str, Any]]):
+        if not (len(ids) == len(embeddings) == len(documents) == len(metadatas)):
+            raise ValueError("ids, embeddings, documents и metadatas должны быть одной длины")
+        if not len(ids):
+            return
+        matrix = np.array(embeddings, dtype=np.float32)  # копия: нормализуем на месте
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(ids), -1)
+        if self._dimensions is None:
+            self._dimensions = int(matrix.shape[1])
+        elif matrix.shape[1] != self._dimensions:
+            raise ValueError(f"Размерность эмбеддингов {matrix.shape[1]}, ожидалась {self._dimensions}")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        matrix.tofile(self._vectors_file)
+        for chunk_id, document, metadata in zip(ids, documents, metadatas):
+            self._chunks_file.write(json.dumps([chunk_id, document, metadata], ensure_ascii=False) + "\n")
+        self._count += len(ids)
+
+    def _write_chunks(self, tmp_path: str):
+        # chunks.json собирается из JSON Lines в три прохода — по одному на ids, documents и metadatas
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            for field_position, field_name in enumerate(("ids", "documents", "metadatas")):
+                out.write(("{" if field_position == 0 else ", ") + json.dumps(field_name) + ": [")
+                with open(self._chunks_tmp_path, "r", encoding="utf-8") as source:
+                    for row, line in enumerate(source):
+                        if row:
+                            out.write(", ")
+                        out.write(json.dumps(json.loads(line)[field_position], ensure_ascii=False))
+                out.write("]")
+            out.write("}")
+
+    def finish(self) -> NumpyVectorIndex:
+        self._vectors_file.close()
+        self._chunks_file.close()
+        dimensions = self._dimensions or 0
+
+        vectors_file, chunks_file = _revision_files(self._revision)
+
+        def _write_meta(tmp_path: str):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"format": INDEX_FORMAT_VERSION, "revision": self._revision, "count": self._count,
+                           "dimensions": dimensions, "vectors_file": vectors_file, "chunks_file": chunks_file}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        # Файлы ревизии никто не читает, пока на них не указывают метаданные; замена метаданных —
+        # единственная точка переключения
+        _fsync_file(self._vectors_tmp_path)
+        os.replace(self._vectors_tmp_path, os.path.join(self._path, vectors_file))
+        self._write_chunks(os.path.join(self._path, chunks_file))
+        _fsync_file(os.path.join(self._path, chunks_file))
+        _write_atomic(os.path.join(self._path, META_FILE), _write_meta)
+        os.remove(self._chunks_tmp_path)
+        self._remove_stale_revisions(vectors_file, chunks_file)
+        logger.info(f"Собран векторный индекс NumPy: {self._count} векторов размерности {dimensions} в '{self._path}'.")
+        return NumpyVectorIndex.load(self._path)
+
+    def _remove_stale_revisions(self, vectors_file: str, chunks_file: str):
+        # Прежние ревизии удаляются сразу: запросы, которые еще читают старый индекс, держат memmap
+        # (на POSIX файл живет, пока открыт), а чанки у них уже в памяти. Если удалить не вышло
+        # (Windows), файл уберет следующая сборка.
+        current = {vectors_file, chunks_file}
+        candidates = [VECTORS_FILE, CHUNKS_FILE]
+        candidates += [os.path.basename(p) for p in glob.glob(os.path.join(self._path, "vectors.*.f32"))]
+        candidates += [os.path.basename(p) for p in glob.glob(os.path.join(self._path, "chunks.*.json"))]
+        for name in candidates:
+            if name in current:
+                continue
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старую ревизию векторного индекса '{name}': {e}")
+
+    def abort(self):
+        self._vectors_file.close()
+        self._chunks_file.close()
+        for tmp_path in (self._vectors_tmp_path, self._chunks_tmp_path):
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+def load_or_build_index(path: str, collection: Optional[Any] = None) -> Optional[NumpyVectorIndex]:
+    if NumpyVectorIndex.exists(path):
+        return NumpyVectorIndex.load(path)
+    if collection is None:
+        return None
+    logger.info(f"Векторный индекс NumPy в '{path}' не найден, собираем из коллекции Chroma...")
+    return NumpyVectorIndex.build_from_collection(path, collection)
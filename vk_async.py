@@ -0,0 +1,222 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+VK_API_BASE_URL = "https://api.vk.com/method/"
+VK_HTTP_POOL_SIZE = 100
+VK_HTTP_KEEPALIVE_SECONDS = 60
+VK_API_TIMEOUT_SECONDS = 15
+# Максимум вызовов API внутри одного execute
+VK_EXECUTE_MAX_CALLS = 25
+
+
+# --- Ошибки ---
+class VkTransportError(Exception):
+    # Сетевая ошибка, таймаут или некорректный ответ сервера VK
+    pass
+
+
+class VkLongPollError(Exception):
+    pass
+
+
+class VkApiError(Exception):
+    def __init__(self, code: Optional[int], message: str, method: str,
+                 request_params: Optional[List[Dict[str, Any]]] = None):
+        super().__init__(f"[{code}] {message} (метод {method})")
+        self.code = code
+        self.message = message
+        self.method = method
+        self.request_params = request_params or []
+
+
+class VkAuthError(VkApiError):
+    pass
+
+
+class VkTooManyRequestsError(VkApiError):
+    pass
+
+
+class VkFloodControlError(VkApiError):
+    pass
+
+
+class VkInternalServerError(VkApiError):
+    pass
+
+
+class VkAccessDeniedError(VkApiError):
+    pass
+
+
+# Коды ошибок: https://dev.vk.com/ru/reference/errors
+VK_ERROR_CLASSES: Dict[int, type] = {
+    5: VkAuthError,
+    6: VkTooManyRequestsError,
+    7: VkAccessDeniedError,
+    9: VkFloodControlError,
+    10: VkInternalServerError,
+    15: VkAccessDeniedError,
+    901: VkAccessDeniedError,  # Пользователь не разрешил сообщения от сообщества
+    902: VkAccessDeniedError,  # Настройки приватности пользователя
+}
+
+
+def make_vk_api_error(error: Dict[str, Any], method: str) -> VkApiError:
+    code = error.get("error_code")
+    error_class = VK_ERROR_CLASSES.get(code, VkApiError)
+    return error_class(code, error.get("error_msg", ""), method, error.get("request_params"))
+
+
+def create_vk_http_session(pool_size: int = VK_HTTP_POOL_SIZE,
+                           keepalive_timeout: float = VK_HTTP_KEEPALIVE_SECONDS) -> aiohttp.ClientSession:
+    # Одна сессия на процесс: keep-alive соединения переиспользуются между запросами
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def _encode_param(value: Any) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(v) for v in value)
+    return str(value)
+
+
+def _execute_call_code(method: str, params: Dict[str, Any]) -> str:
+    args = {k: v for k, v in params.items() if v is not None}
+    return f"API.{method}({json.dumps(args, ensure_ascii=False)})"
+
+
+def estimate_execute_call_length(method: str, params: Dict[str, Any]) -> int:
+    return len(_execute_call_code(method, params)) + 1
+
+
+def build_execute_code(calls: Sequence[Tuple[str, Dict[str, Any]]]) -> str:
+    return "return [" + ",".join(_execute_call_code(m, p) for m, p in calls) + "];"
+
+
+# --- Клиент методов API ---
+class AsyncVkApi:
+    def __init__(self, session: aiohttp.ClientSession, token: str, api_version: str,
+                 timeout: float = VK_API_TIMEOUT_SECONDS):
+        self._session = session
+        self._token = token
+        self._api_version = api_version
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session
+
+    async def _post(self, method: str, params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        payload = {k: _encode_param(v) for k, v in (params or {}).items() if v is not None}
+        payload["access_token"] = self._token
+        payload["v"] = self._api_version
+        try:
+            async with self._session.post(VK_API_BASE_URL + method, data=payload, timeout=self._timeout) as resp:
+                if resp.status >= 500:
+                    raise VkTransportError(f"{method}: HTTP {resp.status}")
+                data = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise VkTransportError(f"{method}: {type(e).__name__}: {e}") from e
+        if not isinstance(data, dict):
+            raise VkTransportError(f"{method}: неожиданный ответ {data!r}")
+        return data
+
+    async def method(self, method: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        data = await self._post(method, params)
+        if "error" in data:
+            raise make_vk_api_error(data["error"], method)
+        return data.get("response")
+
+    async def execute(self, calls: Sequence[Tuple[str, Dict[str, Any]]]) -> List[Union[Any, VkApiError]]:
+        # Выполняет до 25 вызовов одним запросом. Для каждого вызова возвращает его результат
+        # или VkApiError: упавшие вызовы в ответе execute равны false, а их ошибки идут
+        # по порядку в execute_errors.
+        if not calls:
+            return []
+        if len(calls) > VK_EXECUTE_MAX_CALLS:
+            raise ValueError(f"execute поддерживает не более {VK_EXECUTE_MAX_CALLS} вызовов, передано {len(calls)}")
+        data = await self._post("execute", {"code": build_execute_code(calls)})
+        if "error" in data:
+            raise make_vk_api_error(data["error"], "execute")
+        results = data.get("response")
+        if not isinstance(results, list) or len(results) != len(calls):
+            raise VkTransportError(f"execute: неожиданный ответ {results!r}")
+        execute_errors = list(data.get("execute_errors") or [])
+        outcomes: List[Union[Any, VkApiError]] = []
+        for (method, _), result in zip(calls, results):
+            if result is False:
+                if execute_errors:
+                    outcomes.append(make_vk_api_error(execute_errors.pop(0), method))
+                else:
+                    outcomes.append(VkApiError(None, "вызов внутри execute вернул false", method))
+            else:
+                outcomes.append(result)
+        return outcomes
+
+
+# --- Long Poll ---
+class AsyncVkBotLongPoll:
+    # Bots Long Poll API: https://dev.vk.com/ru/api/bots-long-poll/getting-started
+    def __init__(self, api: AsyncVkApi, group_id: int, wait: int = 25):
+        self._api = api
+        self._group_id = group_id
+        self._wait = wait
+        self.server: Optional[str] = None
+        self.key: Optional[str] = None
+        self.ts: Optional[str] = None
+
+    async def update_longpoll_server(self, update_ts: bool = True):
+        response = await self._api.method("groups.getLongPollServer", {"group_id": self._group_id})
+        self.key = response["key"]
+        self.server = response["server"]
+        if update_ts:
+            self.ts = response["ts"]
+        logger.debug(f"Получен Long Poll сервер {self.server} (ts={self.ts}).")
+
+    async def check(self) -> List[Dict[str, Any]]:
+        if not self.server:
+            await self.update_longpoll_server()
+        params = {"act": "a_check", "key": self.key, "ts": self.ts, "wait": self._wait}
+        timeout = aiohttp.ClientTimeout(total=self._wait + 10)
+        try:
+            async with self._api.session.get(self.server, params=params, timeout=timeout) as resp:
+                data = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise VkTransportError(f"Long Poll: {type(e).__name__}: {e}") from e
+
+        failed = data.get("failed")
+        if failed is None:
+            self.ts = data["ts"]
+            return data.get("updates", [])
+        if failed == 1:
+            # История событий устарела или частично утеряна, продолжаем с нового ts
+            logger.warning(f"Long Poll failed=1, продолжаем с ts={data.get('ts')}.")
+            self.ts = data["ts"]
+        elif failed == 2:
+            logger.info("Long Poll failed=2: истек key, запрашиваем новый.")
+            await self.update_longpoll_server(update_ts=False)
+        elif failed == 3:
+            logger.info("Long Poll failed=3: информация утрачена, запрашиваем новые key и ts.")
+            await self.update_longpoll_server(update_ts=True)
+        else:
+            raise VkLongPollError(f"Неизвестный ответ Long Poll сервера: {data}")
+        return []
+
+    async def listen(self) -> AsyncIterator[Dict[str, Any]]:
+        while True:
+            for raw_event in await self.check():
+                yield raw_event
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Callback API: https://dev.vk.com/ru/api/callback/getting-started
+VkRawEventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+SEEN_EVENT_IDS_LIMIT = 5000
+
+
+def create_callback_app(on_event: VkRawEventHandler, group_id: int, confirmation_code: str,
+                        secret_key: Optional[str] = None, path: str = "/vk/callback") -> web.Application:
+    # VK повторяет доставку, если не получил "ok", поэтому помним последние event_id
+    seen_event_ids: "OrderedDict[str, None]" = OrderedDict()
+    background_tasks: set = set()
+
+    async def _run_handler(raw_event: Dict[str, Any]):
+        try:
+            await on_event(raw_event)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке события Callback API {raw_event.get('type')}: {e}", exc_info=True)
+
+    async def handle_callback(request: web.Request) -> web.Response:
+        try:
+            data = await request.json(loads=json.loads)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.warning("Callback API: получено тело, не являющееся JSON.")
+            return web.Response(status=400, text="bad request")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="bad request")
+
+        if data.get("group_id") != group_id:
+            logger.warning(f"Callback API: событие для чужой группы {data.get('group_id')}. Отклонено.")
+            return web.Response(status=403, text="forbidden")
+        if secret_key and data.get("secret") != secret_key:
+            logger.warning("Callback API: неверный секретный ключ. Событие отклонено.")
+            return web.Response(status=403, text="forbidden")
+
+        event_type = data.get("type")
+        if event_type == "confirmation":
+            logger.info("Callback API: запрос подтверждения адреса сервера.")
+            return web.Response(text=confirmation_code)
+
+        event_id = data.get("event_id")
+        if event_id:
+            if event_id in seen_event_ids:
+                logger.debug(f"Callback API: повторная доставка события {event_id}. Пропускаем.")
+                return web.Response(text="ok")
+            seen_event_ids[event_id] = None
+            if len(seen_event_ids) > SEEN_EVENT_IDS_LIMIT:
+                seen_event_ids.popitem(last=False)
+
+        # VK ждет "ok" в течение нескольких секунд, поэтому обработка идет в фоне
+        task = asyncio.create_task(_run_handler(data))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, handle_callback)
+    return app
+
+
+async def run_callback_server(app: web.Application, host: str, port: int):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Callback API сервер слушает http://{host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        logger.info("Callback API сервер остановлен.")
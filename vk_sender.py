@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from vk_async import (
+    VK_EXECUTE_MAX_CALLS, AsyncVkApi, VkInternalServerError, VkTooManyRequestsError, VkTransportError,
+    estimate_execute_call_length,
+)
+
+logger = logging.getLogger(__name__)
+
+# Лимит VK для ключа сообщества — 20 запросов в секунду
+VK_GROUP_RATE_LIMIT_PER_SECOND = 20
+WAIT_SAMPLES_LIMIT = 1000
+# Ограничение на размер кода execute, чтобы не упереться в лимит тела запроса
+VK_EXECUTE_MAX_CODE_LENGTH = 60000
+
+# Ошибки, после которых запрос имеет смысл повторить.
+# Повтор messages.send безопасен: VK не дублирует сообщения с тем же random_id.
+RETRYABLE_ERRORS = (VkTooManyRequestsError, VkInternalServerError, VkTransportError)
+
+
+class VkSendQueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def drain(self):
+        # VK уже ответил "слишком много запросов" — не тратим оставшиеся токены впустую
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+
+@dataclass
+class _SendJob:
+    method: str
+    params: Dict[str, Any]
+    peer_key: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+def _estimate_code_length(job: _SendJob) -> int:
+    return estimate_execute_call_length(job.method, job.params)
+
+
+class VkOutboundScheduler:
+    # Все исходящие вызовы VK проходят через одну очередь:
+    # - token bucket держит темп ниже лимита сообщества;
+    # - очередь ограничена, при переполнении отправители ждут (или получают VkSendQueueFull);
+    # - для одного peer_id одновременно выполняется не больше одного запроса, порядок сохраняется;
+    # - при ошибке 6 и временных сбоях запрос повторяется с нарастающей паузой;
+    # - накопившиеся запросы разных peer_id упаковываются в один execute (до 25 вызовов).
+    def __init__(self, api: AsyncVkApi, rate_per_second: float = VK_GROUP_RATE_LIMIT_PER_SECOND,
+                 max_queue_size: int = 1000, max_in_flight: int = 8,
+                 max_retries: int = 5, retry_base_delay: float = 1.0,
+                 max_batch_size: int = VK_EXECUTE_MAX_CALLS, batch_linger: float = 0.005):
+        self._api = api
+        self._max_batch_size = max(1, min(max_batch_size, VK_EXECUTE_MAX_CALLS))
+        self._batch_linger = batch_linger
+        self._bucket = TokenBucket(rate_per_second)
+        self._max_queue_size = max_queue_size
+        self._space_freed = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._max_retries = max_retries
+        self._retry_base_delay = retry_base_delay
+
+        self._peer_queues: Dict[int, Deque[_SendJob]] = {}
+        self._ready: Deque[int] = deque()
+        self._busy: Set[int] = set()
+        self._has_ready = asyncio.Event()
+        self._dispatcher_task: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+        self._pending = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._dropped = 0
+        self._batches = 0
+        self._batched_calls = 0
+        self._wait_samples: Deque[float] = deque(maxlen=WAIT_SAMPLES_LIMIT)
+        self._max_wait = 0.0
+
+    # --- Публичный интерфейс ---
+    def start(self):
+        if not self._dispatcher_task or self._dispatcher_task.done():
+            self._dispatcher_task = asyncio.create_task(self._dispatch_loop(), name="VKOutboundScheduler")
+
+    async def stop(self):
+        if self._dispatcher_task and not self._dispatcher_task.done():
+            self._dispatcher_task.cancel()
+            await asyncio.gather(self._dispatcher_task, return_exceptions=True)
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for jobs in self._peer_queues.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._peer_queues.clear()
+        self._ready.clear()
+        self._busy.clear()
+
+    async def call(self, method: str, params: Dict[str, Any], peer_id: Optional[int] = None) -> Any:
+        while self._pending >= self._max_queue_size:
+            self._space_freed.clear()
+            await self._space_freed.wait()
+        return await self._enqueue(method, params, peer_id)
+
+    def submit_nowait(self, method: str, params: Dict[str, Any], peer_id: Optional[int] = None) -> asyncio.Future:
+        # Для необязательных вызовов (статус "печатает"): при заполненной очереди просто отбрасываем
+        if self._pending >= self._max_queue_size:
+            self._dropped += 1
+            raise VkSendQueueFull(f"Очередь исходящих запросов VK заполнена ({self._pending}).")
+        return self._enqueue(method, params, peer_id)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._wait_samples)
+
+        def _percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+
+        return {
+            "queue_depth": self._pending,
+            "peers_waiting": len(self._ready),
+            "in_flight_peers": len(self._busy),
+            "sent": self._sent,
+            "failed": self._failed,
+            "retries": self._retries,
+            "rate_limited": self._rate_limited,
+            "dropped": self._dropped,
+            "execute_batches": self._batches,
+            "execute_calls": self._batched_calls,
+            "wait_ms_p50": round(_percentile(0.5) * 1000, 1),
+            "wait_ms_p95": round(_percentile(0.95) * 1000, 1),
+            "wait_ms_max": round(self._max_wait * 1000, 1),
+        }
+
+    # --- Внутренняя логика ---
+    def _enqueue(self, method: str, params: Dict[str, Any], peer_id: Optional[int]) -> asyncio.Future:
+        job = _SendJob(method, params, peer_id or 0, asyncio.get_running_loop().create_future())
+        jobs = self._peer_queues.setdefault(job.peer_key, deque())
+        jobs.append(job)
+        self._pending += 1
+        if len(jobs) == 1 and job.peer_key not in self._busy:
+            self._mark_ready(job.peer_key)
+        return job.future
+
+    def _mark_ready(self, peer_key: int):
+        if self._peer_queues.get(peer_key):
+            self._ready.append(peer_key)
+            self._has_ready.set()
+
+    def _requeue_after(self, peer_key: int, delay: float):
+        def _release():
+            self._busy.discard(peer_key)
+            self._mark_ready(peer_key)
+        asyncio.get_running_loop().call_later(delay, _release)
+
+    def _take_ready_job(self) -> Optional[Tuple[int, _SendJob]]:
+        while self._ready:
+            peer_key = self._ready.popleft()
+            jobs = self._peer_queues.get(peer_key)
+            if jobs:
+                self._busy.add(peer_key)
+                return peer_key, jobs[0]
+        return None
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._has_ready.wait()
+            first = self._take_ready_job()
+            if not first:
+                self._has_ready.clear()
+                continue
+            batch: List[Tuple[int, _SendJob]] = [first]
+            if self._batch_linger > 0 and len(self._ready) < self._max_batch_size - 1:
+                await asyncio.sleep(self._batch_linger)
+            await self._in_flight.acquire()
+            await self._bucket.acquire()
+            # Пока ждали слот и токен, могли накопиться запросы других peer_id — отправим их одним execute.
+            # Из одного peer_id в пачку попадает только первый запрос: так повтор одного не нарушит порядок.
+            code_length = _estimate_code_length(first[1])
+            while len(batch) < self._max_batch_size and self._ready:
+                peer_key = self._ready[0]
+                jobs = self._peer_queues.get(peer_key)
+                if jobs and code_length + _estimate_code_length(jobs[0]) > VK_EXECUTE_MAX_CODE_LENGTH:
+                    break
+                item = self._take_ready_job()
+                if not item:
+                    break
+                code_length += _estimate_code_length(item[1])
+                batch.append(item)
+            if not self._ready:
+                self._has_ready.clear()
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _finish(self, peer_key: int, job: _SendJob):
+        jobs = self._peer_queues.get(peer_key)
+        if jobs and jobs[0] is job:
+            jobs.popleft()
+        if not jobs:
+            self._peer_queues.pop(peer_key, None)
+        self._pending -= 1
+        self._space_freed.set()
+        self._busy.discard(peer_key)
+        self._mark_ready(peer_key)
+
+    def _complete(self, peer_key: int, job: _SendJob, outcome: Any):
+        if isinstance(outcome, BaseException):
+            if isinstance(outcome, RETRYABLE_ERRORS):
+                if isinstance(outcome, VkTooManyRequestsError):
+                    self._rate_limited += 1
+                    self._bucket.drain()
+                if job.attempts <= self._max_retries:
+                    delay = self._retry_base_delay * (2 ** (job.attempts - 1))
+                    self._retries += 1
+                    logger.warning(f"VK {job.method} (peer_id={peer_key}): {outcome}. Повтор через {delay:.1f}с "
+                                   f"(попытка {job.attempts + 1}/{self._max_retries + 1}).")
+                    self._requeue_after(peer_key, delay)
+                    return
+            self._failed += 1
+            if not job.future.done():
+                job.future.set_exception(outcome)
+        else:
+            self._sent += 1
+            if not job.future.done():
+                job.future.set_result(outcome)
+        self._finish(peer_key, job)
+
+    async def _run_batch(self, batch: List[Tuple[int, _SendJob]]):
+        try:
+            now = time.monotonic()
+            live: List[Tuple[int, _SendJob]] = []
+            for peer_key, job in batch:
+                if job.attempts == 0:
+                    waited = now - job.enqueued_at
+                    self._wait_samples.append(waited)
+                    self._max_wait = max(self._max_wait, waited)
+                job.attempts += 1
+                if job.future.done():
+                    # Отправитель уже перестал ждать (отмена/таймаут)
+                    self._finish(peer_key, job)
+                else:
+                    live.append((peer_key, job))
+            if not live:
+                return
+
+            outcomes: List[Any]
+            if len(live) == 1:
+                job = live[0][1]
+                try:
+                    outcomes = [await self._api.method(job.method, job.params)]
+                except Exception as e:
+                    outcomes = [e]
+            else:
+                try:
+                    outcomes = await self._api.execute([(job.method, job.params) for _, job in live])
+                except Exception as e:
+                    outcomes = [e] * len(live)
+                self._batches += 1
+                self._batched_calls += len(live)
+                logger.debug(f"VK execute: {len(live)} вызовов одним запросом.")
+
+            for (peer_key, job), outcome in zip(live, outcomes):
+                self._complete(peer_key, job, outcome)
+        finally:
+            self._in_flight.release()